@@ -47,6 +47,10 @@ setup(
             'Products.CMFCore>=2.2.3',
             'zope.configuration',
             ],
+        ## optional, for zero-copy columns of uu.retrieval.snapshot:
+        'snapshot': [
+            'numpy',
+            ],
     },
     entry_points='''
     # -*- Entry points: -*-
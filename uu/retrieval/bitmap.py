@@ -0,0 +1,375 @@
+"""
+Compressed docid sets, in the style of roaring bitmaps: integer docids
+are partitioned into chunks by their high bits (docid >> 16), and each
+chunk stores the low 16 bits of its members in a container that is
+either a sorted array (sparse chunk) or a bitmap held as a long
+integer (dense chunk, more than ARRAY_MAX members).
+
+Bitmap is an in-memory set used for query evaluation; BitmapPostings
+is its persistent counterpart, usable in place of a TreeSet as the
+postings (docid set) for one value in an index.
+"""
+
+import binascii
+from array import array
+from bisect import bisect_left, bisect_right
+
+from persistent import Persistent
+from BTrees.Length import Length
+import BTrees
+
+from uu.retrieval.utils import key_before
+
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+ARRAY_MAX = 4096  # maximum members of an array container
+INLINE_MAX = 64  # maximum members of a chunk stored in its BTree bucket
+_BITMAP_BYTES = (1 << CHUNK_BITS) / 8
+
+# positions of bits set in each byte value:
+_BYTE_BITS = tuple(
+    tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)
+    )
+
+
+## chunk containers: sorted array('H') of low bits, or long bitmap;
+## containers are never modified in place, operations return new ones.
+
+def _count(c):
+    if isinstance(c, array):
+        return len(c)
+    return bin(c).count('1')
+
+
+def _bytemap(bits):
+    """bytearray of bitmap, byte i holds bits of members 8i .. 8i+7"""
+    data = bytearray(binascii.unhexlify('%0*x' % (_BITMAP_BYTES * 2, bits)))
+    data.reverse()
+    return data
+
+
+def _to_bits(members):
+    data = bytearray(_BITMAP_BYTES)
+    for low in members:
+        data[low >> 3] |= 1 << (low & 7)
+    data.reverse()
+    return long(binascii.hexlify(data), 16)
+
+
+def _to_members(bits):
+    r = array('H')
+    if bits:
+        for i, byte in enumerate(_bytemap(bits)):
+            if byte:
+                base = i << 3
+                r.extend(base + bit for bit in _BYTE_BITS[byte])
+    return r
+
+
+def _container(c):
+    """
+    Normalize container c: array if sparse, bitmap if dense, or None
+    if empty.
+    """
+    count = _count(c)
+    if not count:
+        return None
+    if isinstance(c, array):
+        return _to_bits(c) if count > ARRAY_MAX else c
+    return _to_members(c) if count <= ARRAY_MAX else c
+
+
+def _has(c, low):
+    if isinstance(c, array):
+        i = bisect_left(c, low)
+        return i < len(c) and c[i] == low
+    return bool(c >> low & 1)
+
+
+def _add(c, low):
+    if isinstance(c, array):
+        r = array('H', c)
+        r.insert(bisect_left(c, low), low)
+        return _container(r)
+    return c | (1 << low)
+
+
+def _discard(c, low):
+    if isinstance(c, array):
+        i = bisect_left(c, low)
+        return _container(c[:i] + c[i + 1:])
+    return _container(c & ~(1 << low))
+
+
+def _and(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        if len(a) > len(b):
+            a, b = b, a
+        b = set(b)
+        return _container(array('H', [low for low in a if low in b]))
+    if isinstance(b, array):
+        a, b = b, a
+    if isinstance(a, array):
+        data = _bytemap(b)
+        return _container(
+            array('H', [low for low in a if data[low >> 3] >> (low & 7) & 1])
+            )
+    return _container(a & b)
+
+
+def _or(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return _container(array('H', sorted(set(a).union(b))))
+    if isinstance(a, array):
+        a = _to_bits(a)
+    if isinstance(b, array):
+        b = _to_bits(b)
+    return a | b
+
+
+def _sub(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            b = set(b)
+            return _container(array('H', [low for low in a if low not in b]))
+        data = _bytemap(b)
+        return _container(
+            array(
+                'H',
+                [low for low in a if not data[low >> 3] >> (low & 7) & 1],
+                )
+            )
+    if isinstance(b, array):
+        b = _to_bits(b)
+    return _container(a & ~b)
+
+
+class Bitmap(object):
+    """
+    In-memory compressed set of integer docids; self.chunks maps chunk
+    key (docid >> 16) to a non-empty container of member low bits.
+
+    Bitmaps are treated as immutable: set operations (&, |, -) return
+    new bitmaps, possibly sharing containers with their operands.
+    """
+
+    __slots__ = ('chunks',)
+
+    def __init__(self, docids=()):
+        groups = {}
+        for docid in docids:
+            key = docid >> CHUNK_BITS
+            groups.setdefault(key, []).append(docid & LOW_MASK)
+        self.chunks = {}
+        for key, members in groups.items():
+            members = array('H', sorted(set(members)))
+            self.chunks[key] = _container(members)
+
+    @classmethod
+    def fromchunks(cls, chunks):
+        bitmap = cls.__new__(cls)
+        bitmap.chunks = chunks
+        return bitmap
+
+    @classmethod
+    def union(cls, bitmaps):
+        chunks = {}
+        for bitmap in bitmaps:
+            for key, c in bitmap.chunks.items():
+                existing = chunks.get(key)
+                chunks[key] = c if existing is None else _or(existing, c)
+        return cls.fromchunks(chunks)
+
+    @classmethod
+    def intersection(cls, bitmaps):
+        bitmaps = sorted(bitmaps, key=lambda bitmap: len(bitmap.chunks))
+        if not bitmaps:
+            return cls()
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            if not result:
+                break
+            result = result & bitmap
+        return result
+
+    def __len__(self):
+        return sum(_count(c) for c in self.chunks.values())
+
+    def __nonzero__(self):
+        return bool(self.chunks)
+
+    def __iter__(self):
+        for key in sorted(self.chunks):
+            c = self.chunks[key]
+            if not isinstance(c, array):
+                c = _to_members(c)
+            base = key << CHUNK_BITS
+            for low in c:
+                yield base + low
+
+    def __contains__(self, docid):
+        c = self.chunks.get(docid >> CHUNK_BITS)
+        return c is not None and _has(c, docid & LOW_MASK)
+
+    def __and__(self, other):
+        chunks = {}
+        if len(self.chunks) > len(other.chunks):
+            self, other = other, self
+        for key, c in self.chunks.items():
+            if key in other.chunks:
+                c = _and(c, other.chunks[key])
+                if c is not None:
+                    chunks[key] = c
+        return self.fromchunks(chunks)
+
+    def __or__(self, other):
+        return self.union((self, other))
+
+    def __sub__(self, other):
+        chunks = {}
+        for key, c in self.chunks.items():
+            if key in other.chunks:
+                c = _sub(c, other.chunks[key])
+            if c is not None:
+                chunks[key] = c
+        return self.fromchunks(chunks)
+
+    def __repr__(self):
+        return '<%s: %s members in %s chunks>' % (
+            self.__class__.__name__,
+            len(self),
+            len(self.chunks),
+            )
+
+
+class BitmapChunk(Persistent):
+    """Persistent record holding the container of one chunk"""
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _data(stored):
+    """Container of a chunk as stored by BitmapPostings"""
+    return stored if isinstance(stored, array) else stored.data
+
+
+class BitmapPostings(Persistent):
+    """
+    Persistent compressed docid set, with the subset of the TreeSet
+    API used by field and keyword indexes for postings.
+
+    Chunks of at most INLINE_MAX members are stored inline, as values
+    of the chunk BTree, and larger chunks as separate BitmapChunk
+    records; changes to members of a large chunk only write that chunk
+    (and a length counter).
+
+    Docids from new_docid() are sequential runs starting at random
+    points of the 64-bit space, not dense ids: members from many runs
+    fall in many sparse chunks (down to one member each), stored much
+    like a TreeSet, and only members of one run share a chunk.  We do
+    not remap docids to dense ids, as every lookup and every result
+    would then go through a persistent mapping; compression pays off
+    for values shared by many records added in runs.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self, docids=()):
+        self._chunks = self.family.IO.BTree()  # chunk key -> BitmapChunk
+        self._length = Length()
+        bitmap = Bitmap(docids)
+        for key, data in bitmap.chunks.items():
+            self._store(key, data)
+        self._length.change(len(bitmap))
+
+    def _store(self, key, data, stored=None):
+        """Store container data of chunk key, replacing stored, if any"""
+        if data is None:
+            del self._chunks[key]
+        elif isinstance(stored, BitmapChunk):
+            stored.data = data  # stays a record, once grown
+        elif isinstance(data, array) and len(data) <= INLINE_MAX:
+            self._chunks[key] = data
+        else:
+            self._chunks[key] = BitmapChunk(data)
+
+    def bitmap(self):
+        """Return in-memory Bitmap of members"""
+        return Bitmap.fromchunks(
+            dict((key, _data(stored)) for key, stored in self._chunks.items())
+            )
+
+    def insert(self, docid):
+        key, low = docid >> CHUNK_BITS, docid & LOW_MASK
+        stored = self._chunks.get(key)
+        if stored is None:
+            self._store(key, array('H', [low]))
+        elif _has(_data(stored), low):
+            return 0
+        else:
+            self._store(key, _add(_data(stored), low), stored)
+        self._length.change(1)
+        return 1
+
+    add = insert
+
+    def remove(self, docid):
+        key, low = docid >> CHUNK_BITS, docid & LOW_MASK
+        stored = self._chunks.get(key)
+        if stored is None or not _has(_data(stored), low):
+            raise KeyError(docid)
+        self._store(key, _discard(_data(stored), low), stored)
+        self._length.change(-1)
+
+    def __contains__(self, docid):
+        stored = self._chunks.get(docid >> CHUNK_BITS)
+        return stored is not None and _has(_data(stored), docid & LOW_MASK)
+
+    def __len__(self):
+        return self._length()
+
+    def __nonzero__(self):
+        return bool(self._length())
+
+    def __iter__(self):
+        return iter(self.bitmap())
+
+    def keys(self):
+        return list(self)
+
+    def walk(self, after=None, reverse=False):
+        """
+        Generate members in order (descending, if reverse), only those
+        beyond (after, or before if reverse) docid after, if not None;
+        chunks are loaded one at a time, as members are consumed.
+        """
+        chunks = self._chunks
+        start = None if after is None else after >> CHUNK_BITS
+        if reverse:
+            key = chunks.maxKey() if chunks else None
+            if start is not None:
+                key = start if start in chunks else key_before(chunks, start)
+        else:
+            keys = iter(chunks.keys(min=start))
+            key = next(keys, None)
+        while key is not None:
+            members = _data(chunks[key])
+            if not isinstance(members, array):
+                members = _to_members(members)
+            base = key << CHUNK_BITS
+            if reverse:
+                end = len(members)
+                if key == start:
+                    end = bisect_left(members, after & LOW_MASK)
+                for i in xrange(end - 1, -1, -1):
+                    yield base + members[i]
+                key = key_before(chunks, key)
+            else:
+                begin = 0
+                if key == start:
+                    begin = bisect_right(members, after & LOW_MASK)
+                for i in xrange(begin, len(members)):
+                    yield base + members[i]
+                key = next(keys, None)
@@ -1,26 +1,50 @@
+import copy
 import datetime
 import time
 
 from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from plone.uuid.interfaces import IUUID
 from repoze.catalog import query
+from repoze.catalog.query import Name
 from zope.dottedname.resolve import resolve
 from zope.interface import implements
-from zope.schema.interfaces import ICollection
+from zope.schema.interfaces import ICollection, IDatetime
 
-from uu.retrieval.interfaces import ISimpleCatalog
+from uu.retrieval import consistency, export, paging, statistics, warmup
+from uu.retrieval.interfaces import IPreparedQuery
+from uu.retrieval.interfaces import ISearchResult, ISimpleCatalog
 from uu.retrieval.indexing import Indexer, UUIDMapper
 from uu.retrieval.indexing import FieldIndex, KeywordIndex, TextIndex
+from uu.retrieval.indexing import make_lexicon, merge_lexicons
+from uu.retrieval.indexing.composite import CompositeIndex
+from uu.retrieval.indexing.dates import DateIndex, DATE, DATETIME
+from uu.retrieval.indexing.dates import convert_date_index
+from uu.retrieval.indexing.postings import BitmapFieldIndex
+from uu.retrieval.indexing.postings import BitmapKeywordIndex
+from uu.retrieval.indexing.postings import convert_index, BITMAP, TREESET
+from uu.retrieval.querying import IsEmpty, NotEmpty, route_composites
+from uu.retrieval.querying import SubqueryCache, evaluate, evaluate_within
+from uu.retrieval.querying import ClauseCache, distinct_values, parse_text
 from uu.retrieval.resolver import ContentContainerUIDResolver
+from uu.retrieval.saved import SavedQuery
 from uu.retrieval.schema.interfaces import ISchemaIndexes
 from uu.retrieval.utils import identify_interface, normalize_uuid
 from uu.retrieval.result import SearchResult
+from uu.retrieval.warmup import HOT_LIMIT
 
 
 IDXCLS = {
     'field': FieldIndex,
     'text': TextIndex,
     'keyword': KeywordIndex,
+    'date': DateIndex,
+}
+
+# index classes by postings format, for index types supporting formats:
+POSTINGS_IDXCLS = {
+    TREESET: {'field': FieldIndex, 'keyword': KeywordIndex},
+    BITMAP: {'field': BitmapFieldIndex, 'keyword': BitmapKeywordIndex},
 }
 
 
@@ -33,25 +57,196 @@ def _indexer_value(v, fieldtype=None):
         return int(time.mktime(v.timetuple()))  # timetuple has 1s resolution
     if isinstance(v, datetime.date):
         return v.toordinal()
-    if v is None and ICollection.implementedBy(fieldtype):
-        # default value is empty list/set/tuple/dict respective to fieldtype
-        return fieldtype._type()  # _type is non-tuple type for collections
-    elif v is None:
-        # avoid range query side effects of None key for index btrees
-        return float('inf')  # sentinel value
     return v
 
 
 def query_value(v):
+    if isinstance(v, tuple):
+        return tuple(_indexer_value(e) for e in v)  # composite index value
     return _indexer_value(v)
 
 
+# comparators for a None (missing) value, and their replacements:
+EMPTY_COMPARATORS = {
+    query.Eq: IsEmpty,
+    query.NotEq: NotEmpty,
+}
+
+
 def normalize_query(q):
+    """
+    Return a copy of query q with values normalized recursively; q
+    itself is not modified.  Comparison of an index to None is
+    replaced by an IsEmpty/NotEmpty query.
+    """
+    if type(q) in EMPTY_COMPARATORS and q._value is None:
+        return EMPTY_COMPARATORS[type(q)](q.index_name)
+    q = copy.copy(q)
     if isinstance(q, query.BoolOp):
-        for subq in q.queries:
-            normalize_query(subq)
+        q.queries = [normalize_query(subq) for subq in q.queries]
+    elif isinstance(q, query.Not):
+        q.query = normalize_query(q.query)
+    elif isinstance(q, query._Range):
+        q._start, q._end = query_value(q._start), query_value(q._end)
     else:
         q._value = query_value(q._value)
+    return q
+
+
+def query_from_mapping(qdict):
+    """
+    Return a query.Query object given mapping of index names to
+    values, or to (comparator class, value) pairs.
+    """
+    r = []
+    for idxname, value in qdict.items():
+        if isinstance(value, tuple) and len(value) > 1:
+            comparator = value[0]
+            if isinstance(comparator, type) and \
+                    issubclass(comparator, query.Query):
+                r.append(comparator(idxname, value[1]))
+                continue
+        if idxname.startswith('text'):
+            r.append(query.Contains(idxname, value))
+        elif idxname.startswith('keyword'):
+            r.append(query.Any(idxname, value))
+        else:
+            r.append(query.Eq(idxname, value))
+    if len(r) == 1:
+        return r[0]
+    return query.And(*r)
+
+
+# reserved keyword arguments of query(), passed to Indexer.query():
+QUERY_OPTIONS = ('sort_index', 'limit', 'reverse')
+
+
+def query_options(kwargs):
+    """Pop query option keyword arguments from kwargs, return as dict"""
+    return dict((k, kwargs.pop(k)) for k in QUERY_OPTIONS if k in kwargs)
+
+
+def make_query(args, kwargs, composites=()):
+    """
+    Given positional and keyword arguments of ISimpleCatalog.query()
+    (a mapping, query object or query expression string), return a
+    query object, normalized, and with Eq clauses routed to any
+    matching composite indexes.
+    """
+    qdict = None
+    if not args and kwargs:
+        qdict = kwargs
+    elif args and hasattr(args[0], 'iteritems'):
+        ## looks like mapping/dict
+        qdict = dict(args[0].items())
+    elif not args:
+        raise ValueError('Empty query')
+    elif isinstance(args[0], basestring):
+        _query = parse_text(args[0])  # CQE string
+    else:
+        _query = args[0]
+        if not isinstance(_query, query.Query):
+            raise ValueError('Invalid query')
+    if qdict:
+        _query = query_from_mapping(qdict)
+    _query = normalize_query(_query)  # normalized copy
+    return route_composites(_query, composites)
+
+
+def _value_params(value):
+    if isinstance(value, Name):
+        return set([value.name])
+    if isinstance(value, (list, tuple)):
+        return set().union(*[_value_params(v) for v in value])
+    return set()
+
+
+def _bind_value(value, params):
+    if isinstance(value, Name):
+        if value.name not in params:
+            raise NameError('No value passed in for name: %s' % value.name)
+        return params[value.name]
+    if isinstance(value, list):
+        return [_bind_value(v, params) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_bind_value(v, params) for v in value)
+    return value
+
+
+class PreparedQuery(object):
+    """
+    Compiled query template for a SimpleCatalog, with parameters as
+    repoze.catalog.query.Name placeholders.  The template is normalized,
+    checked against indexes, and routed to composite indexes once; each
+    execution binds parameter values into copies of only the nodes
+    holding parameters, so the template is never modified.  Bound
+    queries have plain values, so their clauses use the clause cache.
+    """
+
+    implements(IPreparedQuery)
+
+    def __init__(self, catalog, template, **options):
+        self.catalog = catalog
+        self.options = query_options(options)
+        if options:
+            raise TypeError('unknown options: %s' % ', '.join(options))
+        self.query = make_query((template,), {}, catalog.composites())
+        self._parametric = {}  # id of node -> parameter names under node
+        self.params = frozenset(self._compile(self.query))
+
+    def _compile(self, q):
+        if isinstance(q, query.BoolOp):
+            names = set().union(*[self._compile(sub) for sub in q.queries])
+        elif isinstance(q, query.Not):
+            names = self._compile(q.query)
+        else:
+            if q.index_name not in self.catalog.indexer:
+                raise KeyError('unknown index: %s' % q.index_name)
+            if isinstance(q, query._Range):
+                names = _value_params([q._start, q._end])
+            else:
+                names = _value_params(q._value)
+        if names:
+            self._parametric[id(q)] = names
+        return names
+
+    def _bind(self, q, params):
+        if id(q) not in self._parametric:
+            return q  # shared, never modified
+        if isinstance(q, query.BoolOp):
+            q = copy.copy(q)
+            q.queries = [self._bind(sub, params) for sub in q.queries]
+            return q
+        if isinstance(q, query.Not):
+            q = copy.copy(q)
+            q.query = self._bind(q.query, params)
+            return q
+        if isinstance(q, query._Range):
+            q = copy.copy(q)
+            q._start = query_value(_bind_value(q._start, params))
+            q._end = query_value(_bind_value(q._end, params))
+            return q
+        value = query_value(_bind_value(q._value, params))
+        if value is None and type(q) in EMPTY_COMPARATORS:
+            return EMPTY_COMPARATORS[type(q)](q.index_name)
+        q = copy.copy(q)
+        q._value = value
+        return q
+
+    def bind(self, **params):
+        """Query with parameter values bound (template if none)"""
+        return self._bind(self.query, params)
+
+    def _execute(self, params):
+        options = dict(self.options)
+        options.update(query_options(params))
+        return self.catalog.indexer.query(self.bind(**params), **options)
+
+    def __call__(self, **params):
+        return self.catalog._make_result(self._execute(params))
+
+    def rcount(self, **params):
+        return self._execute(params)[0]
 
 
 class ValueDiscriminator(Persistent):
@@ -62,8 +257,10 @@ class ValueDiscriminator(Persistent):
     
     def __call__(self, obj, default):
         v = getattr(obj, self.fieldname, default)
-        if v is default:
-            return default
+        if v is default or v is None:
+            return default  # missing value, tracked as such by index
+        if not v and ICollection.implementedBy(self.fieldtype):
+            return default  # empty collection is a missing value
         return _indexer_value(v, self.fieldtype)
 
 
@@ -77,8 +274,16 @@ class SimpleCatalog(Persistent):
     """
     
     implements(ISimpleCatalog)
-    
-    def __init__(self, context, schema=None):
+
+    lexicon = None  # default for catalogs without a shared lexicon
+    postings = None  # index name to postings format, if not default
+    saved_queries = None  # name to SavedQuery, if any registered
+    parse_cache_size = 256  # entries in (volatile) cache of parsed text
+    warmup_indexes = None  # names of indexes to warm up, None for all
+    warmup_values = False  # warm up postings (bucket values) too?
+    hot_oids = ()  # recorded by record_hot(), loaded by warmup()
+    
+    def __init__(self, context, schema=None, shared_lexicon=True):
         self._context_uid = IUUID(context)
         if schema is None:
             schema = getattr(context, 'schema', None)
@@ -86,6 +291,8 @@ class SimpleCatalog(Persistent):
                 raise ValueError('Context does not provide schema')
         self.indexer = Indexer()
         self.uidmap = UUIDMapper()
+        if shared_lexicon:
+            self.lexicon = make_lexicon()
         self.bind(schema)
     
     ## ILocation implementation:
@@ -134,14 +341,138 @@ class SimpleCatalog(Persistent):
             ## discriminator that is anonymous (not importable) that
             ## works around limitations in ZODB/pickle.
             discriminator = fieldname
-            if idx_type != 'text':
-                discriminator = ValueDiscriminator(field)
-            self.indexer[name] = IDXCLS.get(idx_type)(discriminator)
-    
+            if idx_type == 'text':
+                # text indexes use shared lexicon, if catalog has one:
+                self.indexer[name] = TextIndex(discriminator, self.lexicon)
+                continue
+            discriminator = ValueDiscriminator(field)
+            if idx_type == 'date':
+                kind = DATETIME if IDatetime.providedBy(field) else DATE
+                self.indexer[name] = DateIndex(discriminator, kind)
+                continue
+            cls = IDXCLS.get(idx_type)
+            if self.postings and name in self.postings:
+                cls = POSTINGS_IDXCLS[self.postings[name]][idx_type]
+            self.indexer[name] = cls(discriminator)
+    
+    def share_lexicon(self):
+        if self.lexicon is None:
+            self.lexicon = make_lexicon()
+        text_indexes = [
+            idx for idx in self.indexer.values() if isinstance(idx, TextIndex)
+            ]
+        merge_lexicons(text_indexes, self.lexicon)
+
+    def set_postings(self, name, format=BITMAP):
+        if format not in POSTINGS_IDXCLS:
+            raise ValueError('unknown postings format: %s' % format)
+        idx_type = name.split('_')[0]
+        cls = POSTINGS_IDXCLS[format].get(idx_type)
+        if cls is None:
+            raise ValueError('index %s does not support postings formats' % (
+                name,))
+        idx = self.indexer[name]
+        if self.postings is None:
+            self.postings = PersistentMapping()
+        if format == TREESET:
+            self.postings.pop(name, None)
+        else:
+            self.postings[name] = format
+        if type(idx) is not cls:
+            self.indexer[name] = convert_index(idx, cls)
+
+    def migrate_missing(self):
+        migrated = []
+        for name, idx in sorted(self.indexer.items()):
+            if isinstance(idx, FieldIndex) and idx.migrate_missing():
+                migrated.append(name)
+        return migrated
+
+    def migrate_date_indexes(self):
+        migrated = []
+        for name in self.indexes():
+            if not name.startswith('date_') or name in self.indexer:
+                continue
+            fieldname = name[len('date_'):]
+            legacy = 'field_%s' % fieldname
+            if legacy not in self.indexer:
+                continue
+            field = self.search_schema[fieldname]
+            kind = DATETIME if IDatetime.providedBy(field) else DATE
+            self.indexer[name] = convert_date_index(self.indexer[legacy], kind)
+            del self.indexer[legacy]
+            if self.postings:
+                self.postings.pop(legacy, None)
+            for idx in self.indexer.values():
+                if isinstance(idx, CompositeIndex) and \
+                        legacy in idx.components:
+                    idx.components = tuple(
+                        name if component == legacy else component
+                        for component in idx.components
+                        )
+            migrated.append(name)
+        return migrated
+
+    def add_composite(self, names, name=None):
+        names = tuple(names)
+        if len(names) < 2:
+            raise ValueError('composite index needs two or more components')
+        components = []
+        for idxname in names:
+            idx = self.indexer.get(idxname)
+            if not isinstance(idx, FieldIndex) or \
+                    isinstance(idx, CompositeIndex):
+                raise ValueError(
+                    'composite component %s is not a field index' % idxname)
+            components.append(idx)
+        if name is None:
+            fieldnames = [idxname.split('_', 1)[1] for idxname in names]
+            name = 'composite_%s' % '__'.join(fieldnames)
+        if name in self.indexer:
+            raise KeyError('index name already in use: %s' % name)
+        idx = CompositeIndex(
+            names,
+            [component.discriminator for component in components],
+            )
+        idx.build(components, self.uidmap.docid_to_uuid.keys())
+        self.indexer[name] = idx
+        return name
+
+    def composites(self):
+        return tuple(
+            (name, idx.components) for name, idx in self.indexer.items()
+            if isinstance(idx, CompositeIndex)
+            )
+    
+    def save_query(self, name, *args, **kwargs):
+        saved = SavedQuery(
+            name,
+            make_query(args, kwargs, self.composites()),
+            )
+        saved.rebuild(self)
+        if self.saved_queries is None:
+            self.saved_queries = PersistentMapping()
+        self.saved_queries[name] = saved
+        return saved
+
+    def remove_saved_query(self, name):
+        if not self.saved_queries or name not in self.saved_queries:
+            raise KeyError(name)
+        del self.saved_queries[name]
+
+    def saved_query(self, name):
+        docids = self.saved_queries[name].docids
+        return self._make_result((len(docids), docids))
+
+    def _update_saved(self, docid, uid):
+        for saved in (self.saved_queries or {}).values():
+            saved.update(self, docid, uid)
+
     def index(self, obj):
         uid = IUUID(obj)
         uid, docid = self.uidmap.add(uid)
         self.indexer.index_doc(docid, obj)
+        self._update_saved(docid, uid)
     
     def unindex(self, obj):
         if isinstance(obj, str):
@@ -151,9 +482,25 @@ class SimpleCatalog(Persistent):
         if uid not in self.uidmap:
             raise KeyError(uid)
         docid = self.uidmap.docid_for(uid)
+        for saved in (self.saved_queries or {}).values():
+            saved.remove(self, docid, uid)
         self.indexer.unindex_doc(docid)
         self.uidmap.remove(uid)
     
+    def unindex_many(self, objs):
+        uids = [obj if isinstance(obj, str) else IUUID(obj) for obj in objs]
+        pairs = self.uidmap.remove_many(uids)  # KeyError if any missing
+        for uid, docid in pairs:
+            for saved in (self.saved_queries or {}).values():
+                saved.remove(self, docid, uid)
+        self.indexer.unindex_docs([docid for uid, docid in pairs])
+        return len(pairs)
+
+    def unindex_query(self, *args, **kwargs):
+        _query = self._make_query(args, kwargs)
+        docids = self.indexer.query(_query)[1]
+        return self.unindex_many(self.uidmap.uuids_for(list(docids)))
+
     def reindex(self, obj=None):
         if obj is None:
             for uid, docid in self.uidmap.iteritems():
@@ -168,7 +515,8 @@ class SimpleCatalog(Persistent):
             else:
                 uid = IUUID(obj)
             docid = self.uidmap.docid_for(uid)
-            self.indexer.redindex_doc(docid, obj)
+            self.indexer.reindex_doc(docid, obj)
+            self._update_saved(docid, uid)
    
     ## ISearchContext base mapping methods:
     
@@ -235,23 +583,35 @@ class SimpleCatalog(Persistent):
         Value normalization is not in scope (should happen to
         resulting query).
         """
-        r = []
-        for idxname, value in qdict.items():
-            if isinstance(value, tuple) and len(value) > 1:
-                if issubclass(value[0], query.Query):
-                    comparator = value[0]
-                    r.append(comparator(idxname, value[1]))
-                    continue
-            if idxname.startswith('text'):
-                r.append(query.Contains(idxname, value))
-            elif idxname.startswith('keyword'):
-                r.append(query.Any(idxname, value))
-            else:
-                r.append(query.Eq(idxname, value))
-        if len(r) == 1:
-            return r[0]
-        return query.And(*r)
-    
+        return query_from_mapping(qdict)
+    
+    def parse_cache(self):
+        """Per-connection cache of parsed query text, made as needed"""
+        cache = getattr(self, '_v_parse_cache', None)
+        if cache is None:
+            cache = self._v_parse_cache = ClauseCache(self.parse_cache_size)
+        return cache
+
+    def parse(self, text, safe=False):
+        # entries are valid while the schema and indexes are unchanged:
+        generation = (self._schema, tuple(self.indexer.keys()))
+        cache = self.parse_cache()
+        key = (text, bool(safe))
+        _query = cache.get(key, generation)
+        if _query is None:
+            _query = parse_text(text, self.indexer, safe)
+            _query = route_composites(
+                normalize_query(_query),
+                self.composites(),
+                )
+            cache.set(key, generation, _query)
+        return _query
+
+    def _make_query(self, args, kwargs, safe=False):
+        if args and isinstance(args[0], basestring):
+            return self.parse(args[0], safe)  # shared, cached query
+        return make_query(args, kwargs, self.composites())
+
     def _make_result(self, result):
         """
         Given a result as tuple of length, integer docids,
@@ -266,25 +626,55 @@ class SimpleCatalog(Persistent):
         result.__name__ = 'result'
         return result
     
+    def compile(self, template, **options):
+        return PreparedQuery(self, template, **options)
+
     def query(self, *args, **kwargs):
-        qdict = None
-        if not args and kwargs:
-            qdict = kwargs
-        elif args and hasattr(args[0], 'iteritems'):
-            ## looks like mapping/dict
-            qdict = dict(args[0].items())
-        elif not args:
-            raise ValueError('Empty query')
+        count_only = kwargs.pop('return_query_result_count', False)
+        paged = 'cursor' in kwargs
+        cursor = kwargs.pop('cursor', None)
+        within = kwargs.pop('within', None)
+        safe = kwargs.pop('safe', False)
+        options = query_options(kwargs)
+        _query = self._make_query(args, kwargs, safe)
+        if paged and not count_only:
+            return self._page(_query, cursor, within, **options)
+        if within is not None:
+            result = self.indexer.sort_result(
+                self._within(_query, within),
+                **options
+                )
         else:
-            _query = args[0]
-            if not isinstance(_query, query.Query):
-                raise ValueError('Invalid query')
-        if qdict:
-            _query = self._query_from_mapping(qdict)
-        if kwargs.get('return_query_result_count', False):
-            return self.indexer.query(_query)[0]
-        normalize_query(_query)  # normalize values recursively in-place
-        return self._make_result(self.indexer.query(_query))
+            result = self.indexer.query(_query, **options)
+        if count_only:
+            return result[0]
+        return self._make_result(result)
+
+    def _within(self, _query, within):
+        """Evaluate query restricted to search result or docids"""
+        if ISearchResult.providedBy(within):
+            within = within.record_ids(ordered=True)
+        within = self.indexer.family.IF.Set(within)
+        return evaluate_within(_query, self.indexer, within)
+
+    def _page(self, _query, cursor, within=None, sort_index=None,
+              limit=None, reverse=False):
+        if not (sort_index and limit):
+            raise ValueError('cursor pagination needs sort_index and limit')
+        if within is not None:
+            docids = self._within(_query, within)
+        else:
+            docids = self.indexer.query(_query)[1]  # unsorted
+        docids, next_cursor = paging.page(
+            self.indexer[sort_index],
+            docids,
+            limit,
+            reverse,
+            cursor,
+            )
+        result = self._make_result((len(docids), docids))
+        result.cursor = next_cursor
+        return result
     
     def rcount(self, *args, **kwargs):
         kwargs['return_query_result_count'] = True
@@ -292,3 +682,94 @@ class SimpleCatalog(Persistent):
     
     __call__ = query
 
+    def _query_many(self, queries, cache):
+        if cache is None:
+            cache = SubqueryCache()
+        for spec in queries:
+            options = {}
+            if hasattr(spec, 'iteritems'):
+                spec = dict(spec.items())
+                options = query_options(spec)
+            _query = self._make_query((spec,), {})
+            docids = evaluate(_query, self.indexer, None, cache)
+            yield self.indexer.sort_result(docids, **options)
+
+    def query_many(self, queries, cache=None):
+        return [
+            self._make_result(result)
+            for result in self._query_many(queries, cache)
+            ]
+
+    def rcount_many(self, queries, cache=None):
+        return [result[0] for result in self._query_many(queries, cache)]
+
+    def distinct(self, index_name, query=None, with_counts=False,
+                 prefix=None, limit=None, start=None, end=None):
+        idx = self.indexer[index_name]
+        if not isinstance(idx, (FieldIndex, KeywordIndex)):
+            raise ValueError(
+                'index %s is not a field or keyword index' % index_name)
+        docids = None
+        if query is not None:
+            _query = self._make_query((query,), {})
+            docids = self.indexer.query(_query)[1]
+        if start is not None:
+            start = query_value(start)
+        if end is not None:
+            end = query_value(end)
+        return distinct_values(
+            idx,
+            docids,
+            with_counts,
+            prefix,
+            limit,
+            start,
+            end,
+            )
+
+    ## export:
+
+    def _export_docids(self, result):
+        if result is None:
+            return self.uidmap.docid_to_uuid.keys()  # lazy, all records
+        return result.record_ids(ordered=True)
+
+    def export_rows(self, result=None, columns=None):
+        return export.iter_rows(self, self._export_docids(result), columns)
+
+    def export(self, stream, result=None, columns=None, format='csv'):
+        return export.export(
+            self,
+            stream,
+            self._export_docids(result),
+            columns,
+            format,
+            )
+
+    ## consistency:
+
+    def check_consistency(self, resolve=True):
+        return consistency.check(self, resolve)
+
+    def repair(self, report=None):
+        if report is None:
+            report = self.check_consistency()
+        return consistency.repair(self, report)
+
+    ## statistics:
+
+    def stats(self, names=None, sample=None):
+        return statistics.catalog_stats(self, names, sample)
+
+    ## cache warm-up:
+
+    def warmup(self, names=None, values=None, limit=None):
+        if names is None:
+            names = self.warmup_indexes
+        if values is None:
+            values = self.warmup_values
+        return warmup.warm(self, names, values, limit)
+
+    def record_hot(self, limit=HOT_LIMIT):
+        return warmup.record_hot(self, limit)
+
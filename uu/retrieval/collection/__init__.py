@@ -1,2 +1,4 @@
 from base import BaseCollection  # noqa
 from base import BaseNamedCollection  # noqa
+from base import CollectionView  # noqa
+from base import NamedCollectionView  # noqa
@@ -6,6 +6,19 @@ from interfaces import IUIDItemCollection, INamedItemCollection
 from interfaces import ICollectionSetOperations
 
 
+# set operations of collection views:
+INTERSECTION = 'intersection'
+UNION = 'union'
+DIFFERENCE = 'difference'
+
+# merge of name->uid mappings of operands, for each set operation:
+_NAMEMAP_MERGE = {
+    INTERSECTION: lambda a, b: dict(set(a.items()) & set(b.items())),
+    UNION: lambda a, b: dict(set(a.items()) | set(b.items())),
+    DIFFERENCE: lambda a, b: dict(set(a.items()) - set(b.items())),
+    }
+
+
 class BaseCollection(object):
     """
     Base UID-keyed collection, may be used standalone or as superclass for
@@ -52,9 +65,22 @@ class BaseCollection(object):
                     self._uid_to_names[uid] = []
                 self._uid_to_names[uid].append(name)
 
+    def __getattr__(self, name):
+        if name == '_uidset':
+            # set of UIDs, for membership tests, built once on first use:
+            self._uidset = frozenset(self._uids)
+            return self._uidset
+        raise AttributeError(name)
+
+    def _iteruids(self):
+        return iter(self._uids)
+
+    def _has(self, uid):
+        return uid in self._uidset
+
     def get(self, name, default=None):
         name = str(name)  # in case of uuid.UUID
-        if name not in self._uids:
+        if not self._has(name):
             return default
         return self._items.get(name, default)
 
@@ -65,7 +91,7 @@ class BaseCollection(object):
         return v
 
     def __contains__(self, name):
-        return str(name) in self._uids
+        return self._has(str(name))
 
     def keys(self):
         return self._uids
@@ -77,7 +103,7 @@ class BaseCollection(object):
         return list(self.iteritems())
 
     def iterkeys(self):
-        return self._uids.__iter__()
+        return self._iteruids()
 
     def itervalues(self):
         return itertools.imap(lambda k: self.get(k), self.iterkeys())
@@ -122,16 +148,8 @@ class BaseCollection(object):
         return None
 
     def intersection(self, other):
-        # set.intersection() does correct order, by order of self.
-        common_uids = list(set(self._uids).intersection(other._uids))
-        rv = object.__new__(self.__class__)
-        rv._uids = common_uids  # preserves order of self.keys() if applicable
-        rv._items = dict((uid, self.get(uid)) for uid in common_uids)
-        # optional name mapping
-        _mergednames = lambda a, b: dict(set(a.items()) & set(b.items()))
-        namemap = self._new_namemap(other, _mergednames)
-        rv._init_namemap(namemap)
-        return rv
+        """Common members, ordered by self.keys()"""
+        return self._view_class(INTERSECTION, self, other)
 
     __and__ = intersection
 
@@ -140,34 +158,14 @@ class BaseCollection(object):
         Returns de-duped concatenation as a specialized type of
         union.
         """
-        common_uids = set(self._uids).intersection(other._uids)
-        head = self._uids
-        tail = [k for k in other._uids if k not in common_uids]
-        rv = object.__new__(self.__class__)
-        rv._uids = head + tail  # note: full (not lazy) concatentation
-        items = [(uid, self.get(uid)) for uid in common_uids]  # head
-        items += other._items.items()  # tail
-        rv._items = dict(items)
-        # optional name mapping
-        _mergednames = lambda a, b: dict(set(a.items()) | set(b.items()))
-        namemap = self._new_namemap(other, _mergednames)
-        rv._init_namemap(namemap)
-        return rv
+        return self._view_class(UNION, self, other)
 
     __or__ = union
     __add__ = union  # a concatentation, with de-duping, seems reasonable
 
     def difference(self, other):
         """Relative complement, order remaining members by self.keys()"""
-        common_uids = set(self._uids).intersection(other._uids)
-        rv = object.__new__(self.__class__)
-        rv._uids = [k for k in self._uids if k not in common_uids]
-        rv._items = dict([(uid, self.get(uid)) for uid in rv._uids])
-        # optional name mapping
-        _mergednames = lambda a, b: dict(set(a.items()) - set(b.items()))
-        namemap = self._new_namemap(other, _mergednames)
-        rv._init_namemap(namemap)
-        return rv
+        return self._view_class(DIFFERENCE, self, other)
 
     __sub__ = difference
 
@@ -207,7 +205,7 @@ class BaseNamedCollection(BaseCollection):
         # internally translate each UID to name, lazily
         return itertools.imap(
             lambda k: self.name_for(k),
-            self._uids.__iter__(),
+            self._iteruids(),
             )
 
     def keys(self):
@@ -215,8 +213,83 @@ class BaseNamedCollection(BaseCollection):
 
     def byuid(self):
         ordered_items = [(k, self._items.get(k)) for k in self._uids]
-        return BaseCollection(ordered_items, self._namemap)
+        return BaseCollection(ordered_items, self._name_to_uid)
 
     def byname(self):
         return self
 
+
+class _ViewItems(object):
+    """UID to item lookup of a collection view, from its operands"""
+
+    def __init__(self, view):
+        self.view = view
+
+    def get(self, uid, default=None):
+        view = self.view
+        source = view._left
+        if view._op == UNION and not source._has(uid):
+            source = view._right
+        return source._items.get(uid, default)
+
+    def items(self):
+        return [(uid, self.get(uid)) for uid in self.view._iteruids()]
+
+
+class CollectionView(BaseCollection):
+    """
+    Lazy result of a set operation on two collections (operands), which
+    may themselves be views.  Keys, membership and items are computed
+    from the operands as needed; the key list, set of keys, and name
+    mappings of a view are each built at most once, on first use, so
+    chained set operations do not copy intermediate results.
+    """
+
+    def __init__(self, op, left, right):
+        self._op = op
+        self._left = left
+        self._right = right
+        self._items = _ViewItems(self)
+
+    def __getattr__(self, name):
+        if name == '_uids':
+            self._uids = list(self._iteruids())
+            return self._uids
+        if name in ('_name_to_uid', '_uid_to_names'):
+            merge = _NAMEMAP_MERGE[self._op]
+            self._init_namemap(self._left._new_namemap(self._right, merge))
+            return self.__dict__[name]
+        return super(CollectionView, self).__getattr__(name)
+
+    def _iteruids(self):
+        if '_uids' in self.__dict__:
+            return iter(self._uids)
+        left, right = self._left, self._right
+        if self._op == UNION:
+            return itertools.chain(
+                left._iteruids(),
+                (k for k in right._iteruids() if not left._has(k)),
+                )
+        if self._op == INTERSECTION:
+            return (k for k in left._iteruids() if right._has(k))
+        return (k for k in left._iteruids() if not right._has(k))
+
+    def _has(self, uid):
+        if '_uids' in self.__dict__:
+            return uid in self._uidset
+        left, right = self._left, self._right
+        if self._op == UNION:
+            return left._has(uid) or right._has(uid)
+        if self._op == INTERSECTION:
+            return left._has(uid) and right._has(uid)
+        return left._has(uid) and not right._has(uid)
+
+
+class NamedCollectionView(CollectionView, BaseNamedCollection):
+    """Lazy collection view of named collections, keyed by name"""
+
+    implementsOnly(INamedItemCollection, ICollectionSetOperations)
+
+
+BaseCollection._view_class = CollectionView
+BaseNamedCollection._view_class = NamedCollectionView
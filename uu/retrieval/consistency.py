@@ -0,0 +1,247 @@
+"""
+Consistency check (and repair) of the UUID map and indexes of a
+SimpleCatalog.
+
+check() walks the docid -> uid map of the catalog in docid order once,
+in step with a sorted docid stream (indexed and not indexed docids) of
+each index, so no set of all docids is built; each mapped uid is
+looked up in the uid -> docid map, and optionally resolved (in batches)
+to find stale entries.  The uid -> docid map is walked separately only
+if its size does not match the count of consistent pairs.  Memory use
+is bounded by the batch size and the number of problems found.
+
+repair() fixes only the entries listed in a report, re-checking each
+before changing anything.
+"""
+
+import heapq
+
+from uu.retrieval.indexing import CatalogIndexBase, KeywordIndex
+
+
+BATCH_SIZE = 500
+
+# kinds of problems found, each reported as (kind, index name, docid, uid):
+DANGLING_DOCID = 'docid'  # docid -> uid, without matching uid -> docid
+DANGLING_UID = 'uid'  # uid -> docid, without matching docid -> uid
+ORPHAN = 'orphan'  # docid in an index, not mapped to any uid
+MISSING = 'missing'  # mapped docid neither indexed nor not-indexed
+STALE = 'stale'  # mapped uid not resolved to any object
+
+
+class ConsistencyReport(object):
+    """
+    Problems found by check(), a list of (kind, index name or None,
+    docid, uid) tuples in self.problems; length is the stored length
+    of the UUID map, pairs the count of consistent (uid, docid) pairs.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.pairs = 0
+        self.problems = []
+
+    def add(self, kind, name, docid, uid):
+        self.problems.append((kind, name, docid, uid))
+
+    @property
+    def ok(self):
+        return not self.problems and self.length == self.pairs
+
+    def __iter__(self):
+        return iter(self.problems)
+
+    def __len__(self):
+        return len(self.problems)
+
+    def summary(self):
+        """Count of problems by kind"""
+        counts = {}
+        for problem in self.problems:
+            counts[problem[0]] = counts.get(problem[0], 0) + 1
+        return counts
+
+
+class _IndexCursor(object):
+    """Walk docids of an index (indexed or not) in order, once"""
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        # absence from a keyword index may mean an empty sequence value:
+        self.ambiguous = isinstance(index, KeywordIndex)
+        self._docids = heapq.merge(index._indexed(), index._not_indexed)
+        self.current = None
+        self._advance()
+
+    def _advance(self):
+        previous = self.current
+        for docid in self._docids:
+            if docid != previous:
+                self.current = docid
+                return
+        self.current = None
+
+    def skip(self, docid=None):
+        """Generate docids before docid (or all remaining), skipping"""
+        while self.current is not None and (
+                docid is None or self.current < docid):
+            yield self.current
+            self._advance()
+
+    def take(self, docid):
+        """Is docid in index? Call in docid order, after skip(docid)"""
+        if self.current == docid:
+            self._advance()
+            return True
+        return False
+
+
+def _cursors(catalog):
+    return [
+        _IndexCursor(name, idx)
+        for name, idx in sorted(catalog.indexer.items())
+        if isinstance(idx, CatalogIndexBase)
+        ]
+
+
+def _resolve(catalog, report, batch):
+    """Resolve batch of (docid, uid, missing cursors), report problems"""
+    uids = [uid for docid, uid, missing in batch]
+    get_many = getattr(catalog.resolver, 'get_many', None)
+    if get_many is not None:
+        objects = get_many(uids)
+    else:
+        objects = [catalog.resolver(uid) for uid in uids]
+    for (docid, uid, missing), obj in zip(batch, objects):
+        if obj is None:
+            report.add(STALE, None, docid, uid)
+            continue
+        for cursor in missing:
+            if cursor.ambiguous and not cursor.index.discriminate(obj, None):
+                continue  # empty keywords, correctly not indexed
+            report.add(MISSING, cursor.name, docid, uid)
+    jar = getattr(catalog, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()  # let go of objects loaded for batch
+
+
+def check(catalog, resolve=True, batch_size=BATCH_SIZE):
+    """
+    Check UUID map, indexes and (if resolve) resolver of catalog for
+    consistency in one pass in docid order; returns ConsistencyReport.
+    Without resolve, absence of a docid from a keyword index is not
+    reported (it may have had an empty sequence value).
+    """
+    uidmap = catalog.uidmap
+    fwd, rev = uidmap.uuid_to_docid, uidmap.docid_to_uuid
+    report = ConsistencyReport(len(uidmap))
+    cursors = _cursors(catalog)
+    batch = []
+    for docid, uid in rev.items():
+        mapped = fwd.get(uid)
+        if mapped == docid:
+            report.pairs += 1
+        else:
+            report.add(DANGLING_DOCID, None, docid, uid)
+        missing = []
+        for cursor in cursors:
+            for orphan in cursor.skip(docid):
+                report.add(ORPHAN, cursor.name, orphan, None)
+            if not cursor.take(docid):
+                missing.append(cursor)
+        if mapped not in (docid, None):
+            missing = []  # uid has another docid, likely a duplicate
+        if not resolve:
+            for cursor in missing:
+                if not cursor.ambiguous:
+                    report.add(MISSING, cursor.name, docid, uid)
+            continue
+        batch.append((docid, uid, missing))
+        if len(batch) == batch_size:
+            _resolve(catalog, report, batch)
+            batch = []
+    if batch:
+        _resolve(catalog, report, batch)
+    for cursor in cursors:
+        for orphan in cursor.skip():
+            report.add(ORPHAN, cursor.name, orphan, None)
+    if len(fwd) != report.pairs:
+        restorable = set()
+        for uid, docid in fwd.items():
+            if rev.get(docid) != uid:
+                report.add(DANGLING_UID, None, docid, uid)
+                if docid not in rev:
+                    restorable.add(docid)
+        # indexed docids of uids missing only a docid -> uid entry are
+        # not orphans, once that entry is restored by repair():
+        report.problems = [
+            p for p in report.problems
+            if not (p[0] == ORPHAN and p[2] in restorable)
+            ]
+    return report
+
+
+def _repair_dangling_docid(catalog, docid, uid):
+    uidmap = catalog.uidmap
+    fwd, rev = uidmap.uuid_to_docid, uidmap.docid_to_uuid
+    if rev.get(docid) != uid or fwd.get(uid) == docid:
+        return False  # no longer broken
+    other = fwd.get(uid)
+    if other is not None and rev.get(other) == uid:
+        # uid is consistently mapped to other docid, docid is a duplicate:
+        del rev[docid]
+        catalog.indexer.unindex_doc(docid)
+    else:
+        fwd[uid] = docid
+    return True
+
+
+def _repair_dangling_uid(catalog, docid, uid):
+    uidmap = catalog.uidmap
+    fwd, rev = uidmap.uuid_to_docid, uidmap.docid_to_uuid
+    if fwd.get(uid) != docid or rev.get(docid) == uid:
+        return False  # no longer broken
+    other = rev.get(docid)
+    if other is not None and fwd.get(other) == docid:
+        del fwd[uid]  # docid belongs to other uid
+    else:
+        rev[docid] = uid
+    return True
+
+
+def repair(catalog, report):
+    """
+    Repair the problems listed in report (from check()) for catalog,
+    touching only broken entries: dangling map entries are restored to
+    pairs (or removed, if duplicating a consistent pair), orphan docids
+    unindexed, missing docids indexed, stale uids unindexed, and the
+    stored length of the UUID map corrected.  Returns count of repairs.
+    """
+    uidmap = catalog.uidmap
+    repaired = 0
+    for kind, name, docid, uid in report:
+        if kind == DANGLING_DOCID:
+            repaired += _repair_dangling_docid(catalog, docid, uid)
+        elif kind == DANGLING_UID:
+            repaired += _repair_dangling_uid(catalog, docid, uid)
+    if repaired:
+        uidmap._changed()
+    for kind, name, docid, uid in report:
+        if kind == ORPHAN and docid not in uidmap.docid_to_uuid:
+            catalog.indexer[name].unindex_doc(docid)
+            repaired += 1
+        elif kind == MISSING and uidmap.docid_to_uuid.get(docid) == uid:
+            obj = catalog.get(uid)
+            if obj is not None:
+                catalog.indexer[name].index_doc(docid, obj)
+                repaired += 1
+        elif kind == STALE and uid in uidmap and catalog.get(uid) is None:
+            catalog.unindex(uid)
+            repaired += 1
+    length = len(uidmap.uuid_to_docid)
+    if len(uidmap) != length:
+        uidmap._length.set(length)
+        uidmap._changed()
+        repaired += 1
+    return repaired
@@ -1 +1,5 @@
 #
+from base import InterfaceIndex  # noqa
+from base import NamedItemContainer  # noqa
+from base import UIDKeyedContainer  # noqa
+from base import OrderedUIDKeyedContainer  # noqa
@@ -0,0 +1,501 @@
+import itertools
+
+from BTrees.Length import Length
+from BTrees.LOBTree import LOBTree
+from BTrees.OLBTree import OLBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet, union
+from persistent import Persistent
+from plone.uuid.interfaces import IUUID
+from zope.container.interfaces import IOrderedContainer
+from zope.interface import implements, providedBy
+from zope.interface.interfaces import IInterface
+
+from uu.retrieval.collection import BaseCollection
+from uu.retrieval.collection.interfaces import INamedItemCollection
+from uu.retrieval.container.interfaces import INamedItemContainer
+from uu.retrieval.container.interfaces import IUIDKeyedContainer
+from uu.retrieval.utils import identify_interface, key_before
+
+
+def resolve_interface(identifier):
+    """Interface for dotted name identifier, or None if not importable"""
+    modname, _, name = identifier.rpartition('.')
+    try:
+        module = __import__(modname, {}, {}, [name])
+    except ImportError:
+        return None
+    iface = getattr(module, name, None)
+    return iface if IInterface.providedBy(iface) else None
+
+
+class InterfaceIndex(Persistent):
+    """
+    Index of item UIDs by each interface provided by the item, that is
+    each interface in providedBy(item).flattened(), keyed by interface
+    identifier (dotted name).
+    """
+
+    def __init__(self):
+        self._uids = OOBTree()      # interface identifier -> UIDs
+        self._provided = OOBTree()  # UID -> interface identifiers
+
+    def index(self, uid, obj):
+        self.unindex(uid)
+        identifiers = tuple(
+            identify_interface(iface)
+            for iface in providedBy(obj).flattened()
+            )
+        for identifier in identifiers:
+            uids = self._uids.get(identifier)
+            if uids is None:
+                uids = self._uids[identifier] = OOTreeSet()
+            uids.insert(uid)
+        self._provided[uid] = identifiers
+
+    def unindex(self, uid):
+        for identifier in self._provided.pop(uid, ()):
+            uids = self._uids[identifier]
+            uids.remove(uid)
+            if not uids:
+                del self._uids[identifier]
+
+    def identifiers(self):
+        return list(self._uids.keys())
+
+    def providing(self, spec):
+        """UIDs of items providing spec, or any of a sequence of specs"""
+        # note: interfaces are iterable (of names), so check explicitly:
+        specs = (spec,) if IInterface.providedBy(spec) else spec
+        result = OOTreeSet()
+        for iface in specs:
+            uids = self._uids.get(identify_interface(iface))
+            if uids is not None:
+                result = union(result, uids) if result else uids
+        return result
+
+
+class ItemSubset(object):
+    """
+    Lazy, read-only named item collection of the items of a container
+    with UIDs in a set; items and names are looked up from the container
+    only as needed.
+    """
+
+    implements(INamedItemCollection)
+
+    __name__ = u''
+
+    def __init__(self, container, uids):
+        self.__parent__ = container
+        self._uids = uids
+
+    def _uid(self, name):
+        uid = self.__parent__.uid_for(name)
+        return uid if uid is not None and uid in self._uids else None
+
+    def get(self, name, default=None):
+        uid = self._uid(name)
+        if uid is None:
+            return default
+        return self.__parent__._items.get(uid, default)
+
+    def __getitem__(self, name):
+        v = self.get(name, None)
+        if v is None:
+            raise KeyError(name)
+        return v
+
+    def __contains__(self, name):
+        return self._uid(name) is not None
+
+    def __len__(self):
+        return len(self._uids)
+
+    def iterkeys(self):
+        return itertools.imap(self.__parent__.name_for, self._uids)
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return itertools.imap(self.__parent__._items.get, self._uids)
+
+    def iteritems(self):
+        return itertools.izip(self.iterkeys(), self.itervalues())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def byname(self):
+        return self
+
+    def byuid(self):
+        items = [(uid, self.__parent__._items.get(uid)) for uid in self._uids]
+        namemap = dict((self.__parent__.name_for(uid), uid)
+                       for uid in self._uids)
+        return BaseCollection(items, namemap)
+
+
+class NamedItemContainer(Persistent):
+    """
+    Reference implementation of a container of items keyed by name,
+    storing each item by its UID (with a Length counter), with an index
+    of interfaces provided by each item answering interfaces() and
+    providing() without resolving items.
+    """
+
+    implements(INamedItemContainer)
+
+    __name__ = u''
+    __parent__ = None
+
+    def __init__(self, id=None):
+        if id is not None:
+            self.__name__ = unicode(id)
+        self._items = OOBTree()        # UID -> item
+        self._length = Length()
+        self._name_to_uid = OOBTree()
+        self._uid_to_name = OOBTree()
+        self._interfaces = InterfaceIndex()
+
+    def getId(self):
+        return self.__name__
+
+    ## adding and removing items:
+
+    def __setitem__(self, name, obj):
+        name = str(name)
+        uid = str(IUUID(obj))
+        if name in self._name_to_uid:
+            del self[name]
+        if uid in self._uid_to_name:
+            del self[self._uid_to_name[uid]]  # rename
+        self._items[uid] = obj
+        self._length.change(1)  # (any replaced item was deleted above)
+        self._name_to_uid[name] = uid
+        self._uid_to_name[uid] = name
+        self._interfaces.index(uid, obj)
+
+    def __delitem__(self, name):
+        uid = self._name_to_uid.pop(str(name))
+        del self._uid_to_name[uid]
+        del self._items[uid]
+        self._length.change(-1)
+        self._interfaces.unindex(uid)
+
+    def reindex(self, name):
+        """Reindex provided interfaces of item (e.g. after alsoProvides)"""
+        uid = self.uid_for(name)
+        self._interfaces.index(uid, self._items[uid])
+
+    ## name and UID lookup:
+
+    def uid_for(self, name):
+        return self._name_to_uid.get(str(name))
+
+    def name_for(self, uid):
+        return self._uid_to_name.get(str(uid))
+
+    def all_names(self, uid):
+        name = self.name_for(uid)
+        return (name,) if name is not None else ()
+
+    ## mapping methods, keyed by name:
+
+    def get(self, name, default=None):
+        uid = self.uid_for(name)
+        if uid is None:
+            return default
+        return self._items.get(uid, default)
+
+    def __getitem__(self, name):
+        v = self.get(name, None)
+        if v is None:
+            raise KeyError(name)
+        return v
+
+    def __contains__(self, name):
+        return str(name) in self._name_to_uid
+
+    def __len__(self):
+        return self._length()
+
+    def iterkeys(self):
+        return iter(self._name_to_uid.keys())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return itertools.imap(self._items.get, self._name_to_uid.values())
+
+    def iteritems(self):
+        return itertools.izip(self.iterkeys(), self.itervalues())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def byname(self):
+        return self
+
+    def byuid(self):
+        return BaseCollection(
+            [(uid, self._items[uid]) for uid in self._name_to_uid.values()],
+            dict(self._name_to_uid.items()),
+            )
+
+    ## interface filtering:
+
+    def interfaces(self):
+        # dynamic interfaces, not importable by name, are omitted:
+        resolved = map(resolve_interface, self._interfaces.identifiers())
+        return [iface for iface in resolved if iface is not None]
+
+    def providing(self, spec):
+        return ItemSubset(self, self._interfaces.providing(spec))
+
+
+class UIDKeyedContainer(Persistent):
+    """
+    Container of items keyed by UUID (string representation), stored
+    in an OOBTree, with a Length counter and optionally many local
+    names per item.  Items obtained from the container are marked with
+    the container as (volatile) parent context.
+    """
+
+    implements(IUIDKeyedContainer)
+
+    __name__ = u''
+    __parent__ = None
+
+    def __init__(self, id=None, items=None):
+        if id is not None:
+            self.__name__ = unicode(id)
+        self._items = OOBTree()          # UID -> item
+        self._length = Length()
+        self._name_to_uid = OOBTree()
+        self._uid_to_names = OOBTree()   # UID -> tuple of names
+        for uid, item in (items or ()):
+            self[uid] = item
+
+    def getId(self):
+        return self.__name__
+
+    def _parented(self, item):
+        if item is not None and getattr(item, '_v_parent', None) is None:
+            item._v_parent = self  # mark obtained item with context
+        return item
+
+    ## adding and removing items:
+
+    def __setitem__(self, uid, item):
+        uid = str(uid)
+        if uid not in self._items:
+            self._length.change(1)
+        self._items[uid] = item
+
+    def add(self, item, name=None):
+        """Add item keyed by its UUID, optionally with a name; return UID"""
+        uid = str(IUUID(item))
+        self[uid] = item
+        if name is not None:
+            self.add_name(name, uid)
+        return uid
+
+    def __delitem__(self, uid):
+        uid = str(uid)
+        del self._items[uid]
+        self._length.change(-1)
+        for name in self._uid_to_names.pop(uid, ()):
+            del self._name_to_uid[name]
+
+    ## names:
+
+    def add_name(self, name, uid):
+        """Link name (one of possibly many for UID) to item"""
+        name, uid = str(name), str(uid)
+        if uid not in self._items:
+            raise KeyError(uid)
+        if name in self._name_to_uid:
+            self.remove_name(name)
+        self._name_to_uid[name] = uid
+        self._uid_to_names[uid] = self._uid_to_names.get(uid, ()) + (name,)
+
+    def remove_name(self, name):
+        uid = self._name_to_uid.pop(str(name))
+        names = tuple(n for n in self._uid_to_names[uid] if n != name)
+        if names:
+            self._uid_to_names[uid] = names
+        else:
+            del self._uid_to_names[uid]
+
+    def uid_for(self, name):
+        return self._name_to_uid.get(str(name))
+
+    def name_for(self, uid):
+        """Primary (first linked) name for UID, or None"""
+        names = self.all_names(uid)
+        return names[0] if names else None
+
+    def all_names(self, uid):
+        return self._uid_to_names.get(str(uid), ())
+
+    ## mapping methods, keyed by UID:
+
+    def get(self, uid, default=None):
+        item = self._items.get(str(uid))
+        if item is None:
+            return default
+        return self._parented(item)
+
+    def __getitem__(self, uid):
+        v = self.get(uid, None)
+        if v is None:
+            raise KeyError(uid)
+        return v
+
+    def get_many(self, uids, default=None):
+        """
+        Return list of items (or default) for each of uids, in the same
+        order; each distinct UID is looked up once, in key order, so
+        that lookups of neighbouring keys reuse the BTree buckets loaded
+        by previous ones, and persistent items are prefetched in bulk if
+        the database connection supports it.
+        """
+        uids = [str(uid) for uid in uids]
+        found = {}
+        for uid in sorted(set(uids)):
+            item = self._items.get(uid)
+            if item is not None:
+                found[uid] = item
+        prefetch = getattr(self._p_jar, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(found.values())
+        return [
+            self._parented(found[uid]) if uid in found else default
+            for uid in uids
+            ]
+
+    def __contains__(self, uid):
+        return str(uid) in self._items
+
+    def __len__(self):
+        return self._length()
+
+    def iterkeys(self):
+        return iter(self._items.keys())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return itertools.imap(self._parented, self._items.values())
+
+    def iteritems(self):
+        return ((uid, self._parented(item))
+                for uid, item in self._items.items())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class OrderedUIDKeyedContainer(UIDKeyedContainer):
+    """
+    UID-keyed container keeping order of items by sparse integer
+    positions (ORDER_STEP apart), so appending or moving one item
+    changes two BTree entries instead of rewriting a list of every
+    key; positions are only renumbered when a gap is used up.
+    """
+
+    implements(IOrderedContainer)
+
+    ORDER_STEP = 2 ** 16
+
+    def __init__(self, id=None, items=None):
+        self._order = LOBTree()      # position -> UID
+        self._position = OLBTree()   # UID -> position
+        super(OrderedUIDKeyedContainer, self).__init__(id, items)
+
+    def __setitem__(self, uid, item):
+        uid = str(uid)
+        super(OrderedUIDKeyedContainer, self).__setitem__(uid, item)
+        if uid not in self._position:
+            self._place(uid, self._last() + self.ORDER_STEP)
+
+    def __delitem__(self, uid):
+        uid = str(uid)
+        super(OrderedUIDKeyedContainer, self).__delitem__(uid)
+        del self._order[self._position.pop(uid)]
+
+    def _last(self):
+        return self._order.maxKey() if self._order else 0
+
+    def _place(self, uid, position):
+        previous = self._position.get(uid)
+        if previous is not None:
+            del self._order[previous]
+        self._order[position] = uid
+        self._position[uid] = position
+
+    def _renumber(self):
+        uids = list(self._order.values())
+        self._order.clear()
+        self._position.clear()
+        for i, uid in enumerate(uids):
+            self._place(uid, (i + 1) * self.ORDER_STEP)
+
+    def move(self, uid, before=None):
+        """Move item uid to position before item before (None: to end)"""
+        uid = str(uid)
+        if uid not in self._position:
+            raise KeyError(uid)
+        if before is None:
+            if self._order[self._last()] != uid:
+                self._place(uid, self._last() + self.ORDER_STEP)
+            return
+        before = str(before)
+        if before == uid:
+            return
+        upper = self._position[before]
+        lower = key_before(self._order, upper) or 0  # O(log n)
+        if self._order.get(lower) == uid:
+            return  # already in place
+        if upper - lower < 2:
+            self._renumber()
+            return self.move(uid, before)
+        self._place(uid, (lower + upper) // 2)
+
+    def updateOrder(self, order):
+        """Set order of all items to sequence of UIDs in order"""
+        order = [str(uid) for uid in order]
+        if len(order) != len(self) or set(order) != set(self._position):
+            raise ValueError('order must list each key exactly once')
+        self._order.clear()
+        self._order.update(dict(enumerate(order)))
+        self._renumber()
+
+    def iterkeys(self):
+        return iter(self._order.values())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return itertools.imap(self.get, self.iterkeys())
+
+    def iteritems(self):
+        return ((uid, self.get(uid)) for uid in self.iterkeys())
@@ -0,0 +1,182 @@
+"""
+Streaming export of catalog records (CSV, JSON lines).
+
+Column values are read from the docid -> value reverse maps of the
+field, date and keyword indexes of a SimpleCatalog wherever a column
+has one; only columns without such an index (e.g. text-only fields)
+need objects, which are resolved in batches.  Rows are generated (and
+written) one batch at a time, so memory use does not grow with the
+number of records exported.
+"""
+
+import csv
+import datetime
+import json
+
+from zope.schema import getFieldNamesInOrder
+from zope.schema.interfaces import IDate, IDatetime
+
+from uu.retrieval.querying import LEGACY_MISSING
+
+
+BATCH_SIZE = 500
+
+# separator of multiple (keyword) values within one CSV cell:
+CSV_MULTI_SEPARATOR = u'; '
+
+# prefixes of names of indexes keeping a reverse map of values by docid:
+VALUE_INDEX_PREFIXES = ('field', 'date', 'keyword')
+
+
+def _value_index(catalog, column):
+    for prefix in VALUE_INDEX_PREFIXES:
+        idx = catalog.indexer.get('%s_%s' % (prefix, column))
+        if idx is not None and hasattr(idx, '_rev_index'):
+            return idx
+    return None
+
+
+def _denormalizer(field):
+    """Function to convert indexed value back to value of field"""
+    if IDatetime.providedBy(field):
+        return datetime.datetime.fromtimestamp
+    if IDate.providedBy(field):
+        return datetime.date.fromordinal
+    return None
+
+
+def _object_value(obj, column):
+    value = getattr(obj, column, None) if obj is not None else None
+    if isinstance(value, (set, frozenset, tuple)):
+        value = list(value)
+    return value
+
+
+def default_columns(catalog):
+    """Names of search schema fields of catalog, in order"""
+    return getFieldNamesInOrder(catalog.search_schema)
+
+
+def _batches(docids, size):
+    batch = []
+    for docid in docids:
+        batch.append(docid)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_rows(catalog, docids, columns=None, batch_size=BATCH_SIZE):
+    """
+    Generate a (uid, values) tuple for each of docids (a sequence of
+    record ids), where values is a list of the value of each column
+    (or None, also for the legacy float('inf') missing-value sentinel
+    of indexes not yet migrated); keyword index values are lists (in
+    sorted order).
+    """
+    if columns is None:
+        columns = default_columns(catalog)
+    schema = catalog.search_schema
+    sources = []
+    for column in columns:
+        field = schema.get(column)
+        convert = _denormalizer(field) if field is not None else None
+        sources.append((column, _value_index(catalog, column), convert))
+    resolve = any(idx is None for column, idx, convert in sources)
+    get_many = getattr(catalog.resolver, 'get_many', None)
+    jar = getattr(catalog, '_p_jar', None)
+    for batch in _batches(docids, batch_size):
+        uids = catalog.uidmap.uuids_for(batch)
+        objects = [None] * len(uids)
+        if resolve and get_many is not None:
+            objects = get_many(uids)
+        elif resolve:
+            objects = [catalog.get(uid) for uid in uids]
+        for docid, uid, obj in zip(batch, uids, objects):
+            values = []
+            for column, idx, convert in sources:
+                if idx is None:
+                    values.append(_object_value(obj, column))
+                    continue
+                value = idx._rev_index.get(docid)
+                if isinstance(value, basestring) or value is None:
+                    pass
+                elif hasattr(value, '__iter__'):
+                    value = list(value)  # keywords
+                elif value == LEGACY_MISSING:
+                    value = None  # not yet migrated, see migrate_missing()
+                elif convert is not None:
+                    value = convert(value)
+                values.append(value)
+            yield uid, values
+        if jar is not None:
+            jar.cacheGC()  # let go of objects loaded for batch
+
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return CSV_MULTI_SEPARATOR.join(
+            _csv_cell(v).decode('utf-8') for v in value
+            ).encode('utf-8')
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError('not JSON serializable: %r' % (value,))
+
+
+def write_csv(stream, rows, columns):
+    """
+    Write header and rows (from iter_rows()) as CSV (UTF-8) to file-like
+    stream, incrementally; returns count of rows written.
+    """
+    writer = csv.writer(stream)
+    writer.writerow(['uid'] + list(columns))
+    count = 0
+    for uid, values in rows:
+        writer.writerow([uid] + [_csv_cell(v) for v in values])
+        count += 1
+    return count
+
+
+def write_jsonl(stream, rows, columns):
+    """
+    Write rows (from iter_rows()) as JSON lines, one object per record,
+    to file-like stream, incrementally; returns count of rows written.
+    """
+    count = 0
+    for uid, values in rows:
+        record = dict(zip(columns, values))
+        record['uid'] = uid
+        stream.write(json.dumps(record, default=_json_value) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+def export(catalog, stream, docids, columns=None, format='csv'):
+    """
+    Export records of catalog for docids to file-like stream, in format
+    ('csv' or 'jsonl'); returns count of records written.
+    """
+    if format not in WRITERS:
+        raise ValueError('unknown export format: %s' % format)
+    if columns is None:
+        columns = default_columns(catalog)
+    rows = iter_rows(catalog, docids, columns)
+    return WRITERS[format](stream, rows, columns)
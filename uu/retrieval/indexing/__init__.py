@@ -1,29 +1,39 @@
+from itertools import islice
 import random
 import uuid
 
 from plone.uuid.interfaces import IUUID
 from persistent import Persistent
 from repoze.catalog.catalog import Catalog as BaseIndexer
+from repoze.catalog.indexes.common import CatalogIndex
 from repoze.catalog.indexes.field import CatalogFieldIndex
 from repoze.catalog.indexes.text import CatalogTextIndex
 from repoze.catalog.indexes.keyword import CatalogKeywordIndex
 import repoze.catalog.query
+from repoze.catalog.query import parse_query
 from zope.interface import implements
 from zope.index.text.lexicon import CaseNormalizer
 from zope.index.text.lexicon import Lexicon
 from zope.index.text.lexicon import Splitter
 from zope.index.text.lexicon import StopWordRemover
 from zope.index.text.okapiindex import OkapiIndex
+from zope.index.text import widcode
+from ZODB.broken import Broken
 import BTrees
+import transaction
 
+from uu.retrieval.querying import ClauseCache, evaluate, query_key
+from uu.retrieval.querying import query_values
 from uu.retrieval.utils import is_multiple, normalize_uuid
 
-from interfaces import IIndexer, IUUIDMapper
+from interfaces import IIndexer, IUUIDMapper, ICatalogIndex
 
 ## temporary monkey patch of repoze.catalog.query.BoolOp to
 ## globally force 64-bit long keys
 repoze.catalog.query.BoolOp.family = BTrees.family64
 
+_marker = ()  # discriminator default, marks a missing value
+
 
 ## 64-bit integer keys -- specific Indexer (Catalog) and Indexes
 
@@ -34,14 +44,279 @@ class Indexer(BaseIndexer):
 
     family = BTrees.family64
 
+    clause_cache_size = 256  # entries in (volatile) per-clause cache
+
+    def clause_cache(self):
+        """Per-connection cache of leaf clause results, made as needed"""
+        cache = getattr(self, '_v_clause_cache', None)
+        if cache is None:
+            cache = self._v_clause_cache = ClauseCache(self.clause_cache_size)
+        return cache
+
+    def apply_clause(self, q, names=None):
+        if names or self.clause_cache_size <= 0:
+            return q._apply(self, names)  # (names bind values at query)
+        index = self[q.index_name]
+        if not isinstance(index, CatalogIndexBase):
+            return q._apply(self, names)  # index without generations
+        # generation of this index object (indexes may be replaced, e.g.
+        # by set_postings()), with serial of counter, as an aborted change
+        # and a change committed elsewhere may both reach the same count:
+        counter = getattr(index, '_generation', None)
+        generation = (
+            index,
+            index.generation(),
+            getattr(counter, '_p_serial', 0),
+            self._pending(counter),
+            )
+        cache = self.clause_cache()
+        key = query_key(q)
+        result = cache.get(key, generation)
+        if result is None:
+            result = q._apply(self, names)
+            cache.set(key, generation, result)
+        return result
+
+    def _pending(self, counter):
+        """
+        Current transaction if the generation counter has changes not
+        yet committed (results computed from these are void once that
+        transaction aborts, even if a later change reaches the same
+        count and serial), else None.
+        """
+        if counter is None:
+            return None
+        if counter._p_jar is not None and not counter._p_changed:
+            return None  # committed state, identified by serial
+        jar = counter._p_jar or self._p_jar
+        if jar is None:
+            return transaction.get()
+        return jar.transaction_manager.get()
+
+    def unindex_docs(self, docids):
+        """Unindex many docids, one index at a time"""
+        docids = sorted(docids)
+        for index in self.values():
+            if isinstance(index, CatalogIndexBase):
+                index.unindex_docs(docids)
+            else:
+                for docid in docids:
+                    index.unindex_doc(docid)
+
+    def query(self, queryobject, sort_index=None, limit=None,
+              sort_type=None, reverse=False, names=None):
+        # like repoze.catalog, but combining bitmap results as bitmaps:
+        if isinstance(queryobject, basestring):
+            queryobject = parse_query(queryobject)
+        results = evaluate(queryobject, self, names)
+        return self.sort_result(results, sort_index, limit, sort_type,
+                                reverse)
+
+
+class CatalogIndexBase(object):
+    """
+    Mix-in for the catalog index types in this package, preceding the
+    repoze.catalog index class in MRO.
+
+    Records for which the discriminator yields no value (missing
+    attribute or None) are not indexed under any sentinel value;
+    their docids are kept in the self._not_indexed TreeSet, which
+    directly answers IsEmpty/NotEmpty queries.
+
+    Each change to the index increments a generation counter, so that
+    copies of index data (e.g. a CatalogReplica) can detect changes.
+    """
+
+    implements(ICatalogIndex)
+
+    def __init__(self, *args, **kwargs):
+        super(CatalogIndexBase, self).__init__(*args, **kwargs)
+        self._not_indexed = self.family.IF.TreeSet()
+
+    def clear(self):
+        super(CatalogIndexBase, self).clear()
+        self._not_indexed = self.family.IF.TreeSet()
+        if getattr(self, '_generation', None) is not None:
+            self._changed()  # (none yet on construction: generation 0)
+
+    def discriminate(self, obj, default=_marker):
+        """Get value to index for obj, or default if value missing"""
+        if callable(self.discriminator):
+            value = self.discriminator(obj, default)
+        else:
+            value = getattr(obj, self.discriminator, default)
+        if value is None:
+            return default
+        return value
+
+    def generation(self):
+        counter = getattr(self, '_generation', None)
+        return counter() if counter is not None else 0
+
+    def _changed(self):
+        if getattr(self, '_generation', None) is None:
+            self._generation = BTrees.Length.Length()
+        self._generation.change(1)
+
+    def _unchanged(self, docid, value):
+        """Is value already indexed for docid?"""
+        if value is _marker:
+            return docid in self._not_indexed
+        return False
 
-class FieldIndex(CatalogFieldIndex):
+    def index_doc(self, docid, obj):
+        return self.index_value(docid, self.discriminate(obj))
+
+    def index_value(self, docid, value):
+        """
+        Index an already discriminated value for docid; this is the
+        equivalent of repoze.catalog CatalogIndex.index_doc() after
+        the discriminator is applied.
+        """
+        if self._unchanged(docid, value):
+            return None
+        if value is _marker:
+            self.unindex_doc(docid)  # unindex previous value, if any
+            self._not_indexed.insert(docid)
+            return None
+        self._changed()
+        if isinstance(value, Persistent):
+            raise ValueError('Catalog cannot index persistent object %s' %
+                             value)
+        if isinstance(value, Broken):
+            raise ValueError('Catalog cannot index broken object %s' %
+                             value)
+        if docid in self._not_indexed:
+            self._not_indexed.remove(docid)
+        return self._index_value(docid, value)
+
+    def _index_value(self, docid, value):
+        # skip CatalogIndex.index_doc(), call zope.index implementation:
+        return super(CatalogIndex, self).index_doc(docid, value)
+
+    def unindex_doc(self, docid):
+        self._changed()
+        super(CatalogIndexBase, self).unindex_doc(docid)
+
+    def unindex_docs(self, docids):
+        """Unindex many docids, in sorted order (for BTree locality)"""
+        for docid in sorted(docids):
+            self.unindex_doc(docid)
+
+    def applyIsEmpty(self):
+        return self._not_indexed
+
+    def applyNotEmpty(self):
+        return self.family.IF.Set(self._indexed())
+
+
+class FieldIndex(CatalogIndexBase, CatalogFieldIndex):
     """Field index using long integer document ids"""
 
     family = BTrees.family64
 
+    def _unchanged(self, docid, value):
+        if value is not _marker and docid in self._rev_index:
+            return self._rev_index[docid] == value
+        return super(FieldIndex, self)._unchanged(docid, value)
+
+    def applyAny(self, values):
+        # a single string is one value (not characters), as for keywords:
+        return super(FieldIndex, self).applyAny(query_values(values))
 
-class TextIndex(CatalogTextIndex):
+    def sort(self, docids, reverse=False, limit=None, sort_type=None):
+        """
+        Sort docids by value as repoze.catalog does, except that docids
+        without a value (not in the reverse index, which that sort
+        skips) are kept: last, or first if reverse, where the legacy
+        float('inf') sentinel sorted them.
+        """
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError('limit must be 1 or greater')
+        not_indexed = self._not_indexed
+
+        def missing(count=None):
+            if not docids or not not_indexed:
+                return []
+            found = (docid for docid in docids if docid in not_indexed)
+            return list(islice(found, count))
+
+        if reverse:
+            first = missing(limit)
+            if limit is not None:
+                if len(first) == limit:
+                    return first
+                limit -= len(first)
+            return first + list(super(FieldIndex, self).sort(
+                docids, reverse, limit, sort_type))
+        result = list(super(FieldIndex, self).sort(
+            docids, reverse, limit, sort_type))
+        if limit is None:
+            return result + missing()
+        if len(result) < limit:
+            result += missing(limit - len(result))
+        return result
+
+    def migrate_missing(self, sentinel=float('inf')):
+        """
+        Migrate docids indexed under a legacy missing-value sentinel
+        (float('inf') in previous versions) to the set of docids
+        with missing values; returns count of docids migrated.
+        """
+        TreeSet = self.family.IF.TreeSet
+        if not isinstance(self._not_indexed, TreeSet):
+            self._not_indexed = TreeSet(self._not_indexed)  # legacy Set
+        docids = self._fwd_index.get(sentinel)
+        if docids is None:
+            return 0
+        docids = list(docids)
+        for docid in docids:
+            self.unindex_doc(docid)
+            self._not_indexed.insert(docid)
+        return len(docids)
+
+
+def make_lexicon():
+    """Construct a new lexicon using the default text pipeline"""
+    return Lexicon(
+        Splitter(),
+        CaseNormalizer(),
+        StopWordRemover(),
+        )
+
+
+def merge_lexicons(indexes, lexicon):
+    """
+    Re-bind each TextIndex in indexes to lexicon (usually one shared
+    by all text indexes of a catalog).  Word ids already indexed using
+    the previous lexicon of each index are re-mapped to word ids in
+    the target lexicon, so nothing needs to be reindexed.
+    """
+    for idx in indexes:
+        if idx.lexicon is lexicon:
+            continue
+        old_lexicon, okapi = idx.lexicon, idx.index
+        wid_map = {}
+
+        def _remap(wid):
+            if wid not in wid_map:
+                word = old_lexicon.get_word(wid)
+                wid_map[wid] = lexicon._getWordIdCreate(word)
+            return wid_map[wid]
+
+        wordinfo = okapi.family.IO.BTree()  # as made by OkapiIndex
+        for wid, doc2score in okapi._wordinfo.items():
+            wordinfo[_remap(wid)] = doc2score
+        okapi._wordinfo = wordinfo
+        for docid, encoded in okapi._docwords.items():
+            wids = [_remap(wid) for wid in widcode.decode(encoded)]
+            okapi._docwords[docid] = widcode.encode(wids)
+        okapi._lexicon = idx.lexicon = lexicon
+
+
+class TextIndex(CatalogIndexBase, CatalogTextIndex):
     """Text index using long integer document ids"""
 
     family = BTrees.family64
@@ -51,11 +326,7 @@ class TextIndex(CatalogTextIndex):
     def __init__(self, discriminator, lexicon=None, index=None):
         _lexicon = lexicon
         if lexicon is None:
-            _lexicon = Lexicon(
-                Splitter(),
-                CaseNormalizer(),
-                StopWordRemover(),
-                )
+            _lexicon = make_lexicon()
         if index is None:
             index = OkapiIndex(_lexicon, family=self.family)
         super(TextIndex, self).__init__(discriminator, lexicon, index)
@@ -64,12 +335,66 @@ class TextIndex(CatalogTextIndex):
         self.index = index
         self.clear()
 
-
-class KeywordIndex(CatalogKeywordIndex):
+    def index_words(self, items):
+        """
+        Index (docid, words) items, words already split and normalized
+        by the lexicon pipeline (e.g. by workers of a parallel reindex):
+        word ids are looked up (or created) directly, and word info,
+        document weight and words are updated without the pipeline,
+        with document count and total length changed once for all
+        items.  Unchanged documents are skipped.  Returns count of
+        documents changed.
+        """
+        okapi = self.index
+        lexicon = okapi._lexicon
+        lexicon.wordCount._p_deactivate()  # latest value, as in pipeline
+        word_id = lexicon._getWordIdCreate
+        added, doclen, changed = 0, 0, 0
+        for docid, words in items:
+            wids = [word_id(word) for word in words]
+            old_wids = None
+            if docid in okapi._docwords:
+                old_wids = okapi.get_words(docid)
+            if old_wids == wids:
+                continue
+            freqs, weight = okapi._get_frequencies(wids)
+            old_freqs, old_weight = {}, 0
+            if old_wids is None:
+                added += 1
+            else:
+                old_freqs, old_weight = okapi._get_frequencies(old_wids)
+                for wid in old_freqs:
+                    if wid not in freqs:
+                        okapi._del_wordinfo(wid, docid)
+            okapi._mass_add_wordinfo(
+                dict((wid, f) for wid, f in freqs.items()
+                     if old_freqs.get(wid) != f),
+                docid,
+                )
+            doclen += weight - old_weight
+            okapi._docweight[docid] = weight
+            okapi._docwords[docid] = widcode.encode(wids)
+            if docid in self._not_indexed:
+                self._not_indexed.remove(docid)
+            changed += 1
+        if changed:
+            self._changed()
+            okapi.documentCount.change(added)
+            okapi._change_doc_len(doclen)
+        return changed
+
+
+class KeywordIndex(CatalogIndexBase, CatalogKeywordIndex):
     """Keyword index using long integer document ids"""
 
     family = BTrees.family64
 
+    def _unchanged(self, docid, value):
+        old = self._rev_index.get(docid)
+        if value is not _marker and old is not None:
+            return list(old) == sorted(set(self.normalize(value)))
+        return super(KeywordIndex, self)._unchanged(docid, value)
+
 
 class IdGeneratorBase(object):
 
@@ -140,6 +465,15 @@ class UUIDMapper(Persistent, IdGeneratorBase):
     def __len__(self):
         return self._length()
 
+    def generation(self):
+        counter = getattr(self, '_generation', None)
+        return counter() if counter is not None else 0
+
+    def _changed(self):
+        if getattr(self, '_generation', None) is None:
+            self._generation = BTrees.Length.Length()
+        self._generation.change(1)
+
     def _is_uid(self, spec):
         if isinstance(spec, int) or isinstance(spec, long):
             return False
@@ -178,6 +512,7 @@ class UUIDMapper(Persistent, IdGeneratorBase):
         self.uuid_to_docid[uid] = docid
         self.docid_to_uuid[docid] = uid
         self._length.change(1)  # increment length counter
+        self._changed()
         return uid, docid
 
     def remove(self, spec):
@@ -188,6 +523,24 @@ class UUIDMapper(Persistent, IdGeneratorBase):
         del(self.uuid_to_docid[uid])
         del(self.docid_to_uuid[docid])
         self._length.change(-1)  # decrement length counter
+        self._changed()
+
+    def remove_many(self, specs):
+        pairs = {}  # uid -> docid, without duplicates
+        for spec in specs:
+            try:
+                uid, docid = self._pair(spec)
+            except (ValueError, TypeError):
+                raise KeyError('key specification %s not found' % spec)
+            pairs[uid] = docid
+        for uid in sorted(pairs):
+            del(self.uuid_to_docid[uid])
+        for docid in sorted(pairs.values()):
+            del(self.docid_to_uuid[docid])
+        if pairs:
+            self._length.change(-len(pairs))  # one change for batch
+            self._changed()
+        return pairs.items()
 
     def equivalent(self, spec, default=None):
         if is_multiple(spec):
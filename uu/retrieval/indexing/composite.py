@@ -0,0 +1,63 @@
+from persistent import Persistent
+
+from uu.retrieval.indexing import FieldIndex, _marker
+
+
+class CompositeDiscriminator(Persistent):
+    """
+    Discriminator for a composite index: calls the discriminator of
+    each component (single-valued) index, and yields a tuple of the
+    component values, or default if any component value is missing.
+    """
+
+    def __init__(self, discriminators):
+        self.discriminators = tuple(discriminators)
+
+    def __call__(self, obj, default):
+        r = []
+        for discriminator in self.discriminators:
+            if callable(discriminator):
+                value = discriminator(obj, default)
+            else:
+                value = getattr(obj, discriminator, default)
+            if value is default or value is None:
+                return default
+            r.append(value)
+        return tuple(r)
+
+
+class CompositeIndex(FieldIndex):
+    """
+    Field index keyed by a tuple of the normalized values of several
+    component field (or date) indexes, named in self.components.
+
+    An equality query on all components is one bucket read in this
+    index, instead of an intersection of one result per component.
+    """
+
+    def __init__(self, components, discriminators):
+        self.components = tuple(components)
+        discriminator = CompositeDiscriminator(discriminators)
+        super(CompositeIndex, self).__init__(discriminator)
+
+    def applyEq(self, value):
+        # tuple value is a key, not a (min, max) range as in FieldIndex:
+        return self.search([value], operator='or')
+
+    def build(self, indexes, docids):
+        """
+        Index docids from the already indexed values of component
+        indexes (sequence, in order of self.components), without
+        needing to resolve any indexed objects.
+        """
+        for docid in docids:
+            value = []
+            for idx in indexes:
+                v = idx._rev_index.get(docid, _marker)
+                if v is _marker:
+                    value = _marker
+                    break
+                value.append(v)
+            if value is not _marker:
+                value = tuple(value)
+            self.index_value(docid, value)
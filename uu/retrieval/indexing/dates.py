@@ -0,0 +1,180 @@
+import datetime
+import time
+
+from uu.retrieval.indexing import FieldIndex, _marker
+from uu.retrieval.querying import LEGACY_MISSING
+
+
+DATE, DATETIME = 'date', 'datetime'
+
+
+class DateIndex(FieldIndex):
+    """
+    Field index for normalized date (ordinal) or datetime (epoch
+    seconds, local time) values, which additionally keeps docids
+    in hierarchical year, month, and (for datetime) day buckets.
+
+    Range queries are answered by a union of the coarsest buckets
+    covering the range, plus exact values only for partial days at
+    either end of the range, instead of a union of one docid set per
+    distinct value in the range.
+    """
+
+    def __init__(self, discriminator, kind=DATE):
+        if kind not in (DATE, DATETIME):
+            raise ValueError('unknown date index kind: %s' % kind)
+        self.kind = kind
+        super(DateIndex, self).__init__(discriminator)
+
+    def clear(self):
+        super(DateIndex, self).clear()
+        self._year_index = self.family.IO.BTree()   # year -> docids
+        self._month_index = self.family.IO.BTree()  # year*12 + month-1 -> ...
+        self._day_index = None                      # for date, _fwd_index
+        if self.kind == DATETIME:
+            self._day_index = self.family.IO.BTree()  # ordinal -> docids
+
+    ## value <--> day ordinal conversions:
+
+    def _day(self, value):
+        """day ordinal for a normalized value"""
+        if self.kind == DATETIME:
+            return datetime.date.fromtimestamp(value).toordinal()
+        return value
+
+    def _day_start(self, day):
+        """smallest normalized value for day ordinal"""
+        if self.kind == DATETIME:
+            date = datetime.date.fromordinal(day)
+            return int(time.mktime(date.timetuple()))
+        return day
+
+    def _buckets(self, value):
+        """(btree, key) pairs for each bucket containing value"""
+        day = self._day(value)
+        date = datetime.date.fromordinal(day)
+        r = [
+            (self._year_index, date.year),
+            (self._month_index, date.year * 12 + date.month - 1),
+            ]
+        if self._day_index is not None:
+            r.append((self._day_index, day))
+        return r
+
+    ## bucket maintenance:
+
+    def _add_buckets(self, docid, value):
+        for btree, key in self._buckets(value):
+            docids = btree.get(key)
+            if docids is None:
+                docids = btree[key] = self.family.IF.TreeSet()
+            docids.insert(docid)
+
+    def _remove_buckets(self, docid, value):
+        for btree, key in self._buckets(value):
+            docids = btree.get(key)
+            if docids is not None and docid in docids:
+                docids.remove(docid)
+                if not docids:
+                    del btree[key]
+
+    def index_value(self, docid, value):
+        old = self._rev_index.get(docid, _marker)
+        result = super(DateIndex, self).index_value(docid, value)
+        new = self._rev_index.get(docid, _marker)
+        if old != new:
+            if old is not _marker:
+                self._remove_buckets(docid, old)
+            if new is not _marker:
+                self._add_buckets(docid, new)
+        return result
+
+    def unindex_doc(self, docid):
+        old = self._rev_index.get(docid, _marker)
+        super(DateIndex, self).unindex_doc(docid)
+        if old is not _marker:
+            self._remove_buckets(docid, old)
+
+    ## range queries:
+
+    def _exact(self, start, end):
+        """docid sets for exact values in inclusive range"""
+        return list(self._fwd_index.values(start, end))
+
+    def _covering(self, first, last):
+        """docid sets of coarsest buckets covering whole days inclusive"""
+        result = []
+        day_index = self._day_index
+        if day_index is None:
+            day_index = self._fwd_index  # day is exact value for dates
+        day = first
+        while day <= last:
+            date = datetime.date.fromordinal(day)
+            if date.day == 1 and date.year < datetime.MAXYEAR:
+                next_year = datetime.date(date.year + 1, 1, 1)
+                if date.month == 1:
+                    following = next_year.toordinal()
+                    if following - 1 <= last:
+                        result.append(self._year_index.get(date.year))
+                        day = following
+                        continue
+                if date.month == 12:
+                    following = next_year
+                else:
+                    following = datetime.date(date.year, date.month + 1, 1)
+                following = following.toordinal()
+                if following - 1 <= last:
+                    key = date.year * 12 + date.month - 1
+                    result.append(self._month_index.get(key))
+                    day = following
+                    continue
+            result.append(day_index.get(day))
+            day += 1
+        return [docids for docids in result if docids is not None]
+
+    def applyInRange(self, start, end, excludemin=False, excludemax=False):
+        fwd_index = self._fwd_index
+        if not fwd_index:
+            return self.family.IF.Set()
+        # inclusive integer bounds, open ends bounded by indexed values:
+        if start is None:
+            start = fwd_index.minKey()
+        elif excludemin:
+            start = int(start) + 1
+        if end is None:
+            end = fwd_index.maxKey()
+        elif excludemax:
+            end = int(end) - 1
+        if start > end:
+            return self.family.IF.Set()
+        sets = []
+        first, last = self._day(start), self._day(end)
+        if self._day_start(first) < start:
+            # partial first day, use exact values until next day:
+            day_end = self._day_start(first + 1) - 1
+            sets += self._exact(start, min(end, day_end))
+            first += 1
+        if first <= last and self._day_start(last + 1) - 1 > end:
+            # partial last day, use exact values from its start:
+            sets += self._exact(max(start, self._day_start(last)), end)
+            last -= 1
+        sets += self._covering(first, last)
+        return self.family.IF.multiunion(sets)
+
+
+def convert_date_index(idx, kind=DATE):
+    """
+    Construct a DateIndex of kind from an existing field index of the
+    same (normalized) date or datetime values, e.g. a field_ prefixed
+    index of a previous version, copying its already indexed values,
+    without resolving any indexed objects.  Docids indexed under the
+    legacy missing-value sentinel are kept as missing values.
+    """
+    result = DateIndex(idx.discriminator, kind)
+    for docid, value in idx._rev_index.items():
+        if value == LEGACY_MISSING:
+            value = _marker
+        result.index_value(docid, value)
+    for docid in idx._not_indexed:
+        result.index_value(docid, _marker)
+    return result
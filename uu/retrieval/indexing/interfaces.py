@@ -19,12 +19,65 @@ class IIndexer(catalog_interfaces.ICatalog, IUse64BitBTrees):
     which differs from the default ICatalog implementation.
     """
 
+    def apply_clause(q, names=None):
+        """
+        Apply leaf clause (comparator) q to its index, using a bounded
+        per-connection cache of clause results keyed by index name,
+        comparator and normalized value.  A cached result is used only
+        while the generation counter of its index is unchanged, so
+        writes to one index leave cached clauses of other indexes
+        intact.
+        """
+
+    def clause_cache():
+        """
+        Return the (volatile, per-connection) clause cache, which has
+        hits and misses counts, and a clear() method.
+        """
+
+    def unindex_docs(docids):
+        """
+        Unindex many docids, index by index, each in sorted docid
+        order.
+        """
+
 
 class ICatalogIndex(catalog_interfaces.ICatalogIndex, IUse64BitBTrees):
     """
     A catalog index supporting 64-bit long-integer object ids.
+
+    Records without a value for the index (None, or no value yielded
+    by the discriminator) are tracked by docid rather than indexed
+    using any sentinel value.
     """
 
+    def discriminate(obj, default=None):
+        """
+        Return the value to index for obj, using the discriminator of
+        the index, or default if obj has no value.
+        """
+
+    def index_value(docid, value):
+        """
+        Index an already-discriminated value for docid, as index_doc()
+        does after applying the discriminator to an object.
+        """
+
+    def unindex_docs(docids):
+        """Unindex each of docids, in sorted order."""
+
+    def applyIsEmpty():
+        """Return set of docids for records with no value indexed."""
+
+    def applyNotEmpty():
+        """Return set of docids for records with a value indexed."""
+
+    def generation():
+        """
+        Return integer change counter, incremented on each change to
+        the index (index or unindex of a document).
+        """
+
 
 class IItemIdGenerator(Interface):
     """Component to generate integer (64 bit) and UUID identifiers"""
@@ -76,6 +129,15 @@ class IUUIDMapper(IUse64BitBTrees, IItemIdGenerator):
         Raises KeyError if identifier (spec) is not found.
         """
 
+    def remove_many(specs):
+        """
+        Remove each identifier pair for a sequence of specs (as for
+        remove()), updating the length once for the batch.  Returns
+        list of the removed (uid, docid) pairs.
+
+        Raises KeyError, removing nothing, if any spec is not found.
+        """
+
     def equivalent(spec, default=None):
         """
         General-purpose isomorphic function for this mapping and the
@@ -97,6 +159,12 @@ class IUUIDMapper(IUse64BitBTrees, IItemIdGenerator):
     def __len__():
         """Return number of mapped pairs"""
 
+    def generation():
+        """
+        Return integer change counter, incremented on each addition
+        or removal of a mapped pair.
+        """
+
     def __contains__(spec):
         """
         Given spec as either integer (docid) or string/UUID (uid),
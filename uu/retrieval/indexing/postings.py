@@ -0,0 +1,123 @@
+from repoze.catalog import RangeValue
+
+from uu.retrieval.bitmap import Bitmap, BitmapPostings
+from uu.retrieval.indexing import FieldIndex, KeywordIndex, _marker
+
+
+TREESET, BITMAP = 'treeset', 'bitmap'
+
+
+class BitmapIndexBase(object):
+    """
+    Mix-in for indexes storing postings for each value as compressed
+    BitmapPostings instead of TreeSets; queries on these indexes
+    return Bitmap results, which the Indexer combines bitmap-to-bitmap.
+
+    Best suited to values shared by a large fraction of documents
+    (low-cardinality fields and keywords).
+    """
+
+    def _bitmap(self, postings):
+        if postings is None:
+            return Bitmap()
+        return postings.bitmap()
+
+    def _all(self):
+        """Bitmap of all docids known to the index"""
+        return Bitmap.union(
+            [self._bitmap(p) for p in self._fwd_index.values()] +
+            [Bitmap(self._not_indexed)]
+            )
+
+    def _negate(self, assertion, *args, **kw):
+        positive = assertion(*args, **kw)
+        if not isinstance(positive, Bitmap):
+            positive = Bitmap(positive)
+        return self._all() - positive
+
+    def applyNotEmpty(self):
+        return Bitmap.union(self._bitmap(p) for p in self._fwd_index.values())
+
+
+class BitmapFieldIndex(BitmapIndexBase, FieldIndex):
+    """Field index using compressed bitmap postings"""
+
+    def _index_value(self, docid, value):
+        # as zope.index FieldIndex.index_doc(), but postings of a new
+        # value are created as BitmapPostings, not as a TreeSet:
+        if docid in self._rev_index:
+            self.unindex_doc(docid)
+        postings = self._fwd_index.get(value)
+        if postings is None:
+            postings = self._fwd_index[value] = BitmapPostings()
+        postings.insert(docid)
+        self._num_docs.change(1)
+        self._rev_index[docid] = value
+
+    def _range(self, start, end, excludemin=False, excludemax=False):
+        values = self._fwd_index.values(
+            start,
+            end,
+            excludemin=excludemin,
+            excludemax=excludemax,
+            )
+        return Bitmap.union(self._bitmap(p) for p in values)
+
+    def search(self, queries, operator='or'):
+        bitmaps = []
+        for query in queries:
+            if isinstance(query, RangeValue):
+                bitmaps.append(self._range(*query.as_tuple()))
+            else:
+                bitmaps.append(self._bitmap(self._fwd_index.get(query)))
+        if operator == 'and':
+            return Bitmap.intersection(bitmaps)
+        return Bitmap.union(bitmaps)
+
+    def applyInRange(self, start, end, excludemin=False, excludemax=False):
+        return self._range(start, end, excludemin, excludemax)
+
+
+class BitmapKeywordIndex(BitmapIndexBase, KeywordIndex):
+    """Keyword index using compressed bitmap postings"""
+
+    def _insert_forward(self, docid, words):
+        idx = self._fwd_index
+        for word in words:
+            postings = idx.get(word)
+            if postings is None:
+                postings = idx[word] = BitmapPostings()
+            postings.insert(docid)
+
+    def optimize(self):
+        pass  # no TreeSet conversion of postings
+
+    def search(self, query, operator='and'):
+        if isinstance(query, basestring):
+            query = [query]
+        query = self.normalize(query)
+        bitmaps = [self._bitmap(self._fwd_index.get(word)) for word in query]
+        if operator == 'or':
+            return Bitmap.union(bitmaps)
+        if operator == 'and':
+            return Bitmap.intersection(bitmaps)
+        raise TypeError(
+            'Keyword index only supports `and` and `or` operators, '
+            'not `%s`.' % operator
+            )
+
+
+def convert_index(idx, cls):
+    """
+    Construct an index of class cls from an existing field or keyword
+    index, copying its already indexed values, without resolving any
+    indexed objects.
+    """
+    result = cls(idx.discriminator)
+    for docid, value in idx._rev_index.items():
+        if isinstance(idx, KeywordIndex):
+            value = list(value)  # copy of persistent OOSet of keywords
+        result.index_value(docid, value)
+    for docid in idx._not_indexed:
+        result.index_value(docid, _marker)
+    return result
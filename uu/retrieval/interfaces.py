@@ -34,6 +34,10 @@ class IItemResolver(IItemMapping):
     def __call__(uid):
         """Return object for given UID, or None"""
 
+    # Resolvers may optionally provide get_many(uids), returning a list
+    # of objects (or None) for a sequence of UIDs, used by search results
+    # to resolve items in bulk.
+
 
 class ISearchContext(IUIDItemCollection):
     """
@@ -99,6 +103,12 @@ class ISearchResult(ISearchContext):
     Marker interface for a search context that is a result of a query.
     """
 
+    def export(stream, columns=None, format='csv'):
+        """
+        Export records of this result, in order, to file-like stream,
+        using export() of the catalog (__parent__) of the result.
+        """
+
 
 class IRecordIdMapper(Interface):
     """Map (64-bit integer) RID <--> (string) UID (one-to-one)"""
@@ -141,6 +151,30 @@ class ISimpleCatalog(ISearchContext):
         required=True,
         )
 
+    lexicon = schema.Object(
+        title=u'Shared lexicon',
+        description=u'Persistent lexicon (zope.index.text ILexicon) '
+                    u'shared by all text indexes of this catalog, or '
+                    u'None if each text index uses its own lexicon.',
+        schema=Interface,
+        required=False,
+        )
+
+    postings = schema.Dict(
+        title=u'Postings formats',
+        description=u'Mapping of index name to postings format (docid '
+                    u'set storage) for indexes not using the default '
+                    u'TreeSet postings, or None.',
+        required=False,
+        )
+
+    saved_queries = schema.Dict(
+        title=u'Saved queries',
+        description=u'Mapping of name to ISavedQuery registered on this '
+                    u'catalog, or None.',
+        required=False,
+        )
+
     def bind(schema):
         """
         Bind a new schema to this catalog, then reindex existing values.
@@ -159,6 +193,81 @@ class ISimpleCatalog(ISearchContext):
         on catalog construction.
         """
 
+    def share_lexicon():
+        """
+        Migrate text indexes to one shared self.lexicon, creating it
+        if needed, and merging the vocabulary of any existing
+        per-index lexicons into it (without reindexing).
+        """
+
+    def set_postings(name, format='bitmap'):
+        """
+        Set the postings format of a field or keyword index by name,
+        either 'bitmap' (compressed bitmaps, suited to low-cardinality
+        values shared by many records) or 'treeset' (default).  The
+        existing index is converted from its already indexed values,
+        and the choice is kept when indexes are re-made.
+        """
+
+    def migrate_missing():
+        """
+        Migrate field (and date) indexes made by previous versions,
+        which indexed missing values under a float('inf') sentinel:
+        docids indexed under it are moved to the docids without a
+        value, without resolving any indexed objects, so that IsEmpty
+        and Eq(None) queries find them.  Returns list of names of
+        indexes with docids migrated.
+        """
+
+    def migrate_date_indexes():
+        """
+        Migrate indexes of Date and Datetime fields made by previous
+        versions (field_ prefixed field indexes) to DateIndex (date_
+        prefixed) indexes, built from their already indexed values,
+        without resolving any indexed objects; the field_ indexes are
+        removed, and renamed in the components of composite indexes.
+        Saved queries naming a field_ index must be saved again.
+        Returns list of names of migrated indexes.
+        """
+
+    def add_composite(names, name=None):
+        """
+        Add a composite index over two or more existing (single-valued)
+        field or date indexes, given a sequence of index names, and
+        index existing records from the values already indexed by the
+        components.  Returns the composite index name, by default
+        'composite_' plus the component field names joined by '__'.
+
+        Composite indexes are keyed by a tuple of the component values;
+        queries containing an And of Eq clauses on every component are
+        answered by a single lookup of the composite index.
+        """
+
+    def composites():
+        """
+        Return tuple of (name, component index names) pairs for each
+        composite index in this catalog.
+        """
+
+    def save_query(name, *args, **kwargs):
+        """
+        Register a saved query by name, given query arguments with the
+        same semantics as query().  The set of matching docids is kept
+        by the saved query, and updated on each index(), reindex() and
+        unindex() by testing only the changed record; ISavedQueryEntered
+        and ISavedQueryLeft events are notified on membership changes.
+        Returns the ISavedQuery.
+        """
+
+    def remove_saved_query(name):
+        """Unregister saved query by name, raises KeyError if missing."""
+
+    def saved_query(name):
+        """
+        Return ISearchResult of the current members of the saved query
+        of given name, without evaluating the query.
+        """
+
     def index(obj):
         """
         Given an object, index it in catalog and track its UID in
@@ -182,6 +291,29 @@ class ISimpleCatalog(ISearchContext):
         Should remove related UID to RID mapping from self.uidmap.
         """
 
+    def unindex_many(specs):
+        """
+        Unindex a batch of UIDs or indexed objects, removing them from
+        each index in sorted record id order, and from self.uidmap in
+        one batch.  Returns count of records unindexed.
+
+        Raises KeyError, unindexing nothing, if any is not indexed.
+        """
+
+    def unindex_query(*args, **kwargs):
+        """
+        Unindex all records matching a query (arguments as for query()),
+        as a batch like unindex_many().  Returns count unindexed.
+        """
+
+    def compile(template, **options):
+        """
+        Compile a query template (query object or mapping, as for
+        query()), which may use repoze.catalog.query.Name placeholders
+        for parameters, returning an IPreparedQuery.  Options
+        (sort_index, limit, reverse) are defaults for each execution.
+        """
+
     def query(*args, **kwargs):
         """
         Given a first positional argument providing a query mapping
@@ -202,12 +334,51 @@ class ISimpleCatalog(ISearchContext):
             * Can also be:
                 * Pair of comparator name, value.
 
+            * None, which (with Eq or NotEq) queries records with no
+              value for the index, equivalent to the IsEmpty and
+              NotEmpty comparators of uu.retrieval.querying.
+
         Alternately, if the first positional argument is not a
-        dict/mapping, then it may be (only) a repoze.catalog
-        Query object.
+        dict/mapping, then it may be a repoze.catalog Query object, or
+        a query expression (CQE) string, e.g.
+        "field_name == 'Me' and keyword_keywords in any(['a', 'b'])",
+        parsed using parse(); pass safe=True for text from untrusted
+        sources.
 
         When multiple fields are passed, the results from each
         are ANDed.
+
+        Reserved keyword arguments are not index names, but options:
+        sort_index (name of field index to order results by), limit
+        (maximum number of sorted results), and reverse (boolean,
+        sort descending).
+
+        For keyset pagination of sorted results, pass a cursor (None
+        for the first page) with sort_index and limit (page size):
+        the result is one page, with a cursor attribute to pass for
+        the next page (None when there are no more results).  Each
+        page resumes from the (sort value, docid) of the last result
+        in the forward index of the sort index; records without a
+        sort value are not included.
+
+        To filter a previous result again, pass it (or a set of its
+        integer record ids) as within: the query is evaluated only
+        for those records, probing the values indexed for each of
+        them when the restriction is small.
+        """
+
+    def parse(text, safe=False):
+        """
+        Parse query expression (CQE) text into a normalized query
+        object, raising ValueError for invalid text.  Parsed queries
+        are kept in a bounded (per-connection) cache keyed by text,
+        valid while the schema and indexes of the catalog are
+        unchanged.  Cached query objects are shared, and must not be
+        modified.
+
+        If safe, text is limited in length and number of clauses, and
+        must only use comparators supported by indexes of this catalog,
+        with literal values (see uu.retrieval.querying.check_safe).
         """
 
     def rcount(*args, **kwargs):
@@ -220,3 +391,259 @@ class ISimpleCatalog(ISearchContext):
 
     __call__ = query
 
+    def query_many(queries, cache=None):
+        """
+        Execute a batch of queries, each a query object or a mapping
+        (which may include the sort_index, limit and reverse options),
+        returning a list of search results in the same order.
+
+        Identical sub-queries (at any level) shared by the queries are
+        evaluated once; a uu.retrieval.querying.SubqueryCache may be
+        passed as cache, to share results with other batches, or to
+        inspect its hits (sub-queries reused) and misses (sub-queries
+        evaluated) counts.
+        """
+
+    def rcount_many(queries, cache=None):
+        """Like query_many(), but return a list of result counts."""
+
+    def distinct(index_name, query=None, with_counts=False, prefix=None,
+                 limit=None, start=None, end=None):
+        """
+        List the distinct values of a field (or date, or composite) or
+        keyword index, in order, read from the index without resolving
+        records; if with_counts is true, list (value, record count)
+        pairs instead.  Values are as indexed (e.g. date ordinals).
+
+        query (a query object or mapping, as for query()) restricts the
+        listing (and counts) to values of matching records; prefix
+        (a string, or a tuple for a composite index) restricts it to
+        values starting with prefix; start and end (normalized as query
+        values, e.g. dates) restrict it to an inclusive range of values,
+        either end open if None; limit caps the number of values (0
+        lists none).  Missing values are not listed.
+        """
+
+    def export_rows(result=None, columns=None):
+        """
+        Generate (uid, values) tuples, with a list of values for the
+        columns (default: search schema field names) of each record in
+        result (a search result, or None for all records), in order.
+        Values are read from field, date and keyword indexes where
+        possible; objects are resolved (in batches) only for columns
+        without such an index.
+        """
+
+    def export(stream, result=None, columns=None, format='csv'):
+        """
+        Write rows of export_rows() to file-like stream incrementally,
+        as CSV (format 'csv', with a header row) or JSON lines (format
+        'jsonl').  Returns count of records written.
+        """
+
+    def check_consistency(resolve=True):
+        """
+        Check the UUID map (both directions, and its stored length) and
+        the docids of each index against each other, and (if resolve)
+        against the resolver, in one pass in docid order with bounded
+        memory.  Returns a uu.retrieval.consistency.ConsistencyReport,
+        listing (kind, index name, docid, uid) problems.
+        """
+
+    def repair(report=None):
+        """
+        Repair the problems in report (default: a new check), touching
+        only broken entries; returns count of entries repaired.
+        """
+
+    def stats(names=None, sample=None):
+        """
+        Return dict of storage and structure statistics for each index
+        named in names (default: all indexes, 'uidmap' for the UUID map
+        and 'lexicon' for a shared lexicon, counted only there, not in
+        the totals of text indexes): document count, distinct values
+        (words, for text indexes, with lexicon size), largest values by
+        record count, and for each BTree its depth, node, bucket, item
+        and persistent object counts and estimated pickled size.  If
+        sample is not None, at most sample buckets of each BTree are
+        loaded, and counts and sizes extrapolated.  See
+        uu.retrieval.statistics.
+        """
+
+    def warmup(names=None, values=None, limit=None):
+        """
+        Load structures of this catalog into the object cache of its
+        connection in prefetched batches: objects recorded by
+        record_hot() (in self.hot_oids), the UUID map BTrees, and the
+        forward BTrees of indexes in names (default: warmup_indexes
+        attribute, or all if None) and lexicons.  Postings (bucket
+        values) are loaded only if values (default: warmup_values
+        attribute) is true; limit caps objects loaded.  Returns dict
+        of objects (walked), loaded (from storage) and seconds taken.
+        See uu.retrieval.warmup.
+        """
+
+    def record_hot(limit=10000):
+        """
+        Record oids of (at most limit) most recently used catalog
+        structures in the object cache of the connection, for warmup()
+        by later processes (persisted on commit); returns count.
+        """
+
+
+class IPreparedQuery(Interface):
+    """
+    A query template compiled for one catalog, executed many times
+    with different parameter values.
+    """
+
+    query = schema.Object(
+        title=u'Query',
+        description=u'Normalized query template; never modified.',
+        schema=Interface,
+        )
+
+    params = schema.FrozenSet(
+        title=u'Parameters',
+        description=u'Names of Name placeholders in template.',
+        )
+
+    def bind(**params):
+        """
+        Return query with parameter values bound (normalized), sharing
+        sub-queries without parameters with the template.  Raises
+        NameError if a parameter value is missing.
+        """
+
+    def __call__(**params):
+        """
+        Execute with parameter values (and optionally sort_index, limit
+        or reverse options), returning a search result.
+        """
+
+    def rcount(**params):
+        """Like __call__(), but return a result count."""
+
+
+class ISavedQuery(Interface):
+    """
+    A named, normalized query registered on a catalog, maintaining its
+    set of matching docids incrementally.
+    """
+
+    name = schema.BytesLine(title=u'Name')
+
+    query = schema.Object(
+        title=u'Query',
+        description=u'Normalized repoze.catalog query object.',
+        schema=Interface,
+        )
+
+    docids = schema.Object(
+        title=u'Docids',
+        description=u'TreeSet of docids currently matching query.',
+        schema=Interface,
+        )
+
+    def rebuild(catalog):
+        """Populate docids from a full evaluation of query."""
+
+    def update(catalog, docid, uid):
+        """Test indexed docid against query, adding or removing it."""
+
+    def remove(catalog, docid, uid):
+        """Remove an unindexed docid, if a member."""
+
+
+class ISavedQueryEvent(Interface):
+    """Membership of a saved query changed for a record."""
+
+    catalog = schema.Object(title=u'Catalog', schema=ISimpleCatalog)
+
+    saved = schema.Object(title=u'Saved query', schema=ISavedQuery)
+
+    uid = schema.BytesLine(title=u'UID of record')
+
+
+class ISavedQueryEntered(ISavedQueryEvent):
+    """Record now matches saved query."""
+
+
+class ISavedQueryLeft(ISavedQueryEvent):
+    """Record no longer matches saved query."""
+
+
+class ICatalogReplica(Interface):
+    """
+    Non-persistent, read-only in-memory replica of an ISimpleCatalog,
+    answering the same query API without loading persistent index
+    data (except for index types that are not replicated).
+    """
+
+    catalog = schema.Object(
+        title=u'Catalog',
+        description=u'The replicated catalog.',
+        schema=ISimpleCatalog,
+        )
+
+    auto_refresh = schema.Bool(
+        title=u'Refresh before each query?',
+        default=True,
+        )
+
+    def refresh():
+        """
+        Rebuild the replica of each index of the catalog (and the UID
+        table) for which the generation counter of the persistent
+        index (or UUID mapper) has changed since last built.
+        """
+
+    def query(*args, **kwargs):
+        """Query, with same semantics as ISimpleCatalog.query()."""
+
+    def rcount(*args, **kwargs):
+        """Query result count, same as ISimpleCatalog.rcount()."""
+
+    __call__ = query
+
+
+class IShardedCatalog(Interface):
+    """
+    Facade over several ISimpleCatalog shards (possibly stored in
+    separate databases), partitioning records by stable hash of UID.
+    Indexing is delegated to the shard owning a record; queries are
+    scattered to all shards, and their results gathered into a single
+    ISearchResult.
+    """
+
+    shards = schema.Tuple(
+        title=u'Shards',
+        description=u'Sequence of ISimpleCatalog shards; the number of '
+                    u'shards must not change after records are indexed.',
+        value_type=schema.Object(schema=ISimpleCatalog),
+        )
+
+    def shard_for(uid):
+        """Return the shard owning the record with given UID."""
+
+    def index(obj):
+        """Index object in its owning shard."""
+
+    def reindex(obj=None):
+        """Reindex object in its owning shard, or reindex all shards."""
+
+    def unindex(spec):
+        """Unindex object or UID from its owning shard."""
+
+    def query(*args, **kwargs):
+        """
+        Query all shards, with same semantics as ISimpleCatalog.query(),
+        merging results into one ISearchResult.  With sort_index, the
+        merged result is ordered by the sort index value across shards,
+        and limit is applied to the merged result.
+        """
+
+    def rcount(*args, **kwargs):
+        """Query result count, summed across all shards."""
+
+    __call__ = query
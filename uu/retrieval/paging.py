@@ -0,0 +1,95 @@
+"""
+Keyset (cursor) pagination of query results sorted by a field index:
+each page resumes from the (sort value, docid) position of the last
+result of the previous page, by walking the forward index of the sort
+index from that position, so the cost of a page does not depend on
+how deep into the results it is.
+"""
+
+import base64
+import json
+
+from uu.retrieval.bitmap import BitmapPostings
+from uu.retrieval.indexing import FieldIndex
+from uu.retrieval.utils import key_before
+
+
+def encode_cursor(value, docid):
+    """Opaque (URL-safe) cursor string for sort value and docid"""
+    return base64.urlsafe_b64encode(json.dumps([value, docid]))
+
+
+def decode_cursor(cursor):
+    """Decode cursor into (sort value, docid) pair, or raise ValueError"""
+    try:
+        value, docid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor: %r' % (cursor,))
+    if isinstance(value, list):
+        value = tuple(value)  # composite index value
+    if not isinstance(docid, (int, long)):
+        raise ValueError('invalid cursor: %r' % (cursor,))
+    return value, docid
+
+
+def _values(fwd, start, reverse):
+    """Iterate sort values in order from start (inclusive), or all"""
+    if not reverse:
+        for value in fwd.keys(min=start):
+            yield value
+        return
+    if start is None:
+        if not fwd:
+            return
+        start = fwd.maxKey()
+    elif start not in fwd:
+        start = key_before(fwd, start)
+    while start is not None:
+        yield start
+        start = key_before(fwd, start)  # predecessor, O(log n)
+
+
+def _reverse(postings, after):
+    """docids of TreeSet postings, descending, before docid after"""
+    docid = postings.maxKey() if after is None else key_before(postings, after)
+    while docid is not None:
+        yield docid
+        docid = key_before(postings, docid)
+
+
+def _docids(postings, after, reverse):
+    """docids of postings in order, after (excluding) docid after"""
+    if isinstance(postings, BitmapPostings):
+        return postings.walk(after, reverse)
+    if reverse:
+        return _reverse(postings, after)
+    return (
+        postings.keys() if after is None else
+        postings.keys(min=after, excludemin=True)
+        )
+
+
+def page(index, docids, limit, reverse=False, cursor=None):
+    """
+    Get one page of at most limit docids, from docids (a set of query
+    results) ordered by their value in field index, starting after the
+    position encoded in cursor (or from the start, if None).  Returns
+    a list of docids and the cursor for the next page (None if there
+    are no more results; a full last page still gets a cursor, for an
+    empty next page).  Records without a value are not included.
+    """
+    if not isinstance(index, FieldIndex):
+        raise ValueError('cursor pagination requires a field sort index')
+    start, after = None, None
+    if cursor is not None:
+        start, after = decode_cursor(cursor)
+    fwd = index._fwd_index
+    result = []
+    for value in _values(fwd, start, reverse):
+        resume = after if value == start else None
+        for docid in _docids(fwd[value], resume, reverse):
+            if docid in docids:
+                result.append(docid)
+                if len(result) == limit:
+                    return result, encode_cursor(value, docid)
+    return result, None
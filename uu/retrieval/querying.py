@@ -0,0 +1,573 @@
+from collections import OrderedDict
+
+from repoze.catalog.indexes.common import CatalogIndex
+from repoze.catalog.indexes.field import CatalogFieldIndex
+from repoze.catalog.indexes.keyword import CatalogKeywordIndex
+from repoze.catalog.query import Comparator, BoolOp, And, Or, Not, Query
+from repoze.catalog.query import Eq, NotEq, Any, NotAny, All
+from repoze.catalog.query import Gt, Ge, Lt, Le, InRange, NotInRange
+from repoze.catalog.query import Name, _Range, parse_query
+
+from uu.retrieval.bitmap import Bitmap, BitmapPostings
+
+
+class IsEmpty(Comparator):
+    """
+    Query for records without any value for an index.  Answered by
+    each index directly from its set of docids with missing values.
+    """
+
+    operator = 'is empty'
+
+    def __init__(self, index_name, value=None):
+        super(IsEmpty, self).__init__(index_name, value)
+
+    def _apply(self, catalog, names):
+        index = self._get_index(catalog)
+        return index.applyIsEmpty()
+
+    def __str__(self):
+        return '%s is empty' % self.index_name
+
+    def negate(self):
+        return NotEmpty(self.index_name)
+
+
+class NotEmpty(Comparator):
+    """
+    Query for records having any value for an index.
+    """
+
+    operator = 'is not empty'
+
+    def __init__(self, index_name, value=None):
+        super(NotEmpty, self).__init__(index_name, value)
+
+    def _apply(self, catalog, names):
+        index = self._get_index(catalog)
+        return index.applyNotEmpty()
+
+    def __str__(self):
+        return '%s is not empty' % self.index_name
+
+    def negate(self):
+        return IsEmpty(self.index_name)
+
+
+def route_composites(q, composites):
+    """
+    Query planning: replace equality clauses of each And query within
+    q with a single Eq query against a composite index, where Eq
+    clauses exist for all components of that composite index.
+
+    composites is a sequence of (index name, component index names)
+    pairs; composites with more components are preferred.  Values of
+    q are expected to be normalized already.  Returns q (modified
+    in-place) or a replacement query for q.
+    """
+    if isinstance(q, BoolOp):
+        q.queries = [route_composites(subq, composites) for subq in q.queries]
+    elif isinstance(q, Not):
+        q.query = route_composites(q.query, composites)
+    if not isinstance(q, And):
+        return q
+    queries = list(q.queries)
+    for name, components in sorted(composites, key=lambda c: -len(c[1])):
+        matched = {}
+        for subq in queries:
+            if type(subq) is Eq and subq.index_name in components:
+                matched.setdefault(subq.index_name, subq)
+        if len(matched) != len(components):
+            continue
+        used = [id(subq) for subq in matched.values()]
+        queries = [subq for subq in queries if id(subq) not in used]
+        value = tuple(matched[component]._value for component in components)
+        queries.insert(0, Eq(name, value))
+    if len(queries) == 1:
+        return queries[0]
+    q.queries = queries
+    return q
+
+
+def _intersection(results, IF):
+    bitmaps = [r for r in results if isinstance(r, Bitmap)]
+    others = [r for r in results if not isinstance(r, Bitmap)]
+    bitmap = Bitmap.intersection(bitmaps) if bitmaps else None
+    result = None
+    for other in sorted(others, key=len):
+        if result is None:
+            result = other
+            continue
+        _, result = IF.weightedIntersection(result, other)
+    if result is None:
+        return bitmap
+    if bitmap is None:
+        return result
+    # mixed: probe members of smaller result in the larger one:
+    if len(result) <= len(bitmap):
+        return IF.Set([docid for docid in result if docid in bitmap])
+    return IF.Set([docid for docid in bitmap if docid in result])
+
+
+def _union(results, IF):
+    if any(isinstance(r, Bitmap) for r in results):
+        # mixed: other results join the bitmap union (chunk by chunk):
+        return Bitmap.union(
+            r if isinstance(r, Bitmap) else Bitmap(r) for r in results
+            )
+    result = results[0]
+    for other in results[1:]:
+        _, result = IF.weightedUnion(result, other)
+    return result
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    if isinstance(value, Name):
+        return ('name', value.name)
+    return value
+
+
+def query_key(q):
+    """
+    Hashable key for (normalized) query q, equal for structurally
+    identical queries; the operand order of And / Or is ignored.
+    """
+    if isinstance(q, Not):
+        return ('Not', query_key(q.query))
+    if isinstance(q, BoolOp):
+        return (type(q).__name__, frozenset(query_key(s) for s in q.queries))
+    if isinstance(q, _Range):
+        return (
+            type(q).__name__,
+            q.index_name,
+            _freeze(q._start),
+            _freeze(q._end),
+            q.start_exclusive,
+            q.end_exclusive,
+            )
+    return (type(q).__name__, q.index_name, _freeze(q._value))
+
+
+class SubqueryCache(object):
+    """
+    Memo of results of distinct sub-queries, by query_key(), shared by
+    evaluate() calls for a batch of queries; hits and misses count the
+    sub-queries answered from the memo, and those evaluated.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+
+class ClauseCache(object):
+    """
+    Bounded (least recently used) cache of leaf clause results, keyed
+    by query_key() of the clause, each entry tagged with the generation
+    of the clause index when computed; an entry is only used while the
+    generation of its index is unchanged.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, generation):
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] != generation:
+            self.misses += 1
+            return None
+        self.entries[key] = entry  # most recently used, last
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, generation, result):
+        self.entries.pop(key, None)
+        self.entries[key] = (generation, result)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def apply_clause(q, catalog, names=None):
+    """
+    Apply leaf clause (comparator) q to catalog, using the clause cache
+    of catalog, if it has one (Indexer.apply_clause()).
+    """
+    apply = getattr(catalog, 'apply_clause', None)
+    if apply is None:
+        return q._apply(catalog, names)
+    return apply(q, names)
+
+
+def evaluate(q, catalog, names=None, cache=None):
+    """
+    Evaluate query q against catalog (Indexer), with results like
+    those of q._apply(catalog, names), except that And, Or, and Not
+    are evaluated here: Bitmap results (from indexes using bitmap
+    postings) are combined bitmap-to-bitmap, and only other results
+    are combined using BTrees set operations.
+
+    If a SubqueryCache is passed as cache, each distinct sub-query
+    (at any level) is evaluated once, then reused from the cache.
+    """
+    if cache is None:
+        return _evaluate(q, catalog, names, cache)
+    key = query_key(q)
+    if key in cache.results:
+        cache.hits += 1
+        return cache.results[key]
+    cache.misses += 1
+    result = cache.results[key] = _evaluate(q, catalog, names, cache)
+    return result
+
+
+def _evaluate(q, catalog, names, cache):
+    if isinstance(q, Not):
+        return evaluate(q.query.negate(), catalog, names, cache)
+    if not isinstance(q, (And, Or)):
+        return apply_clause(q, catalog, names)
+    IF = catalog.family.IF
+    results = []
+    for subq in q.queries:
+        result = evaluate(subq, catalog, names, cache)
+        if isinstance(q, And) and not len(result):
+            return IF.Set()
+        if len(result):
+            results.append(result)
+    if not results:
+        return IF.Set()
+    if isinstance(q, And):
+        return _intersection(results, IF)
+    return _union(results, IF)
+
+
+def _in_range(value, start, end, start_exclusive, end_exclusive):
+    if start is not None:
+        if value < start or (start_exclusive and value == start):
+            return False
+    if end is not None:
+        if value > end or (end_exclusive and value == end):
+            return False
+    return True
+
+
+def query_values(value):
+    """
+    Values of a multi-valued (Any, NotAny, All) clause: a single string
+    is one value, as for repoze.catalog keyword indexes.
+    """
+    if isinstance(value, basestring):
+        return [value]
+    return value
+
+
+# predicates on the value indexed for one document, by index type, each
+# given the value and the operand of the clause (see _operand()):
+_FIELD_PREDICATES = {
+    Eq: lambda v, x: v == x,
+    NotEq: lambda v, x: v != x,
+    Any: lambda v, x: v in x,
+    NotAny: lambda v, x: v not in x,
+    Gt: lambda v, x: v > x,
+    Ge: lambda v, x: v >= x,
+    Lt: lambda v, x: v < x,
+    Le: lambda v, x: v <= x,
+    InRange: lambda v, q: _in_range(
+        v, q._start, q._end, q.start_exclusive, q.end_exclusive),
+    NotInRange: lambda v, q: not _in_range(
+        v, q._start, q._end, q.start_exclusive, q.end_exclusive),
+    }
+
+_KEYWORD_PREDICATES = {
+    Eq: lambda words, x: x in words,
+    NotEq: lambda words, x: x not in words,
+    Any: lambda words, x: not x.isdisjoint(words),
+    NotAny: lambda words, x: x.isdisjoint(words),
+    All: lambda words, x: x.issubset(words),
+    }
+
+# negations match documents with a missing value:
+_NEGATIONS = (NotEq, NotAny, NotInRange)
+
+
+def _operand(q):
+    """Operand of leaf clause q for predicates, prepared once"""
+    if isinstance(q, (InRange, NotInRange)):
+        return q
+    if isinstance(q, (Any, NotAny, All)):
+        return frozenset(query_values(q._value))
+    return q._value
+
+
+def predicate(q, index):
+    """
+    Return a function of docid testing whether the value indexed for
+    that document alone, in field (including date, composite) or
+    keyword index, satisfies leaf clause q; or None for unsupported
+    index types or comparators (e.g. text).
+    """
+    predicates = {}
+    if isinstance(index, CatalogFieldIndex):
+        predicates = _FIELD_PREDICATES
+    elif isinstance(index, CatalogKeywordIndex):
+        predicates = _KEYWORD_PREDICATES
+    if predicates and isinstance(q, (IsEmpty, NotEmpty)):
+        empty = isinstance(q, IsEmpty)
+        return lambda docid: (docid in index._not_indexed) == empty
+    test = predicates.get(type(q))
+    if test is None:
+        return None
+    rev, missing = index._rev_index, index._not_indexed
+    negation = isinstance(q, _NEGATIONS)
+    operand = _operand(q)
+
+    def _predicate(docid):
+        value = rev.get(docid)
+        if value is None:
+            return negation and docid in missing
+        return test(value, operand)
+    return _predicate
+
+
+def matches(q, catalog, docid):
+    """
+    Does the document docid match query q, evaluated against catalog
+    (Indexer)?  For field (including date, composite) and keyword
+    indexes, comparators are tested against the value indexed for
+    docid alone, instead of evaluating q over all documents; other
+    comparators (e.g. text) fall back to membership of docid in the
+    comparator result.
+    """
+    if isinstance(q, Not):
+        return matches(q.query.negate(), catalog, docid)
+    if isinstance(q, And):
+        return all(matches(subq, catalog, docid) for subq in q.queries)
+    if isinstance(q, Or):
+        return any(matches(subq, catalog, docid) for subq in q.queries)
+    test = predicate(q, catalog[q.index_name])
+    if test is None:
+        return docid in apply_clause(q, catalog)
+    return test(docid)
+
+
+# restriction probed per docid when this many times smaller than index:
+WITHIN_PROBE_RATIO = 16
+
+
+def evaluate_within(q, catalog, within, names=None):
+    """
+    Evaluate query q against catalog (Indexer), restricted to the docids
+    in within (a set).  Leaf clauses on field and keyword indexes probe
+    the value indexed for each restricted docid, if the restriction is
+    much smaller than the index; other clauses are evaluated as usual,
+    then intersected with the restriction.  Each clause of an And is
+    restricted to the result of the clauses before it.
+    """
+    IF = catalog.family.IF
+    if isinstance(q, Not):
+        return evaluate_within(q.query.negate(), catalog, within, names)
+    if isinstance(q, And):
+        for subq in q.queries:
+            within = evaluate_within(subq, catalog, within, names)
+            if not len(within):
+                break
+        return within
+    if isinstance(q, Or):
+        results = [
+            evaluate_within(subq, catalog, within, names)
+            for subq in q.queries
+            ]
+        results = [r for r in results if len(r)]
+        return _union(results, IF) if results else IF.Set()
+    index = catalog[q.index_name]
+    test = None if names else predicate(q, index)
+    if test is not None and \
+            len(within) * WITHIN_PROBE_RATIO < index.documentCount():
+        return IF.Set([docid for docid in within if test(docid)])
+    result = apply_clause(q, catalog, names)
+    if not len(result):
+        return IF.Set()
+    return _intersection([result, within], IF)
+
+
+# legacy sentinel indexed for missing values, before migrate_missing():
+LEGACY_MISSING = float('inf')
+
+
+def _has_prefix(value, prefix):
+    if isinstance(prefix, tuple):
+        return isinstance(value, tuple) and value[:len(prefix)] == prefix
+    return isinstance(value, basestring) and value.startswith(prefix)
+
+
+def _value_counts(index, docids):
+    """Map of value to count of docids, from reverse index of index"""
+    counts = {}
+    for docid in docids:
+        value = index._rev_index.get(docid)
+        if value is None:
+            continue
+        values = value if isinstance(index, CatalogKeywordIndex) else (value,)
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def distinct_values(index, docids=None, with_counts=False, prefix=None,
+                    limit=None, start=None, end=None):
+    """
+    List distinct values indexed by field or keyword index, in order,
+    walking keys of its forward index (starting from prefix, a string
+    or composite tuple prefix, if given); if with_counts is true, list
+    (value, count) pairs.  If docids (a query result) is given, only
+    values of those docids are listed, and counted; when docids are
+    much fewer than the records of the index, the value of each of
+    them is read instead.  Only values in the inclusive range of start
+    and end (as indexed, each None for an open end) are listed, and
+    at most limit values.  Missing values (and the legacy float('inf')
+    sentinel) are not listed.
+    """
+    if limit is not None and limit <= 0:
+        return []
+    IF = index.family.IF
+    if docids is not None and \
+            len(docids) * WITHIN_PROBE_RATIO < index.documentCount():
+        counts = _value_counts(index, docids)
+        values = [
+            v for v in sorted(counts)
+            if (prefix is None or _has_prefix(v, prefix)) and
+            (start is None or v >= start) and (end is None or v <= end)
+            ]
+        pairs = ((value, counts[value]) for value in values)
+    else:
+        pairs = _walk_counts(index, docids, prefix, start, end, IF)
+    result = []
+    for value, count in pairs:
+        if value == LEGACY_MISSING or not count:
+            continue
+        result.append((value, count) if with_counts else value)
+        if len(result) == limit:
+            break
+    return result
+
+
+def _walk_counts(index, docids, prefix, start, end, IF):
+    fwd = index._fwd_index
+    if start is None or (prefix is not None and prefix > start):
+        start = prefix
+    for value in fwd.keys(min=start, max=end):
+        if prefix is not None and not _has_prefix(value, prefix):
+            break
+        postings = fwd[value]
+        if docids is None:
+            yield value, len(postings)
+            continue
+        if isinstance(postings, BitmapPostings):
+            postings = postings.bitmap()
+        yield value, len(_intersection([postings, docids], IF))
+
+
+# limits on query strings from untrusted sources, parse_text(safe=True):
+SAFE_MAX_LENGTH = 4096
+SAFE_MAX_CLAUSES = 64
+
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')  # literals of parsed text are bytes
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_decode(v) for v in value)
+    return value
+
+
+def _clauses(q):
+    if isinstance(q, BoolOp):
+        return sum((_clauses(subq) for subq in q.queries), [])
+    if isinstance(q, Not):
+        return _clauses(q.query)
+    return [q]
+
+
+def _has_name(value):
+    if isinstance(value, (list, tuple)):
+        return any(_has_name(v) for v in value)
+    return isinstance(value, Name)
+
+
+def _supports(index, comparator):
+    """Does index implement comparator (not just the base class stub)?"""
+    name = 'apply%s' % comparator.__name__
+    method = getattr(type(index), name, None)
+    if method is None:
+        return False
+    stub = getattr(CatalogIndex, name, None)  # raises NotImplementedError
+    return stub is None or method.im_func is not stub.im_func
+
+
+def check_safe(q, catalog):
+    """
+    Raise ValueError unless every clause of q is on an index of catalog
+    (Indexer) supporting its comparator, with literal values only (no
+    Name placeholders), and q has at most SAFE_MAX_CLAUSES clauses.
+    """
+    clauses = _clauses(q)
+    if len(clauses) > SAFE_MAX_CLAUSES:
+        raise ValueError('query has too many clauses')
+    for clause in clauses:
+        index = catalog.get(clause.index_name)
+        if index is None:
+            raise ValueError('unknown index: %s' % clause.index_name)
+        if not _supports(index, type(clause)):
+            raise ValueError('%s not supported by index %s' % (
+                type(clause).__name__, clause.index_name))
+        if isinstance(clause, _Range):
+            values = [clause._start, clause._end]
+        else:
+            values = clause._value
+        if _has_name(values):
+            raise ValueError('query names are not allowed')
+
+
+def parse_text(text, catalog=None, safe=False):
+    """
+    Parse CQE (repoze.catalog query expression) text into a query
+    object, with string literals as unicode; raises ValueError for text
+    that is not a valid query.  If safe, text (e.g. from an untrusted
+    source) is limited to SAFE_MAX_LENGTH characters, and the query is
+    checked against catalog (Indexer) by check_safe().
+    """
+    if safe and len(text) > SAFE_MAX_LENGTH:
+        raise ValueError('query text too long')
+    try:
+        q = parse_query(text)
+    except (SyntaxError, MemoryError, RuntimeError, TypeError), e:
+        raise ValueError('invalid query text: %s' % (e,))
+    if not isinstance(q, Query):
+        raise ValueError('query text is not a query: %r' % (text,))
+    for clause in _clauses(q):
+        if isinstance(clause, _Range):
+            clause._start = _decode(clause._start)
+            clause._end = _decode(clause._end)
+        else:
+            clause._value = _decode(clause._value)
+    if safe:
+        check_safe(q, catalog)
+    return q
@@ -0,0 +1,144 @@
+"""
+Parallel full reindex of a SimpleCatalog.
+
+Discrimination of index values (resolving each object, getting and
+normalizing its field values, splitting and normalizing text) is the
+CPU-bound part of a full reindex; parallel_reindex() spreads this
+across a pool of worker processes, each reading from its own database
+connection, while the calling process (the single writer) applies the
+compact results to the indexes of its catalog.  Word ids are assigned
+(in the shared lexicon) and Okapi word info updated by the writer, in
+one batch per text index, from the word lists made by workers.
+
+Each worker gets the catalog by calling open_catalog, a picklable
+(module-level) callable opening its own connection (e.g. to a ZEO
+server) and returning the same catalog as loaded in that connection.
+"""
+
+import multiprocessing
+
+from uu.retrieval.indexing import TextIndex, _marker
+
+
+_worker_catalog = None  # catalog loaded in each worker process
+
+
+def docid_ranges(catalog, count):
+    """
+    Split docids of catalog into (at most) count contiguous, inclusive
+    (min, max) ranges of roughly equal size.
+    """
+    docids = list(catalog.uidmap.docid_to_uuid.keys())
+    size = max(1, -(-len(docids) // max(1, count)))  # ceiling
+    return [
+        (docids[i], docids[min(i + size, len(docids)) - 1])
+        for i in range(0, len(docids), size)
+        ]
+
+
+def discriminate(catalog, docid_range):
+    """
+    Discriminate values of every index for objects in catalog with
+    docids in the inclusive (min, max) docid_range.  Returns a list
+    of (docid, uid, values) tuples, where values maps index name to
+    value (None if missing), or is None for stale (unresolvable)
+    UIDs.  Text values are split and normalized into word lists by
+    the pipeline of the index lexicon.
+    """
+    lo, hi = docid_range
+    result = []
+    indexes = catalog.indexer.items()
+    for docid, uid in catalog.uidmap.docid_to_uuid.items(lo, hi):
+        obj = catalog.get(uid)
+        if obj is None:
+            result.append((docid, uid, None))
+            continue
+        values = {}
+        for name, idx in indexes:
+            value = idx.discriminate(obj)
+            if value is _marker:
+                value = None
+            elif isinstance(idx, TextIndex):
+                words = [value]
+                for element in idx.lexicon._pipeline:
+                    words = element.process(words)
+                value = words
+            values[name] = value
+        result.append((docid, uid, values))
+    return result
+
+
+def _init_worker(open_catalog):
+    global _worker_catalog
+    _worker_catalog = open_catalog()
+
+
+def _work(docid_range):
+    return discriminate(_worker_catalog, docid_range)
+
+
+def apply_values(catalog, results):
+    """
+    Apply (docid, uid, values) results of discriminate() to the indexes
+    of catalog; stale UIDs are unindexed.  Word lists for text indexes
+    are applied in one batch per index (TextIndex.index_words()), not
+    passed through the lexicon pipeline again.  Returns count of
+    records.
+    """
+    count = 0
+    words = {}  # text index name to list of (docid, words)
+    indexed = []
+    for docid, uid, values in results:
+        count += 1
+        if values is None:
+            if uid in catalog.uidmap:
+                catalog.unindex(uid)
+            continue
+        for name, value in values.items():
+            idx = catalog.indexer.get(name)
+            if idx is None:
+                continue  # index removed since discrimination
+            if isinstance(idx, TextIndex) and value is not None:
+                words.setdefault(name, []).append((docid, value))
+                continue
+            idx.index_value(docid, _marker if value is None else value)
+        indexed.append((docid, uid))
+    for name, items in words.items():
+        catalog.indexer[name].index_words(items)
+    for docid, uid in indexed:
+        catalog._update_saved(docid, uid)  # after all indexes are updated
+    return count
+
+
+def parallel_reindex(catalog, open_catalog, processes=None, chunks=None):
+    """
+    Reindex all records of catalog, discriminating values in a pool of
+    processes (default: CPU count), with docids split into chunks
+    ranges (default: four per process) handed to workers as they go
+    idle.  If processes is 0, discrimination runs in this process,
+    using catalog.  Returns count of records reindexed.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    ranges = docid_ranges(catalog, chunks or max(1, processes) * 4)
+    if not processes:
+        return sum(
+            apply_values(catalog, discriminate(catalog, docid_range))
+            for docid_range in ranges
+            )
+    pool = multiprocessing.Pool(
+        processes,
+        initializer=_init_worker,
+        initargs=(open_catalog,),
+        )
+    try:
+        count = 0
+        for results in pool.imap_unordered(_work, ranges):
+            count += apply_values(catalog, results)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return count
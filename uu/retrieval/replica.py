@@ -0,0 +1,258 @@
+from bisect import bisect_left, bisect_right
+
+from repoze.catalog.catalog import ResultSetSize
+from zope.interface import implements
+import BTrees
+
+from uu.retrieval.bitmap import Bitmap, BitmapPostings
+from uu.retrieval.catalog import make_query, query_options
+from uu.retrieval.indexing import FieldIndex, KeywordIndex
+from uu.retrieval.indexing.composite import CompositeIndex
+from uu.retrieval.interfaces import ICatalogReplica
+from uu.retrieval.querying import evaluate, query_values
+from uu.retrieval.result import SearchResult
+
+
+def _bitmap(postings):
+    if isinstance(postings, BitmapPostings):
+        return postings.bitmap()
+    return Bitmap(postings)
+
+
+class ReplicaIndexBase(object):
+    """
+    Read-only in-memory copy of a persistent index, answering the
+    same apply*() methods used by repoze.catalog comparators, with
+    Bitmap results.
+    """
+
+    def __init__(self, index):
+        self.generation = index.generation()
+        self.not_indexed = Bitmap(index._not_indexed)
+        self.all = Bitmap.union(self._postings() + [self.not_indexed])
+
+    def _negate(self, result):
+        return self.all - result
+
+    def applyIsEmpty(self):
+        return self.not_indexed
+
+    def applyNotEmpty(self):
+        return self.all - self.not_indexed
+
+    def applyNotEq(self, value):
+        return self._negate(self.applyEq(value))
+
+    def applyNotAny(self, values):
+        return self._negate(self.applyAny(values))
+
+    def applyContains(self, value):
+        raise NotImplementedError(
+            'Contains is not supported for %s' % type(self).__name__)
+
+
+class ReplicaFieldIndex(ReplicaIndexBase):
+    """
+    Replica of a field index: sorted list of distinct values, and a
+    parallel list of docid bitmaps for each value.
+    """
+
+    def __init__(self, index):
+        self.values, self.docids = [], []
+        for value, postings in index._fwd_index.items():
+            self.values.append(value)
+            self.docids.append(_bitmap(postings))
+        self._rev = None  # docid -> value, made as needed for sorting
+        super(ReplicaFieldIndex, self).__init__(index)
+
+    def _postings(self):
+        return list(self.docids)
+
+    def applyEq(self, value):
+        i = bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            return self.docids[i]
+        return Bitmap()
+
+    def applyAny(self, values):
+        return Bitmap.union(
+            self.applyEq(value) for value in query_values(values)
+            )
+
+    applyIn = applyAny
+
+    def applyInRange(self, start, end, excludemin=False, excludemax=False):
+        values = self.values
+        lo, hi = 0, len(values)
+        if start is not None:
+            lo = (bisect_right if excludemin else bisect_left)(values, start)
+        if end is not None:
+            hi = (bisect_left if excludemax else bisect_right)(values, end)
+        return Bitmap.union(self.docids[lo:hi])
+
+    def applyNotInRange(self, start, end, excludemin=False,
+                        excludemax=False):
+        return self._negate(
+            self.applyInRange(start, end, excludemin, excludemax)
+            )
+
+    def applyGe(self, min_value):
+        return self.applyInRange(min_value, None)
+
+    def applyLe(self, max_value):
+        return self.applyInRange(None, max_value)
+
+    def applyGt(self, min_value):
+        return self.applyInRange(min_value, None, excludemin=True)
+
+    def applyLt(self, max_value):
+        return self.applyInRange(None, max_value, excludemax=True)
+
+    def sort(self, docids, reverse=False, limit=None, sort_type=None):
+        if self._rev is None:
+            self._rev = {}
+            for value, bitmap in zip(self.values, self.docids):
+                for docid in bitmap:
+                    self._rev[docid] = value
+        rev = self._rev
+        result = sorted(
+            (docid for docid in docids if docid in rev),
+            key=rev.get,
+            reverse=reverse,
+            )
+        # without a value: last, or first if reverse, as FieldIndex.sort()
+        missing = [docid for docid in docids if docid in self.not_indexed]
+        result = missing + result if reverse else result + missing
+        return result[:limit] if limit else result
+
+
+class ReplicaKeywordIndex(ReplicaIndexBase):
+    """Replica of a keyword index: mapping of keyword to docid bitmap"""
+
+    def __init__(self, index):
+        self.words = dict(
+            (word, _bitmap(postings))
+            for word, postings in index._fwd_index.items()
+            )
+        super(ReplicaKeywordIndex, self).__init__(index)
+
+    def _postings(self):
+        return self.words.values()
+
+    def applyAny(self, values):
+        return Bitmap.union(
+            self.words.get(word, Bitmap()) for word in query_values(values)
+            )
+
+    applyIn = applyAny
+
+    def applyAll(self, values):
+        return Bitmap.intersection(
+            [self.words.get(word, Bitmap()) for word in query_values(values)]
+            )
+
+    def applyEq(self, value):
+        return self.applyAll([value])
+
+
+class ReplicaIndexer(dict):
+    """
+    Mapping of index name to replica index (or, for index types not
+    replicated, the persistent index itself), queried like an Indexer.
+    """
+
+    family = BTrees.family64
+
+    def query(self, queryobject, sort_index=None, limit=None,
+              sort_type=None, reverse=False, names=None):
+        result = evaluate(queryobject, self, names)
+        numdocs = total = len(result)
+        if sort_index:
+            result = self[sort_index].sort(
+                result,
+                reverse=reverse,
+                limit=limit,
+                sort_type=sort_type,
+                )
+            if limit:
+                numdocs = min(numdocs, limit)
+        return ResultSetSize(numdocs, total), result
+
+
+class CatalogReplica(object):
+    """
+    Non-persistent, read-only replica of a SimpleCatalog, built from
+    the indexes and UUID mapper of the catalog into in-memory sorted
+    value lists, docid bitmaps, and a UID table.
+
+    Field (including date and composite) and keyword indexes are
+    replicated; queries using other indexes (text) are answered by
+    the persistent index of the catalog.  Each replicated index (and
+    the UID table) is rebuilt when the generation counter of its
+    persistent counterpart has moved, checked by refresh() -- before
+    each query if auto_refresh is True.
+    """
+
+    implements(ICatalogReplica)
+
+    def __init__(self, catalog, auto_refresh=True):
+        self.catalog = catalog
+        self.auto_refresh = auto_refresh
+        self.indexer = ReplicaIndexer()
+        self.composites = ()
+        self.uids = {}
+        self._uids_generation = None
+        self.refresh()
+
+    def _replicate(self, index):
+        if isinstance(index, FieldIndex):
+            return ReplicaFieldIndex(index)
+        if isinstance(index, KeywordIndex):
+            return ReplicaKeywordIndex(index)
+        return index  # not replicated, use persistent index
+
+    def refresh(self):
+        indexer = self.catalog.indexer
+        for name in list(self.indexer.keys()):
+            if name not in indexer:
+                del self.indexer[name]
+        for name, index in indexer.items():
+            replica = self.indexer.get(name)
+            if replica is index:
+                continue  # not replicated
+            if not isinstance(replica, ReplicaIndexBase) or \
+                    replica.generation != index.generation():
+                self.indexer[name] = self._replicate(index)
+        self.composites = tuple(
+            (name, index.components) for name, index in indexer.items()
+            if isinstance(index, CompositeIndex)
+            )
+        uidmap = self.catalog.uidmap
+        if self._uids_generation != uidmap.generation():
+            self._uids_generation = uidmap.generation()
+            self.uids = dict(uidmap.docid_to_uuid.items())
+
+    def _make_result(self, result):
+        size, docids = result
+        t = tuple((docid, self.uids.get(docid)) for docid in docids)
+        result = SearchResult.fromtuples(t, resolver=self.catalog.resolver)
+        result.__parent__ = self.catalog
+        result.__name__ = 'result'
+        return result
+
+    def query(self, *args, **kwargs):
+        count_only = kwargs.pop('return_query_result_count', False)
+        options = query_options(kwargs)
+        if self.auto_refresh:
+            self.refresh()
+        _query = make_query(args, kwargs, self.composites)
+        result = self.indexer.query(_query, **options)
+        if count_only:
+            return result[0]
+        return self._make_result(result)
+
+    def rcount(self, *args, **kwargs):
+        kwargs['return_query_result_count'] = True
+        return self.query(*args, **kwargs)
+
+    __call__ = query
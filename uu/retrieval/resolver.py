@@ -78,3 +78,9 @@ class ContentContainerUIDResolver(ContentContainmentResolverBase):
     def __call__(self, uid, _context=None):
         return self.context.get(uid, None)
 
+    def get_many(self, uids):
+        get_many = getattr(self.context, 'get_many', None)
+        if get_many is not None:
+            return get_many(uids)  # e.g. UIDKeyedContainer bulk lookup
+        return [self.context.get(uid, None) for uid in uids]
+
@@ -93,6 +93,21 @@ class SearchResult(BaseCollection):
     def __getitem__(self, name):
         return super(SearchResult, self).__getitem__(name)  # needs self.get()
 
+    def values(self):
+        get_many = getattr(self.resolver, 'get_many', None)
+        if get_many is None:
+            return super(SearchResult, self).values()
+        return list(get_many(self.keys()))  # resolve items in bulk
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def export(self, stream, columns=None, format='csv'):
+        catalog = getattr(self, '__parent__', None)
+        if catalog is None or not hasattr(catalog, 'export'):
+            raise ValueError('search result has no catalog to export from')
+        return catalog.export(stream, self, columns, format)
+
     def uid_for(self, rid):
         if self._idmapper is not None:
             _lookup = self._idmapper.uid_for
@@ -0,0 +1,74 @@
+from persistent import Persistent
+from zope.event import notify
+from zope.interface import implements
+import BTrees
+
+from uu.retrieval.interfaces import ISavedQuery
+from uu.retrieval.interfaces import ISavedQueryEntered, ISavedQueryLeft
+from uu.retrieval.querying import matches
+
+
+class SavedQuery(Persistent):
+    """
+    Saved (normalized) query registered on a catalog, keeping the set
+    of docids matching it up to date as each document is indexed or
+    unindexed, by testing only the changed document.
+    """
+
+    implements(ISavedQuery)
+
+    family = BTrees.family64
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+        self.docids = self.family.IF.TreeSet()
+
+    def __len__(self):
+        return len(self.docids)
+
+    def __contains__(self, docid):
+        return docid in self.docids
+
+    def rebuild(self, catalog):
+        """Populate docids from a full evaluation of query"""
+        self.docids.clear()
+        self.docids.update(catalog.indexer.query(self.query)[1])
+
+    def update(self, catalog, docid, uid):
+        """
+        Test (newly indexed or reindexed) docid against query, adding
+        or removing it from docids, with a membership event on change.
+        """
+        if matches(self.query, catalog.indexer, docid):
+            if self.docids.insert(docid):
+                notify(SavedQueryEntered(catalog, self, uid))
+        else:
+            self.remove(catalog, docid, uid)
+
+    def remove(self, catalog, docid, uid):
+        """Remove (unindexed) docid, with event if it was a member"""
+        if docid in self.docids:
+            self.docids.remove(docid)
+            notify(SavedQueryLeft(catalog, self, uid))
+
+
+class SavedQueryEvent(object):
+    """Base class for saved query membership change events"""
+
+    def __init__(self, catalog, saved, uid):
+        self.catalog = catalog
+        self.saved = saved
+        self.uid = uid
+
+
+class SavedQueryEntered(SavedQueryEvent):
+    """Document with uid now matches saved query"""
+
+    implements(ISavedQueryEntered)
+
+
+class SavedQueryLeft(SavedQueryEvent):
+    """Document with uid no longer matches saved query"""
+
+    implements(ISavedQueryLeft)
@@ -109,6 +109,8 @@ def schema_index_types(field):
         zope.schema.interfaces.IText: ('text',),
         zope.schema.interfaces.ICollection: ('keyword',),
         zope.schema.interfaces.IChoice: ('field',),
+        zope.schema.interfaces.IDate: ('date',),
+        zope.schema.interfaces.IDatetime: ('date',),
         zope.schema.interfaces.IBytes: (),  # omit bytes fields!
         zope.schema.interfaces.IObject: (),  # omit
         zope.schema.interfaces.IDict: (),  # omit
@@ -150,8 +152,10 @@ def index_comparators(idx):
             'Ge',
             'Gt',
             'InRange',
+            'IsEmpty',
             'Le',
             'Lt',
+            'NotEmpty',
             'NotEq',
             'NotInRange',
             ),
@@ -159,12 +163,24 @@ def index_comparators(idx):
             'Any',
             'All',
             'DoesNotContain',
+            'IsEmpty',
+            'NotEmpty',
             ),
         'text': (
             'Contains',
             'DoesNotContain',
+            'IsEmpty',
+            'NotEmpty',
             ),
         }
+    comparators['date'] = comparators['field']
+    comparators['composite'] = (
+        'Any',
+        'Eq',
+        'IsEmpty',
+        'NotEmpty',
+        'NotEq',
+        )
     if idx not in comparators:
         return ()
     return comparators[idx]
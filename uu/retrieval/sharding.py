@@ -0,0 +1,167 @@
+import itertools
+from hashlib import md5
+
+from persistent import Persistent
+from plone.uuid.interfaces import IUUID
+from zope.interface import implements
+
+from uu.retrieval.catalog import SimpleCatalog, query_options
+from uu.retrieval.interfaces import IShardedCatalog
+from uu.retrieval.result import SearchResult
+from uu.retrieval.utils import normalize_uuid
+
+
+class ShardedCatalog(Persistent):
+    """
+    Facade over N SimpleCatalog shards (which may be stored in separate
+    databases), each cataloging the records whose UID hashes to it.
+
+    Indexing operations go to the owning shard; queries are run on
+    every shard, and the results merged into one search result (by
+    sort index value, if sorted).
+    """
+
+    implements(IShardedCatalog)
+
+    __name__ = 'sharded_catalog'
+
+    def __init__(self, shards):
+        shards = tuple(shards)
+        if not shards:
+            raise ValueError('sharded catalog needs one or more shards')
+        self.shards = shards
+
+    @classmethod
+    def fromcontext(cls, context, count, schema=None, **kwargs):
+        """Construct with count new SimpleCatalog shards for context"""
+        return cls(
+            SimpleCatalog(context, schema, **kwargs) for i in range(count)
+            )
+
+    def shard_for(self, uid):
+        digest = md5(str(uid)).hexdigest()
+        return self.shards[int(digest, 16) % len(self.shards)]
+
+    def _uid(self, obj):
+        if isinstance(obj, str):
+            return obj
+        return IUUID(obj)
+
+    @property
+    def resolver(self):
+        return self.get  # each item resolved by its owning shard
+
+    ## indexing methods, delegated to owning shard:
+
+    def index(self, obj):
+        self.shard_for(self._uid(obj)).index(obj)
+
+    def unindex(self, obj):
+        self.shard_for(self._uid(obj)).unindex(obj)
+
+    def reindex(self, obj=None):
+        if obj is None:
+            for shard in self.shards:
+                shard.reindex()
+        else:
+            self.shard_for(self._uid(obj)).reindex(obj)
+
+    ## mapping methods:
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get(self, key, default=None):
+        if isinstance(key, int) or isinstance(key, long):
+            # docid: not unique across shards, first shard mapping it wins
+            for shard in self.shards:
+                if shard.uidmap.get(key) is not None:
+                    return shard.get(key, default)
+            return default
+        return self.shard_for(key).get(key, default)
+
+    def __getitem__(self, key):
+        v = self.get(key, None)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, spec):
+        uid = spec
+        if not isinstance(spec, str):
+            uid = IUUID(spec, None)
+            if uid is None:
+                uid = normalize_uuid(spec)
+                if uid is None:
+                    return False
+        return uid in self.shard_for(uid)
+
+    def iterkeys(self):
+        return itertools.chain(*[shard.iterkeys() for shard in self.shards])
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return (self.get(uid) for uid in self.iterkeys())
+
+    def iteritems(self):
+        return ((uid, self.get(uid)) for uid in self.iterkeys())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    ## query methods, scatter-gather:
+
+    def _shard_results(self, args, kwargs):
+        for shard in self.shards:
+            yield shard, shard.query(*args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        count_only = kwargs.pop('return_query_result_count', False)
+        options = query_options(kwargs)
+        sort_index = options.get('sort_index')
+        limit = options.get('limit')
+        if count_only:
+            count = sum(
+                shard.rcount(*args, **kwargs)
+                for shard in self.shards
+                )
+            return min(count, limit) if limit and sort_index else count
+        kwargs.update(options)
+        pairs = []
+        if sort_index:
+            decorated = []
+            for shard, result in self._shard_results(args, kwargs):
+                values = shard.indexer[sort_index]._rev_index
+                decorated.extend(
+                    (values.get(rid), rid, result.uid_for(rid))
+                    for rid in result.record_ids(ordered=True)
+                    )
+            # stable sort: merges (already sorted) results of each shard
+            decorated.sort(
+                key=lambda d: d[0],
+                reverse=bool(options.get('reverse')),
+                )
+            pairs = [(rid, uid) for value, rid, uid in decorated[:limit]]
+        else:
+            for shard, result in self._shard_results(args, kwargs):
+                pairs.extend(
+                    (rid, result.uid_for(rid))
+                    for rid in result.record_ids(ordered=True)
+                    )
+        result = SearchResult.fromtuples(pairs, resolver=self.resolver)
+        result.__parent__ = self
+        result.__name__ = 'result'
+        return result
+
+    def rcount(self, *args, **kwargs):
+        kwargs['return_query_result_count'] = True
+        return self.query(*args, **kwargs)
+
+    __call__ = query
@@ -0,0 +1,311 @@
+"""
+Columnar snapshot export of the indexed values of a catalog, in one
+file which readers memory-map (read-only), so that several processes
+can share the same snapshot through the OS page cache.
+
+Layout: magic bytes, a JSON header, then 8-byte aligned columns of
+little-endian integers, with rows ordered by ascending docid:
+
+  * docids: int64 column;
+
+  * uids: fixed-width 36 byte (string UUID) column;
+
+  * field (and date, composite) index: int32 column of codes, each an
+    offset into the sorted value dictionary of the index (kept in the
+    JSON header), or -1 for a missing value;
+
+  * keyword index: int64 row offsets (count + 1) into an int32 column
+    of keyword codes.
+
+With numpy installed, the reader columns are zero-copy views of the
+mapped file; otherwise, columns are unpacked into tuples.
+"""
+
+import json
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from uu.retrieval.indexing import FieldIndex, KeywordIndex
+
+
+MAGIC = 'UURSNAP1'
+UID_WIDTH = 36
+_PACK_BATCH = 65536
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _pack(typecode, values):
+    """pack sequence of integers little-endian, as bytes"""
+    values = list(values)
+    return ''.join(
+        struct.pack(
+            '<%d%s' % (len(values[i:i + _PACK_BATCH]), typecode),
+            *values[i:i + _PACK_BATCH]
+            )
+        for i in range(0, len(values), _PACK_BATCH)
+        )
+
+
+def _dictionary_value(v):
+    # JSON arrays in dictionary are composite index (tuple) values:
+    return tuple(v) if isinstance(v, list) else v
+
+
+def export_snapshot(catalog, path, names=None):
+    """
+    Write snapshot of the UUID mapper and the field/keyword indexes of
+    catalog (or those indexes named in names) to a file at path.
+    Text indexes are not exported.
+    """
+    docid_to_uuid = catalog.uidmap.docid_to_uuid
+    docids = list(docid_to_uuid.keys())  # sorted
+    rows = dict((docid, row) for row, docid in enumerate(docids))
+    columns = []  # (typecode, packed data) pairs
+
+    def _add(typecode, values):
+        columns.append(_pack(typecode, values))
+        return len(columns) - 1
+
+    uids = ''.join(str(uid) for uid in docid_to_uuid.values())
+    if len(uids) != UID_WIDTH * len(docids):
+        raise ValueError('catalog UIDs are not normalized UUID strings')
+    header = {
+        'count': len(docids),
+        'docids': _add('q', docids),
+        'uids': len(columns),
+        'indexes': {},
+        }
+    columns.append(uids)
+    for name, idx in sorted(catalog.indexer.items()):
+        if names is not None and name not in names:
+            continue
+        if not isinstance(idx, (FieldIndex, KeywordIndex)):
+            continue
+        dictionary = list(idx._fwd_index.keys())
+        code = dict((value, i) for i, value in enumerate(dictionary))
+        spec = header['indexes'][name] = {'dictionary': dictionary}
+        if isinstance(idx, FieldIndex):
+            codes = [-1] * len(docids)
+            for docid, value in idx._rev_index.items():
+                row = rows.get(docid)
+                if row is not None:
+                    codes[row] = code[value]
+            spec['type'] = 'field'
+            spec['codes'] = _add('i', codes)
+        else:
+            codes, offsets = [], [0]
+            for docid in docids:
+                codes.extend(code[word] for word in idx._rev_index.get(
+                    docid, ()))
+                offsets.append(len(codes))
+            spec['type'] = 'keyword'
+            spec['codes'] = _add('i', codes)
+            spec['offsets'] = _add('q', offsets)
+    # column offsets, relative to start of data after header:
+    offsets, position = [], 0
+    for data in columns:
+        offsets.append(position)
+        position += _align(len(data))
+    header['columns'] = offsets
+    header = json.dumps(header)
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write('\0' * (_align(f.tell()) - f.tell()))
+        for data in columns:
+            f.write(data)
+            f.write('\0' * (_align(len(data)) - len(data)))
+
+
+class Snapshot(object):
+    """
+    Reader for a snapshot file written by export_snapshot(); rows are
+    numbered 0 .. len(snapshot) - 1, in docid order.
+
+    Selections of rows (from select()) are ascending sequences of row
+    numbers, and can be passed as rows to further select() calls (to
+    intersect), to counts() (to aggregate), or to uids() and values().
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a catalog snapshot file: %s' % path)
+        start = len(MAGIC) + 4
+        (size,) = struct.unpack_from('<I', self._map, len(MAGIC))
+        header = json.loads(self._map[start:start + size])
+        self._data = _align(start + size)
+        self._columns = header['columns']
+        self._count = header['count']
+        self._indexes = header['indexes']
+        for spec in self._indexes.values():
+            spec['dictionary'] = map(_dictionary_value, spec['dictionary'])
+        self._uids = self._data + self._columns[header['uids']]
+        self.docids = self._column(header['docids'], 'q', self._count)
+
+    def _column(self, column, typecode, count):
+        offset = self._data + self._columns[column]
+        if numpy is not None:
+            dtype = {'q': '<i8', 'i': '<i4'}[typecode]
+            return numpy.frombuffer(
+                self._map,
+                dtype=dtype,
+                count=count,
+                offset=offset,
+                )
+        return struct.unpack_from('<%d%s' % (count, typecode), self._map,
+                                  offset)
+
+    def _codes(self, name):
+        spec = self._indexes[name]
+        if spec['type'] == 'field':
+            return self._column(spec['codes'], 'i', self._count), None
+        offsets = self._column(spec['offsets'], 'q', self._count + 1)
+        return self._column(spec['codes'], 'i', offsets[-1]), offsets
+
+    def _all(self):
+        if numpy is not None:
+            return numpy.arange(self._count)
+        return range(self._count)
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def names(self):
+        return sorted(self._indexes.keys())
+
+    def dictionary(self, name):
+        """Sorted list of distinct values of index name"""
+        return self._indexes[name]['dictionary']
+
+    def uid(self, row):
+        start = self._uids + row * UID_WIDTH
+        return self._map[start:start + UID_WIDTH]
+
+    def uids(self, rows=None):
+        rows = self._all() if rows is None else rows
+        return [self.uid(row) for row in rows]
+
+    def values(self, name, rows=None):
+        """
+        Values of index for rows: a value, or None, for each row of a
+        field index; a list of keywords for each row of a keyword index.
+        """
+        rows = self._all() if rows is None else rows
+        dictionary = self.dictionary(name)
+        codes, offsets = self._codes(name)
+        if offsets is None:
+            return [
+                dictionary[codes[row]] if codes[row] >= 0 else None
+                for row in rows
+                ]
+        return [
+            [dictionary[c] for c in codes[offsets[row]:offsets[row + 1]]]
+            for row in rows
+            ]
+
+    def _wanted(self, name, values, start, end):
+        """set of codes for values, or for range of values start..end"""
+        dictionary = self.dictionary(name)
+        if values is not None:
+            wanted = []
+            for value in values:
+                i = bisect_left(dictionary, value)
+                if i < len(dictionary) and dictionary[i] == value:
+                    wanted.append(i)
+            return wanted
+        lo = 0 if start is None else bisect_left(dictionary, start)
+        hi = len(dictionary)
+        if end is not None:
+            hi = bisect_right(dictionary, end)
+        return range(lo, hi)
+
+    def select(self, name, values=None, start=None, end=None, rows=None):
+        """
+        Select rows with any of values for index name (for a keyword
+        index, rows with any of values as keyword), or with any value
+        in the inclusive range start..end (either may be None).  If
+        rows is given, only select among those rows.
+        """
+        wanted = self._wanted(name, values, start, end)
+        codes, offsets = self._codes(name)
+        if numpy is not None:
+            hits = numpy.in1d(codes, wanted)
+            if offsets is None:
+                mask = hits
+            else:
+                mask = numpy.zeros(self._count, dtype=bool)
+                owners = numpy.searchsorted(
+                    offsets,
+                    numpy.nonzero(hits)[0],
+                    side='right',
+                    ) - 1
+                mask[owners] = True
+            if rows is None:
+                return numpy.nonzero(mask)[0]
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+            return rows[mask[rows]]
+        wanted = set(wanted)
+        rows = self._all() if rows is None else rows
+        if offsets is None:
+            return [row for row in rows if codes[row] in wanted]
+        return [
+            row for row in rows
+            if wanted.intersection(codes[offsets[row]:offsets[row + 1]])
+            ]
+
+    def counts(self, name, rows=None):
+        """
+        Aggregate count of rows (all, or those given) by value of index
+        name, as a dict of value to count; rows with a missing value of
+        a field index are counted for None.
+        """
+        dictionary = self.dictionary(name)
+        codes, offsets = self._codes(name)
+        if numpy is not None:
+            if offsets is None:
+                selected = codes if rows is None else codes[rows]
+            elif rows is None:
+                selected = codes
+            else:
+                lengths = numpy.diff(offsets)
+                owners = numpy.repeat(numpy.arange(self._count), lengths)
+                mask = numpy.zeros(self._count, dtype=bool)
+                mask[rows] = True
+                selected = codes[mask[owners]]
+            tally = numpy.bincount(
+                selected + 1,
+                minlength=len(dictionary) + 1,
+                )
+            tally = tally.tolist()
+        else:
+            tally = [0] * (len(dictionary) + 1)
+            rows = self._all() if rows is None else rows
+            for row in rows:
+                if offsets is None:
+                    tally[codes[row] + 1] += 1
+                    continue
+                for c in codes[offsets[row]:offsets[row + 1]]:
+                    tally[c + 1] += 1
+        result = dict(
+            (value, count) for value, count in zip(dictionary, tally[1:])
+            if count
+            )
+        if tally[0]:
+            result[None] = tally[0]
+        return result
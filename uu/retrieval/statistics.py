@@ -0,0 +1,302 @@
+"""
+Storage footprint and structure statistics of catalog indexes and the
+UUID map.
+
+BTree shape (depth, internal node and bucket counts) is read from the
+internal nodes only; buckets are loaded to count items, persistent
+objects and pickled size, either all of them (exact) or an evenly
+spaced sample of at most a given number of buckets per tree, from
+which counts and sizes are extrapolated.  Statistics are computed one
+index at a time, so they can be gathered incrementally.
+"""
+
+import cPickle
+import heapq
+from cStringIO import StringIO
+
+from persistent import Persistent
+
+from uu.retrieval.indexing import TextIndex
+
+
+TOP = 10  # number of largest values listed
+
+
+def _persistent_id(obj):
+    if isinstance(obj, Persistent):
+        return obj._p_oid or '\0' * 8  # reference, as in a database record
+    return None
+
+
+def pickled_size(obj):
+    """Estimated size of the database record (pickled state) of obj"""
+    stream = StringIO()
+    pickler = cPickle.Pickler(stream, 1)
+    pickler.persistent_id = _persistent_id
+    pickler.dump((type(obj).__module__, type(obj).__name__))
+    pickler.dump(obj.__getstate__())
+    return len(stream.getvalue())
+
+
+def _is_tree(obj):
+    return hasattr(obj, '_bucket_type')
+
+
+def _shape(tree):
+    """
+    Walk internal nodes of tree, returns (depth, nodes, buckets, inline)
+    with inline the count of items kept in the root without a bucket.
+    """
+    width = 2 if hasattr(tree, 'values') else 1  # (key, value) or key
+    depth, nodes, buckets, inline = 0, [], [], 0
+    level = [tree]
+    while level:
+        depth += 1
+        nodes.extend(level)
+        below = []
+        for node in level:
+            state = node.__getstate__()
+            if state is None:
+                continue  # empty
+            if len(state) == 1:
+                # single bucket, its state inline: ((((items...),),),)
+                inline += len(state[0][0][0]) // width
+                continue
+            below.extend(state[0][::2])
+        level = [c for c in below if not isinstance(c, tree._bucket_type)]
+        buckets.extend(c for c in below if isinstance(c, tree._bucket_type))
+    if buckets:
+        depth += 1
+    return depth, nodes, buckets, inline
+
+
+def _sample(seq, size):
+    """Evenly spaced subset of at most size items of seq"""
+    if size is None or len(seq) <= size:
+        return seq
+    step = float(len(seq)) / size
+    return [seq[int(i * step)] for i in range(size)]
+
+
+class StatsWalker(object):
+    """
+    Count persistent objects and estimated pickled size of persistent
+    objects (and of the persistent objects they refer to), loading at
+    most sample buckets of each tree, or all if sample is None.  Objects
+    not in the values of a tree are counted once, however referenced.
+    """
+
+    def __init__(self, sample=None):
+        self.sample = sample
+        self._seen = set()  # ids of objects counted
+
+    def tree(self, tree, visit=None):
+        """
+        Statistics for a BTree (or TreeSet) as a dict; visit, if not
+        None, is called with each (sampled) bucket, or the tree itself
+        if it has no buckets.
+        """
+        self._seen.add(id(tree))
+        depth, nodes, buckets, inline = _shape(tree)
+        sampled = _sample(buckets, self.sample)
+        scale = float(len(buckets)) / len(sampled) if sampled else 1.0
+        objects, size = 0, 0
+        for node in nodes:
+            objects += 1
+            size += pickled_size(node)
+        if inline:
+            sub = self._values(tree, visit)
+            objects, size = objects + sub[0], size + sub[1]
+        bucket_items, bucket_objects, bucket_size = 0, 0, 0
+        for bucket in sampled:
+            sub = self._values(bucket, visit)
+            bucket_items += len(bucket)
+            bucket_objects += 1 + sub[0]
+            bucket_size += pickled_size(bucket) + sub[1]
+        return {
+            'depth': depth,
+            'nodes': len(nodes),
+            'buckets': len(buckets),
+            'items': inline + int(round(bucket_items * scale)),
+            'objects': objects + int(round(bucket_objects * scale)),
+            'size': size + int(round(bucket_size * scale)),
+            'sampled': len(sampled) < len(buckets),
+            }
+
+    def _values(self, bucket, visit):
+        objects, size = 0, 0
+        if hasattr(bucket, 'values'):
+            for value in bucket.values():
+                sub = self._object(value)
+                objects, size = objects + sub[0], size + sub[1]
+        if visit is not None:
+            visit(bucket)
+        return objects, size
+
+    def _object(self, obj):
+        if not isinstance(obj, Persistent):
+            return 0, 0
+        if _is_tree(obj):
+            result = self.tree(obj)
+            return result['objects'], result['size']
+        objects, size = 1, pickled_size(obj)
+        state = obj.__getstate__()
+        if isinstance(state, dict):
+            for value in state.values():
+                sub = self.object(value)
+                objects, size = objects + sub[0], size + sub[1]
+        return objects, size
+
+    def exclude(self, obj):
+        """Do not count obj (or objects only it refers to)"""
+        self._seen.add(id(obj))
+
+    def object(self, obj):
+        """(persistent object count, size) for obj and its references"""
+        if id(obj) in self._seen:
+            return 0, 0
+        self._seen.add(id(obj))
+        return self._object(obj)
+
+
+def _largest(walker, tree, top, label=None):
+    """Walk tree, return top (value, count) pairs of largest postings"""
+    counts = []
+
+    def visit(bucket):
+        for key, postings in bucket.items():
+            count = len(postings)
+            if len(counts) < top:
+                heapq.heappush(counts, (count, key))
+            elif count > counts[0][0]:
+                heapq.heapreplace(counts, (count, key))
+
+    stats = walker.tree(tree, visit)
+    largest = [
+        (label(key) if label is not None else key, count)
+        for count, key in sorted(counts, reverse=True)
+        ]
+    return stats, largest
+
+
+def _totals(walker, obj, trees):
+    """Totals for obj, with its trees (already walked)"""
+    objects, size = walker.object(obj)  # not counting walked trees
+    return {
+        'objects': objects + sum(t['objects'] for t in trees.values()),
+        'size': size + sum(t['size'] for t in trees.values()),
+        'sampled': any(t['sampled'] for t in trees.values()),
+        }
+
+
+def _lexicon_trees(walker, lexicon):
+    return {
+        'lexicon_wids': walker.tree(lexicon._wids),
+        'lexicon_words': walker.tree(lexicon._words),
+        }
+
+
+def index_stats(index, sample=None, top=TOP, shared=None):
+    """
+    Statistics for one catalog index, as a dict: type, documents,
+    values (distinct values, or words of a text index), largest (top
+    values or words by record count), trees (dict of statistics of each
+    BTree of the index), objects and size (totals for the index).
+    Text indexes also have lexicon_words (words in the lexicon), and
+    lexicon_shared: a lexicon that is shared (is shared, if not None)
+    is left out of the trees and totals, see lexicon_stats().
+    """
+    walker = StatsWalker(sample)
+    trees = {}
+    result = {'type': type(index).__name__, 'trees': trees}
+    if isinstance(index, TextIndex):
+        okapi = index.index
+        lexicon = okapi._lexicon
+        trees['wordinfo'], result['largest'] = _largest(
+            walker,
+            okapi._wordinfo,
+            top,
+            label=lexicon.get_word,
+            )
+        trees['docweight'] = walker.tree(okapi._docweight)
+        trees['docwords'] = walker.tree(okapi._docwords)
+        result['lexicon_shared'] = lexicon is shared
+        if lexicon is shared:
+            walker.exclude(lexicon)  # counted once, by lexicon_stats()
+        else:
+            trees.update(_lexicon_trees(walker, lexicon))
+        result['documents'] = okapi.documentCount()
+        result['values'] = okapi.wordCount()
+        result['lexicon_words'] = lexicon.wordCount()
+    else:
+        trees['fwd_index'], result['largest'] = _largest(
+            walker,
+            index._fwd_index,
+            top,
+            )
+        trees['rev_index'] = walker.tree(index._rev_index)
+        result['documents'] = index.documentCount()
+        result['values'] = trees['fwd_index']['items']
+    trees['not_indexed'] = walker.tree(index._not_indexed)
+    result.update(_totals(walker, index, trees))
+    return result
+
+
+def lexicon_stats(lexicon, sample=None):
+    """Statistics for a (shared) lexicon, as for index_stats()"""
+    walker = StatsWalker(sample)
+    trees = _lexicon_trees(walker, lexicon)
+    result = {
+        'type': type(lexicon).__name__,
+        'values': lexicon.wordCount(),
+        'trees': trees,
+        }
+    result.update(_totals(walker, lexicon, trees))
+    return result
+
+
+def uidmap_stats(uidmap, sample=None):
+    """Statistics for a UUID map, as for index_stats() (without values)"""
+    walker = StatsWalker(sample)
+    trees = {
+        'uuid_to_docid': walker.tree(uidmap.uuid_to_docid),
+        'docid_to_uuid': walker.tree(uidmap.docid_to_uuid),
+        }
+    result = {
+        'type': type(uidmap).__name__,
+        'documents': len(uidmap),
+        'trees': trees,
+        }
+    result.update(_totals(walker, uidmap, trees))
+    return result
+
+
+def catalog_stats(catalog, names=None, sample=None, top=TOP):
+    """
+    Statistics for indexes of catalog named in names (default: all,
+    'uidmap' for the UUID map, and 'lexicon' for the lexicon shared by
+    text indexes, if any), as dict of name to statistics.  A shared
+    lexicon is counted only under 'lexicon', so totals can be summed.
+    """
+    shared = catalog.lexicon
+    if names is None:
+        names = ['uidmap'] + sorted(catalog.indexer.keys())
+        if shared is not None:
+            names.append('lexicon')
+    jar = getattr(catalog, '_p_jar', None)
+    result = {}
+    for name in names:
+        if name == 'uidmap':
+            result[name] = uidmap_stats(catalog.uidmap, sample)
+        elif name == 'lexicon' and shared is not None:
+            result[name] = lexicon_stats(shared, sample)
+        else:
+            result[name] = index_stats(
+                catalog.indexer[name],
+                sample,
+                top,
+                shared,
+                )
+        if jar is not None:
+            jar.cacheGC()  # let go of buckets loaded for this index
+    return result
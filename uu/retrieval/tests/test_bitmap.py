@@ -0,0 +1,110 @@
+import random
+import unittest2 as unittest
+
+from uu.retrieval.bitmap import Bitmap, BitmapPostings, ARRAY_MAX
+from uu.retrieval.bitmap import BitmapChunk, INLINE_MAX
+
+
+class TestBitmap(unittest.TestCase):
+    """Test compressed bitmap docid sets against python sets"""
+
+    def _docids(self, base, size, spread):
+        return set(base + random.randrange(0, spread) for i in range(size))
+
+    def test_set_operations(self):
+        random.seed(1)
+        bases = (0, -(5 << 16), 2 ** 40, -2 ** 63)
+        for i in range(5):
+            # sparse, dense, and mixed (array and bitmap) chunks:
+            a = self._docids(random.choice(bases), 200, 1 << 18)
+            a |= self._docids(random.choice(bases), 20000, 1 << 16)
+            b = self._docids(random.choice(bases), 6000, 1 << 17)
+            b |= set(random.sample(sorted(a), len(a) / 2))
+            bitmap_a, bitmap_b = Bitmap(a), Bitmap(b)
+            assert list(bitmap_a) == sorted(a)
+            assert len(bitmap_a) == len(a)
+            assert list(bitmap_a & bitmap_b) == sorted(a & b)
+            assert list(bitmap_a | bitmap_b) == sorted(a | b)
+            assert list(bitmap_a - bitmap_b) == sorted(a - b)
+            assert list(Bitmap.intersection([bitmap_a, bitmap_b])) == \
+                sorted(a & b)
+            for docid in random.sample(sorted(a | b), 100):
+                assert (docid in bitmap_a) == (docid in a)
+
+    def test_containers(self):
+        bitmap = Bitmap(range(ARRAY_MAX))
+        assert len(bitmap.chunks) == 1
+        assert not isinstance(bitmap.chunks[0], long)  # sparse: array
+        bitmap = Bitmap(range(ARRAY_MAX + 1))
+        assert isinstance(bitmap.chunks[0], long)  # dense: bitmap
+        # dense chunk becomes array when result is sparse:
+        bitmap = bitmap - Bitmap(range(100))
+        assert not isinstance(bitmap.chunks[0], long)
+        assert list(bitmap) == range(100, ARRAY_MAX + 1)
+        # empty chunks are omitted:
+        assert not (bitmap - bitmap)
+        assert (bitmap - bitmap).chunks == {}
+
+
+class TestBitmapPostings(unittest.TestCase):
+    """Test persistent bitmap postings"""
+
+    def test_insert_remove(self):
+        random.seed(2)
+        postings = BitmapPostings([1, 2, 3])
+        expected = set([1, 2, 3])
+        for i in range(10000):
+            docid = random.randrange(0, 1 << 17)
+            if docid in expected:
+                postings.remove(docid)
+                expected.remove(docid)
+            else:
+                assert postings.insert(docid) == 1
+                expected.add(docid)
+        assert postings.insert(min(expected)) == 0  # already member
+        assert list(postings) == sorted(expected)
+        assert len(postings) == len(expected)
+        assert list(postings.bitmap()) == sorted(expected)
+        for docid in expected:
+            postings.remove(docid)
+        assert not postings
+        assert len(postings._chunks) == 0
+        self.assertRaises(KeyError, postings.remove, 1)
+
+    def test_inline_chunks(self):
+        # scattered docids: one small chunk each, not one record each:
+        docids = [i << 20 for i in range(100)]
+        postings = BitmapPostings(docids)
+        assert len(postings._chunks) == 100
+        assert not any(
+            isinstance(stored, BitmapChunk)
+            for stored in postings._chunks.values()
+            )
+        # a chunk growing beyond INLINE_MAX is stored as its own record:
+        for docid in range(1, INLINE_MAX + 1):
+            postings.insert(docid)
+        assert isinstance(postings._chunks[0], BitmapChunk)
+        postings.remove(1)
+        assert isinstance(postings._chunks[0], BitmapChunk)
+        assert len(postings) == 100 + INLINE_MAX - 1
+        assert list(postings) == sorted(docids + range(2, INLINE_MAX + 1))
+        assert 2 in postings and 1 not in postings
+        for docid in range(2, INLINE_MAX + 1) + [0]:
+            postings.remove(docid)
+        assert 0 not in postings._chunks
+        assert list(postings.walk()) == docids[1:]
+
+    def test_walk(self):
+        random.seed(3)
+        members = set(random.randrange(0, 1 << 20) for i in range(5000))
+        members = sorted(members)
+        members += range(1 << 21, (1 << 21) + ARRAY_MAX + 10)  # dense chunk
+        postings = BitmapPostings(members)
+        assert list(postings.walk()) == members
+        assert list(postings.walk(reverse=True)) == members[::-1]
+        for after in random.sample(members, 50) + [-1, 1 << 19, 1 << 22]:
+            assert list(postings.walk(after)) == [
+                d for d in members if d > after]
+            assert list(postings.walk(after, reverse=True)) == [
+                d for d in reversed(members) if d < after]
+        assert list(BitmapPostings().walk(reverse=True)) == []
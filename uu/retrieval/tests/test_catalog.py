@@ -13,6 +13,7 @@ from zope.interface import Interface, implements, implementer
 from zope.lifecycleevent import ObjectCreatedEvent
 from zope import schema
 
+from uu.retrieval.statistics import index_stats
 from uu.retrieval.tests.layers import RETRIEVAL_APP_TESTING
 from test_resolver import MockContainer as BaseMockContainer
 
@@ -208,8 +209,8 @@ class TestCatalog(unittest.TestCase):
         rec1, rec2, rec3, rec4 = RECORDS
         query1 = query.Eq('field_name', 'Me')
         query2 = query.Any('keyword_keywords', 'that')
-        query3 = query.Eq('field_when', datetime.date(2012, 1, 2))
-        query_empty_date = query.Eq('field_when', None)
+        query3 = query.Eq('date_when', datetime.date(2012, 1, 2))
+        query_empty_date = query.Eq('date_when', None)
         r = catalog.query(query1)
         assert len(r) == 1
         assert r.values()[0] is rec1
@@ -232,3 +233,958 @@ class TestCatalog(unittest.TestCase):
         r = catalog.query(query3 & query2)
         assert len(r) == 1
         assert IUUID(rec2) in r
+
+    def test_shared_lexicon(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        assert catalog.lexicon is not None
+        for name, idx in catalog.indexer.items():
+            if name.startswith('text_'):
+                assert idx.lexicon is catalog.lexicon
+                assert idx.index.lexicon is catalog.lexicon
+        assert len(catalog.query(text_bio='hello')) == 2
+        assert len(catalog.query(text_name='george')) == 1
+
+    def test_share_lexicon_migration(self):
+        container = self.test_mock_container()
+        from uu.retrieval.catalog import SimpleCatalog
+        catalog = SimpleCatalog(container, shared_lexicon=False)
+        container.catalog = catalog
+        for uid, record in container.items():
+            catalog.index(record)
+        text_indexes = [
+            idx for name, idx in catalog.indexer.items()
+            if name.startswith('text_')
+            ]
+        assert catalog.lexicon is None
+        assert len(set(id(idx.lexicon) for idx in text_indexes)) > 1
+        catalog.share_lexicon()
+        assert catalog.lexicon is not None
+        for idx in text_indexes:
+            assert idx.lexicon is catalog.lexicon
+        # previously indexed content found using re-mapped word ids:
+        assert len(catalog.query(text_bio='hello')) == 2
+        assert len(catalog.query(text_name='george')) == 1
+        assert len(catalog.query(text_favorite_color='orange')) == 1
+        # newly indexed words shared across indexes:
+        rec1 = RECORDS[0]
+        rec1.bio = u'Orange and yellow'
+        catalog.reindex(rec1)
+        assert len(catalog.query(text_bio='orange')) == 1
+        rec1.bio = u'Hello, this is a\n test of something unique'
+        catalog.reindex(rec1)
+
+    def test_missing_values(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.querying import IsEmpty, NotEmpty
+        rec1, rec2, rec3, rec4 = RECORDS
+        # no sentinel value is indexed for missing values:
+        assert float('inf') not in catalog.indexer['date_when']._fwd_index
+        r = catalog.query(IsEmpty('date_when'))
+        assert len(r) == 2
+        assert IUUID(rec1) in r and IUUID(rec3) in r
+        r = catalog.query(NotEmpty('date_when'))
+        assert len(r) == 2
+        assert IUUID(rec2) in r and IUUID(rec4) in r
+        # Eq/NotEq of None are equivalent to IsEmpty/NotEmpty:
+        assert catalog.rcount(date_when=None) == 2
+        r = catalog.query(query.NotEq('date_when', None))
+        assert IUUID(rec2) in r and IUUID(rec4) in r
+        r = catalog.query(query.Not(IsEmpty('date_when')))
+        assert len(r) == 2
+        r = catalog.query(
+            IsEmpty('date_when') & query.Any('keyword_keywords', ['monkey'])
+            )
+        assert len(r) == 1
+        assert IUUID(rec3) in r
+
+    def test_missing_values_migration(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval.querying import IsEmpty
+        rec1, rec2, rec3, rec4 = RECORDS
+        # field indexes as made by previous versions: sentinel value for
+        # missing values, and docids without attribute in a (non-tree) Set
+        docid3 = catalog.uidmap.docid_for(IUUID(rec3))
+        for name in ('field_name', 'field_age'):
+            idx = catalog.indexer[name]
+            idx._not_indexed = idx.family.IF.Set(idx._not_indexed)
+            idx.index_value(docid3, float('inf'))
+        assert catalog.rcount(IsEmpty('field_name')) == 0
+        assert catalog.migrate_missing() == ['field_age', 'field_name']
+        for name in ('field_name', 'field_age'):
+            idx = catalog.indexer[name]
+            assert float('inf') not in idx._fwd_index
+            assert isinstance(idx._not_indexed, idx.family.IF.TreeSet)
+        assert list(catalog.query(IsEmpty('field_name')).keys()) == [
+            IUUID(rec3)]
+        assert catalog.rcount(field_age=None) == 1
+        assert catalog.rcount(field_age=rec3.age) == 0
+        assert catalog.migrate_missing() == []
+        # reindex of migrated record restores its values:
+        catalog.reindex(rec3)
+        assert catalog.rcount(field_age=rec3.age) == 1
+
+    def test_sort_missing_values(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval.querying import NotEmpty
+        rec1, rec2, rec3, rec4 = RECORDS
+        q = NotEmpty('field_name')
+        # records without a value are sorted last (first if reversed):
+        result = catalog.query(q, sort_index='date_when')
+        keys = list(result.keys())
+        assert len(keys) == 4
+        assert keys[:2] == [IUUID(rec2), IUUID(rec4)]
+        assert sorted(keys[2:]) == sorted([IUUID(rec1), IUUID(rec3)])
+        reverse = catalog.query(q, sort_index='date_when', reverse=True)
+        assert list(reverse.keys()) == keys[2:] + [IUUID(rec4), IUUID(rec2)]
+        # limits count values, then records without a value:
+        result = catalog.query(q, sort_index='date_when', limit=3)
+        assert list(result.keys()) == keys[:3]
+        result = catalog.query(
+            q, sort_index='date_when', reverse=True, limit=1)
+        assert list(result.keys()) == keys[2:3]
+        assert catalog.rcount(q, sort_index='date_when', limit=3) == 3
+
+    def test_date_range_query(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.indexing.dates import DateIndex
+        rec1, rec2, rec3, rec4 = RECORDS
+        assert isinstance(catalog.indexer['date_when'], DateIndex)
+        r = catalog.query(
+            query.InRange(
+                'date_when',
+                datetime.date(2012, 1, 1),
+                datetime.date(2012, 12, 31),
+                )
+            )
+        assert len(r) == 2
+        assert IUUID(rec2) in r and IUUID(rec4) in r
+        r = catalog.query(query.Gt('date_when', datetime.date(2012, 1, 2)))
+        assert len(r) == 1
+        assert IUUID(rec4) in r
+
+    def test_date_index_migration(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.indexing import FieldIndex
+        from uu.retrieval.indexing.dates import DateIndex
+        from uu.retrieval.querying import IsEmpty
+        rec1, rec2, rec3, rec4 = RECORDS
+        # catalog as made by previous versions, field_ index for dates:
+        legacy = FieldIndex(catalog.indexer['date_when'].discriminator)
+        for record in RECORDS:
+            legacy.index_doc(catalog.uidmap.docid_for(IUUID(record)), record)
+        docid1 = catalog.uidmap.docid_for(IUUID(rec1))
+        legacy.index_value(docid1, float('inf'))  # legacy missing sentinel
+        del catalog.indexer['date_when']
+        catalog.indexer['field_when'] = legacy
+        name = catalog.add_composite(('field_name', 'field_when'))
+        assert catalog.migrate_date_indexes() == ['date_when']
+        assert 'field_when' not in catalog.indexer
+        idx = catalog.indexer['date_when']
+        assert isinstance(idx, DateIndex)
+        assert float('inf') not in idx._fwd_index
+        r = catalog.query(IsEmpty('date_when'))
+        assert len(r) == 2 and IUUID(rec1) in r and IUUID(rec3) in r
+        r = catalog.query(query.Gt('date_when', datetime.date(2012, 1, 2)))
+        assert list(r.keys()) == [IUUID(rec4)]
+        # composite components renamed, Eq routed to composite again:
+        assert catalog.composites() == ((name, ('field_name', 'date_when')),)
+        r = catalog.query(field_name=rec2.name, date_when=rec2.when)
+        assert list(r.keys()) == [IUUID(rec2)]
+        assert catalog.migrate_date_indexes() == []
+
+    def test_composite_index(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.querying import route_composites
+        rec1, rec2, rec3, rec4 = RECORDS
+        name = catalog.add_composite(('field_name', 'date_when'))
+        assert name == 'composite_name__when'
+        assert catalog.composites() == ((name, ('field_name', 'date_when')),)
+        idx = catalog.indexer[name]
+        # existing records indexed from component values, if complete:
+        assert idx.documentCount() == 2
+        assert len(idx.applyIsEmpty()) == 2
+        # And of Eq on all components is routed to the composite index:
+        q = route_composites(
+            query.Eq('field_name', u'You') & query.Eq('date_when', 734504),
+            catalog.composites(),
+            )
+        assert isinstance(q, query.Eq) and q.index_name == name
+        assert q._value == (u'You', 734504)
+        r = catalog.query(field_name=rec2.name, date_when=rec2.when)
+        assert len(r) == 1
+        assert IUUID(rec2) in r
+        r = catalog.query(
+            query.Eq('field_name', rec4.name) &
+            query.Eq('date_when', rec4.when) &
+            query.Any('keyword_keywords', ['monkey'])
+            )
+        assert len(r) == 1
+        assert IUUID(rec4) in r
+        assert catalog.rcount(**{name: (rec2.name, rec2.when)}) == 1
+        # new and changed records maintain the composite index:
+        rec4.when = datetime.date(2013, 4, 1)
+        catalog.reindex(rec4)
+        assert catalog.rcount(field_name=rec4.name, date_when=rec4.when) == 1
+        assert catalog.rcount(
+            field_name=rec4.name,
+            date_when=datetime.date(2012, 1, 3),
+            ) == 0
+        rec4.when = datetime.date(2012, 1, 3)  # restore fixture value
+        catalog.reindex(rec4)
+        self.assertRaises(
+            ValueError,
+            catalog.add_composite,
+            ('field_name', 'keyword_keywords'),
+            )
+
+    def test_bitmap_postings(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.bitmap import Bitmap
+        from uu.retrieval.indexing.postings import BitmapFieldIndex
+        from uu.retrieval.indexing.postings import BitmapKeywordIndex
+        from uu.retrieval.querying import IsEmpty
+        queries = (
+            query.Eq('field_name', u'You'),
+            query.All('keyword_keywords', [u'this', u'monkey']),
+            query.NotEq('field_name', u'You'),
+            query.Not(query.Any('keyword_keywords', [u'monkey'])),
+            query.Eq('field_name', u'You') |
+            query.Any('keyword_keywords', [u'monkey']),
+            query.Any('keyword_keywords', [u'this']) &
+            query.Contains('text_bio', u'monkey'),
+            query.Any('keyword_keywords', [u'this']) &
+            IsEmpty('date_when'),
+            )
+        before = [sorted(catalog.indexer.query(q)[1]) for q in queries]
+        catalog.set_postings('field_name')
+        catalog.set_postings('keyword_keywords', 'bitmap')
+        assert catalog.postings['keyword_keywords'] == 'bitmap'
+        assert isinstance(catalog.indexer['field_name'], BitmapFieldIndex)
+        assert isinstance(
+            catalog.indexer['keyword_keywords'],
+            BitmapKeywordIndex,
+            )
+        after = [sorted(catalog.indexer.query(q)[1]) for q in queries]
+        assert before == after
+        # bitmap-only query combined bitmap-to-bitmap:
+        assert isinstance(catalog.indexer.query(queries[4])[1], Bitmap)
+        # changes maintain bitmap postings:
+        rec1, rec2, rec3, rec4 = RECORDS
+        assert catalog.rcount(keyword_keywords=[u'that']) == 2
+        catalog.unindex(rec2)
+        assert catalog.rcount(keyword_keywords=[u'that']) == 1
+        assert catalog.rcount(field_name=u'You') == 0
+        catalog.index(rec2)
+        assert catalog.rcount(field_name=u'You') == 1
+        # choice of format is kept when indexes are re-made:
+        catalog.make_indexes()
+        assert isinstance(catalog.indexer['field_name'], BitmapFieldIndex)
+        catalog.set_postings('keyword_keywords', 'treeset')
+        assert 'keyword_keywords' not in catalog.postings
+        self.assertRaises(ValueError, catalog.set_postings, 'text_bio')
+
+    def test_replica(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.interfaces import ICatalogReplica
+        from uu.retrieval.querying import IsEmpty
+        from uu.retrieval.replica import CatalogReplica, ReplicaFieldIndex
+        rec1, rec2, rec3, rec4 = RECORDS
+        catalog.add_composite(('field_name', 'date_when'))
+        replica = CatalogReplica(catalog)
+        assert ICatalogReplica.providedBy(replica)
+        assert isinstance(replica.indexer['field_name'], ReplicaFieldIndex)
+        # text indexes are not replicated:
+        assert replica.indexer['text_bio'] is catalog.indexer['text_bio']
+        queries = (
+            query.Eq('field_name', u'You'),
+            query.Any('keyword_keywords', [u'this', u'monkey']),
+            query.All('keyword_keywords', [u'this', u'monkey']),
+            query.NotEq('field_name', u'You'),
+            query.Not(query.Any('keyword_keywords', [u'monkey'])),
+            query.InRange('field_name', u'A', u'N'),
+            query.Lt('field_name', u'Me'),
+            query.Any('keyword_keywords', [u'this']) &
+            query.Contains('text_bio', u'monkey'),
+            query.Eq('field_name', u'You') &
+            query.Eq('date_when', datetime.date(2012, 1, 2)),
+            IsEmpty('date_when') | query.Eq('field_name', u'You'),
+            # a single string is one value, not a sequence of characters:
+            query.Any('keyword_keywords', u'that'),
+            query.All('keyword_keywords', u'that'),
+            query.Any('field_name', u'Me'),
+            query.NotAny('field_name', u'Me'),
+            )
+        for q in queries:
+            expected = sorted(catalog.query(q).keys())
+            assert sorted(replica.query(q).keys()) == expected
+        assert replica.rcount(field_name=u'Me') == 1
+        assert replica(keyword_keywords=[u'monkey']).keys() == \
+            catalog(keyword_keywords=[u'monkey']).keys()
+        # changes rebuild only the replicas of changed indexes:
+        replicated = dict(replica.indexer)
+        rec1.name = u'Me too'
+        catalog.reindex(rec1)
+        replica.refresh()
+        assert replica.indexer['date_when'] is replicated['date_when']
+        assert replica.indexer['field_name'] is not replicated['field_name']
+        assert replica.rcount(field_name=u'Me') == 0
+        assert replica.rcount(field_name=u'Me too') == 1
+        rec1.name = u'Me'
+        catalog.reindex(rec1)
+        assert replica.rcount(field_name=u'Me') == 1
+        catalog.unindex(rec1)
+        assert replica.rcount(field_name=u'Me') == 0
+        assert IUUID(rec1) not in replica.uids.values()
+        catalog.index(rec1)
+        # sorted query of replica indexer:
+        size, docids = replica.indexer.query(
+            query.Any('keyword_keywords', [u'this']),
+            sort_index='field_name',
+            limit=2,
+            )
+        assert size == 2
+        names = [catalog.indexer['field_name']._rev_index[d] for d in docids]
+        assert names == [u'Curious george', u'Man in yellow hat']
+        # records without a value are kept, as by the index:
+        replica.refresh()
+        q = query.Any('keyword_keywords', [u'this', u'that'])
+        for reverse in (False, True):
+            assert list(replica.indexer.query(
+                q, sort_index='date_when', reverse=reverse)[1]) == \
+                list(catalog.indexer.query(
+                    q, sort_index='date_when', reverse=reverse)[1])
+
+    def test_sharded_catalog(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.interfaces import IShardedCatalog
+        from uu.retrieval.sharding import ShardedCatalog
+        rec1, rec2, rec3, rec4 = RECORDS
+        sharded = ShardedCatalog.fromcontext(container, 3)
+        assert IShardedCatalog.providedBy(sharded)
+        for record in RECORDS:
+            sharded.index(record)
+            shard = sharded.shard_for(IUUID(record))
+            assert IUUID(record) in shard
+            assert len([s for s in sharded.shards if record in s]) == 1
+        assert len(sharded) == 4
+        assert sorted(sharded.keys()) == sorted(catalog.keys())
+        assert aq_base(sharded.get(IUUID(rec2))) is aq_base(rec2)
+        queries = (
+            query.Eq('field_name', u'You'),
+            query.Any('keyword_keywords', [u'this', u'monkey']),
+            query.NotEq('field_name', u'You'),
+            query.Contains('text_bio', u'monkey'),
+            )
+        for q in queries:
+            expected = sorted(catalog.query(q).keys())
+            assert sorted(sharded.query(q).keys()) == expected
+            assert sharded.rcount(q) == len(expected)
+        # shards share the caller's query object, which is not modified:
+        q = query.Eq('field_name', None)
+        assert sharded.rcount(q) == 0 and q._value is None
+        # sorted, limited results are merged across shards:
+        q = query.Any('keyword_keywords', [u'this', u'that'])
+        for reverse in (False, True):
+            expected = catalog.query(q, sort_index='field_name',
+                                     reverse=reverse, limit=3)
+            result = sharded.query(q, sort_index='field_name',
+                                   reverse=reverse, limit=3)
+            assert len(expected) == 3
+            assert result.keys() == expected.keys()
+        assert sharded.rcount(q, sort_index='field_name', limit=3) == 3
+        sharded.unindex(rec1)
+        assert rec1 not in sharded
+        assert sharded.rcount(field_name=u'Me') == 0
+
+    def test_parallel_reindex(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval.reindex import docid_ranges, parallel_reindex
+        rec1, rec2, rec3, rec4 = RECORDS
+        ranges = docid_ranges(catalog, 3)
+        assert len(ranges) == 2  # two docids per range
+        docids = [d for lo, hi in ranges for d in (lo, hi)]
+        assert docids == list(catalog.uidmap.docid_to_uuid.keys())
+        rec1.name = u'Me too'
+        rec2.bio = u'Now a monkey, too.'
+        rec3.keywords = [u'monkey']
+        # discriminate in this process (no worker pool):
+        assert parallel_reindex(catalog, None, processes=0) == 4
+        assert catalog.rcount(field_name=u'Me') == 0
+        assert catalog.rcount(field_name=u'Me too') == 1
+        assert IUUID(rec2) in catalog.query(text_bio=u'monkey').keys()
+        assert catalog.rcount(keyword_keywords=[u'this']) == 2
+        rec1.name, rec2.bio, rec3.keywords = (
+            u'Me',
+            u'Hello, this is a\n test of something neither here nor there',
+            [u'this', u'other', u'monkey'],
+            )
+        parallel_reindex(catalog, None, processes=0, chunks=1)
+        assert catalog.rcount(field_name=u'Me') == 1
+        assert IUUID(rec2) not in catalog.query(text_bio=u'monkey').keys()
+
+    def test_saved_query(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from zope.component import provideHandler
+        from zope.component import getGlobalSiteManager
+        from uu.retrieval.interfaces import ISavedQuery, ISavedQueryEvent
+        from uu.retrieval.querying import IsEmpty, matches
+        rec1, rec2, rec3, rec4 = RECORDS
+        queries = (
+            query.Eq('field_name', u'You'),
+            query.NotAny('keyword_keywords', [u'monkey']),
+            query.All('keyword_keywords', [u'this', u'monkey']),
+            query.InRange('field_name', u'A', u'N'),
+            query.Not(query.Lt('field_name', u'Me')),
+            query.Contains('text_bio', u'monkey'),
+            IsEmpty('date_when') | query.Eq('field_name', u'You'),
+            # a single string is one value, not a sequence of characters:
+            query.Any('keyword_keywords', u'that'),
+            query.NotAny('keyword_keywords', u'that'),
+            query.All('keyword_keywords', u'other'),
+            )
+        rec2.keywords = [u'h', u'a']
+        catalog.reindex(rec2)
+        for q in queries:
+            expected = catalog.query(q).record_ids()
+            for docid in catalog.uidmap.docid_to_uuid.keys():
+                assert matches(q, catalog.indexer, docid) == \
+                    (docid in expected)
+        docid2 = catalog.uidmap.docid_for(IUUID(rec2))
+        assert not matches(queries[-3], catalog.indexer, docid2)
+        rec2.keywords = [u'that']
+        catalog.reindex(rec2)
+        events = []
+        handler = lambda event: events.append(event)
+        provideHandler(handler, (ISavedQueryEvent,))
+        try:
+            saved = catalog.save_query('monkeys', keyword_keywords=[u'monkey'])
+            assert ISavedQuery.providedBy(saved)
+            assert catalog.saved_queries['monkeys'] is saved
+            assert len(saved) == 2
+            assert sorted(catalog.saved_query('monkeys').keys()) == sorted(
+                [IUUID(rec3), IUUID(rec4)]
+                )
+            # membership updated by testing only changed record:
+            rec1.keywords = [u'monkey']
+            catalog.reindex(rec1)
+            assert IUUID(rec1) in catalog.saved_query('monkeys').keys()
+            assert len(events) == 1
+            assert events[0].uid == IUUID(rec1) and events[0].saved is saved
+            catalog.unindex(rec3)
+            assert len(saved) == 2
+            assert events[-1].uid == IUUID(rec3)
+            rec1.keywords = [u'this', u'that', u'other']
+            catalog.reindex(rec1)
+            catalog.index(rec3)
+            assert sorted(catalog.saved_query('monkeys').keys()) == sorted(
+                [IUUID(rec3), IUUID(rec4)]
+                )
+            assert len(events) == 4
+        finally:
+            getGlobalSiteManager().unregisterHandler(
+                handler, (ISavedQueryEvent,))
+        catalog.remove_saved_query('monkeys')
+        self.assertRaises(KeyError, catalog.remove_saved_query, 'monkeys')
+
+    def test_cursor_pagination(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        q = query.Any('keyword_keywords', [u'this', u'that'])
+        for reverse in (False, True):
+            expected = catalog.query(q, sort_index='field_name',
+                                     reverse=reverse).keys()
+            assert len(expected) == 4
+            pages, cursor = [], None
+            while True:
+                result = catalog.query(q, sort_index='field_name', limit=3,
+                                       reverse=reverse, cursor=cursor)
+                pages.append(result.keys())
+                cursor = result.cursor
+                if cursor is None:
+                    break
+            assert [len(keys) for keys in pages] == [3, 1]
+            assert pages[0] + pages[1] == expected
+        result = catalog.query(q, sort_index='field_name', limit=4,
+                               cursor=None)
+        assert result.keys() == catalog.query(
+            q, sort_index='field_name').keys()
+        assert not catalog.query(q, sort_index='field_name', limit=4,
+                                 cursor=result.cursor)
+        self.assertRaises(ValueError, catalog.query, q, cursor=None)
+        self.assertRaises(ValueError, catalog.query, q, cursor='bad',
+                          sort_index='field_name', limit=2)
+
+    def test_query_many(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval.querying import SubqueryCache, query_key
+        shared = query.Any('keyword_keywords', [u'this', u'that']) & \
+            query.NotEq('field_favorite_color', u'red')
+        # operand order of And / Or is ignored by query keys:
+        assert query_key(shared) == query_key(
+            query.NotEq('field_favorite_color', u'red') &
+            query.Any('keyword_keywords', [u'this', u'that'])
+            )
+        queries = [
+            shared & query.Contains('text_bio', u'monkey'),
+            shared & query.Not(query.Contains('text_bio', u'monkey')),
+            {'keyword_keywords': [u'this', u'that'], 'sort_index':
+             'field_name', 'limit': 2},
+            query.NotEq('field_favorite_color', u'red'),
+            ]
+        cache = SubqueryCache()
+        results = catalog.query_many(queries, cache)
+        assert len(results) == 4
+        assert results[0].keys() == catalog.query(
+            shared & query.Contains('text_bio', u'monkey')).keys()
+        assert sorted(results[1].keys()) == sorted(catalog.query(
+            shared & query.Not(query.Contains('text_bio', u'monkey'))
+            ).keys())
+        assert results[2].keys() == catalog.query(
+            keyword_keywords=[u'this', u'that'],
+            sort_index='field_name',
+            limit=2,
+            ).keys()
+        assert len(results[3]) == 3
+        # shared clauses evaluated once, reused for other queries:
+        assert cache.hits >= 3
+        assert len(cache) == cache.misses
+        assert catalog.rcount_many(queries) == [len(r) for r in results]
+
+    def test_clause_cache(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        rec1, rec2, rec3, rec4 = RECORDS
+        cache = catalog.indexer.clause_cache()
+        cache.clear()
+        q = query.Any('keyword_keywords', [u'monkey']) & \
+            query.NotEq('field_name', u'Me')
+        assert catalog.rcount(q) == 2
+        assert (cache.hits, cache.misses) == (0, 2)
+        assert catalog.rcount(q) == 2
+        assert (cache.hits, cache.misses) == (2, 2)
+        # write to one index leaves cached clauses of others intact:
+        rec3.name = u'Me'
+        catalog.reindex(rec3)
+        assert catalog.rcount(q) == 1
+        assert (cache.hits, cache.misses) == (3, 3)
+        rec3.name = u'Man in yellow hat'
+        catalog.reindex(rec3)
+        assert catalog.rcount(q) == 2
+        # bounded size, least recently used entries evicted:
+        from uu.retrieval.querying import ClauseCache
+        lru = ClauseCache(size=2)
+        lru.set('a', 1, 'A')
+        lru.set('b', 1, 'B')
+        assert lru.get('a', 1) == 'A'
+        lru.set('c', 1, 'C')
+        assert len(lru) == 2
+        assert lru.get('b', 1) is None
+        assert lru.get('a', 2) is None  # generation changed
+
+    def test_query_within(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval import querying
+        from uu.retrieval.querying import IsEmpty
+        rec1, rec2, rec3, rec4 = RECORDS
+        previous = catalog.query(keyword_keywords=[u'this'])
+        assert len(previous) == 3
+        queries = (
+            query.NotEq('field_name', u'Me'),
+            query.Any('keyword_keywords', [u'monkey']),
+            query.Contains('text_bio', u'monkey') | IsEmpty('date_when'),
+            query.Not(query.All('keyword_keywords', [u'this', u'monkey'])),
+            # scalar (a single string is one value) and sequence values:
+            query.Any('keyword_keywords', u'that'),
+            query.Any('keyword_keywords', [u'that', u'other']),
+            query.NotAny('keyword_keywords', u'that'),
+            query.All('keyword_keywords', u'other'),
+            query.Any('field_name', u'Me'),
+            query.Any('field_name', [u'Me', u'Man in yellow hat']),
+            query.NotAny('field_name', u'Me'),
+            {'keyword_keywords': u'that'},
+            {'keyword_keywords': [u'that', u'monkey']},
+            )
+        ratio = querying.WITHIN_PROBE_RATIO
+        try:
+            for probe_ratio in (100, 0):  # probe, and full evaluation
+                querying.WITHIN_PROBE_RATIO = probe_ratio
+                for q in queries:
+                    expected = catalog.query(q).intersection(previous)
+                    result = catalog.query(q, within=previous)
+                    assert sorted(result.keys()) == sorted(expected.keys())
+        finally:
+            querying.WITHIN_PROBE_RATIO = ratio
+        assert catalog.query(
+            {'keyword_keywords': u'that'},
+            within=previous,
+            ).keys() == (IUUID(rec1),)
+        assert catalog.query(query.Any('field_name', u'Me')).keys() == (
+            IUUID(rec1),)
+        # restriction as record ids, with sorting options:
+        rids = previous.record_ids()
+        result = catalog.query(
+            query.NotEq('field_name', u'Me'),
+            within=rids,
+            sort_index='field_name',
+            )
+        assert result.keys() == (IUUID(rec4), IUUID(rec3))
+        assert catalog.rcount(field_name=u'You', within=rids) == 0
+
+    def test_unindex_many(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        rec1, rec2, rec3, rec4 = RECORDS
+        # nothing unindexed if any UID is not in catalog:
+        self.assertRaises(
+            KeyError,
+            catalog.unindex_many,
+            [rec1, str(uuid.uuid4())],
+            )
+        assert len(catalog) == 4
+        assert catalog.unindex_many([rec1, IUUID(rec2)]) == 2
+        assert len(catalog) == 2
+        assert IUUID(rec1) not in catalog.uidmap
+        for idx in catalog.indexer.values():
+            assert catalog.uidmap.docid_for(IUUID(rec3)) in idx.docids()
+            assert len(idx.docids()) == 2
+        assert catalog.rcount(keyword_keywords=[u'that']) == 0
+        assert catalog.rcount(keyword_keywords=[u'monkey']) == 2
+        catalog.index(rec1)
+        catalog.index(rec2)
+        # delete by query:
+        assert catalog.unindex_query(
+            query.Any('keyword_keywords', [u'monkey'])) == 2
+        assert sorted(catalog.keys()) == sorted([IUUID(rec1), IUUID(rec2)])
+        assert catalog.rcount(text_bio=u'monkey') == 0
+        catalog.index(rec3)
+        catalog.index(rec4)
+
+    def test_snapshot(self):
+        import os
+        import tempfile
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval.snapshot import export_snapshot, Snapshot
+        rec1, rec2, rec3, rec4 = RECORDS
+        path = tempfile.mktemp()
+        export_snapshot(catalog, path)
+        try:
+            snapshot = Snapshot(path)
+            assert len(snapshot) == 4
+            assert 'text_bio' not in snapshot.names()
+            docids = list(catalog.uidmap.docid_to_uuid.keys())
+            assert list(snapshot.docids) == docids
+            assert snapshot.uids() == [
+                catalog.uidmap.uuid_for(docid) for docid in docids
+                ]
+            values = dict(zip(snapshot.uids(), snapshot.values('field_name')))
+            assert values[IUUID(rec2)] == u'You'
+            rows = snapshot.select('keyword_keywords', values=[u'monkey'])
+            assert sorted(snapshot.uids(rows)) == sorted(
+                catalog.query(keyword_keywords=[u'monkey']).keys()
+                )
+            rows = snapshot.select('field_name', start=u'D', rows=rows)
+            assert snapshot.uids(rows) == [IUUID(rec3)]
+            counts = snapshot.counts('keyword_keywords')
+            assert counts == {u'this': 3, u'that': 2, u'other': 2,
+                              u'monkey': 2}
+            assert snapshot.counts('date_when') == {
+                rec2.when.toordinal(): 1,
+                rec4.when.toordinal(): 1,
+                None: 2,
+                }
+            snapshot.close()
+        finally:
+            os.unlink(path)
+
+    def test_export(self):
+        import csv
+        import json
+        from StringIO import StringIO
+        container = self.test_indexing()
+        catalog = container.catalog
+        rec1, rec2, rec3, rec4 = RECORDS
+        rows = dict(catalog.export_rows())
+        assert len(rows) == 4
+        columns = ['name', 'age', 'favorite_color', 'bio', 'keywords', 'when']
+        assert rows[IUUID(rec2)] == [
+            rec2.name, rec2.age, rec2.favorite_color, rec2.bio,
+            [u'that'], rec2.when,
+            ]
+        assert rows[IUUID(rec1)][5] is None
+        assert sorted(rows[IUUID(rec1)][4]) == sorted(rec1.keywords)
+        # CSV export of a search result, in order of result:
+        result = catalog.query(keyword_keywords=[u'monkey'],
+                               sort_index='field_age')
+        stream = StringIO()
+        assert result.export(stream) == 2
+        stream.seek(0)
+        lines = list(csv.reader(stream))
+        assert lines[0] == ['uid'] + columns
+        assert [line[0] for line in lines[1:]] == list(result.keys())
+        assert lines[1][1:3] == ['Curious george', '11']
+        assert lines[1][5] == 'monkey; this'
+        assert lines[1][6] == rec4.when.isoformat()
+        # JSON lines of selected columns, indexed only (no resolution):
+        stream = StringIO()
+        catalog.resolver.context._items.clear()  # nothing resolvable
+        assert catalog.export(stream, columns=['name', 'when'],
+                              format='jsonl') == 4
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        records = dict((r.pop('uid'), r) for r in records)
+        assert records[IUUID(rec2)] == {
+            'name': u'You', 'when': rec2.when.isoformat()}
+        self.assertRaises(ValueError, catalog.export, stream, format='xml')
+        # legacy sentinel for missing values is exported as missing:
+        docid1 = catalog.uidmap.docid_for(IUUID(rec1))
+        catalog.indexer['field_age'].index_value(docid1, float('inf'))
+        rows = dict(catalog.export_rows(columns=['age']))
+        assert rows[IUUID(rec1)] == [None]
+        stream = StringIO()
+        catalog.export(stream, columns=['age'], format='jsonl')
+        assert 'Infinity' not in stream.getvalue()
+        stream = StringIO()
+        catalog.export(stream, columns=['age'])
+        assert 'inf' not in stream.getvalue()
+
+    def test_distinct(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from uu.retrieval import querying
+        rec1, rec2, rec3, rec4 = RECORDS
+        assert catalog.distinct('keyword_keywords') == [
+            u'monkey', u'other', u'that', u'this']
+        assert catalog.distinct('keyword_keywords', with_counts=True) == [
+            (u'monkey', 2), (u'other', 2), (u'that', 2), (u'this', 3)]
+        assert catalog.distinct('field_name', prefix=u'M') == [
+            u'Man in yellow hat', u'Me']
+        assert catalog.distinct('field_age', limit=2) == [11, 90]
+        assert catalog.distinct('field_age', limit=0) == []
+        # inclusive range of values, normalized as query values:
+        assert catalog.distinct('field_age', start=11, end=90) == [11, 90]
+        assert catalog.distinct('field_name', start=u'Mf') == [u'You']
+        assert catalog.distinct('field_name', prefix=u'M', start=u'Mb') == [
+            u'Me']
+        assert catalog.distinct(
+            'date_when',
+            start=rec4.when,
+            ) == [rec4.when.toordinal()]
+        # missing values are not listed:
+        assert catalog.distinct('date_when') == [
+            rec2.when.toordinal(), rec4.when.toordinal()]
+        self.assertRaises(ValueError, catalog.distinct, 'text_bio')
+        # restricted to query, walking keys, and probing each docid:
+        ratio = querying.WITHIN_PROBE_RATIO
+        try:
+            for probe_ratio in (0, 100):
+                querying.WITHIN_PROBE_RATIO = probe_ratio
+                assert catalog.distinct(
+                    'keyword_keywords',
+                    query.Gt('field_age', 50),
+                    with_counts=True,
+                    ) == [(u'monkey', 1), (u'other', 2), (u'that', 2),
+                          (u'this', 2)]
+                assert catalog.distinct(
+                    'keyword_keywords',
+                    {'field_name': u'You'},
+                    prefix=u't',
+                    ) == [u'that']
+                assert catalog.distinct(
+                    'keyword_keywords',
+                    query.Gt('field_age', 50),
+                    start=u'other',
+                    end=u'that',
+                    limit=5,
+                    ) == [u'other', u'that']
+        finally:
+            querying.WITHIN_PROBE_RATIO = ratio
+        # legacy sentinel for missing values is not listed:
+        idx = catalog.indexer['field_age']
+        idx.index_value(12345, float('inf'))
+        assert float('inf') not in catalog.distinct('field_age')
+        idx.unindex_doc(12345)
+
+    def test_prepared_query(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        from repoze.catalog.query import Name
+        from uu.retrieval.interfaces import IPreparedQuery
+        rec1, rec2, rec3, rec4 = RECORDS
+        # normalization does not modify caller's query:
+        q = query.Eq('date_when', rec2.when)
+        assert len(catalog.query(q)) == 1
+        assert q._value == rec2.when
+        template = (
+            query.Any('keyword_keywords', [u'this', Name('keyword')]) &
+            query.InRange('field_age', Name('low'), 100) &
+            query.NotEq('field_name', u'Me')
+            )
+        prepared = catalog.compile(template, sort_index='field_age')
+        assert IPreparedQuery.providedBy(prepared)
+        assert prepared.params == frozenset(['keyword', 'low'])
+        result = prepared(keyword=u'that', low=50)
+        assert result.keys() == (IUUID(rec2),)
+        result = prepared(keyword=u'that', low=0, reverse=True)
+        assert result.keys() == (IUUID(rec2), IUUID(rec4))
+        assert prepared.rcount(keyword=u'monkey', low=10) == 1
+        # sub-queries without parameters are shared, template unchanged:
+        bound = prepared.bind(keyword=u'x', low=1)
+        assert bound.queries[2] is prepared.query.queries[2]
+        assert prepared.query.queries[0]._value[1].name == 'keyword'
+        self.assertRaises(NameError, prepared, keyword=u'that')
+        # None for Eq parameter means missing value:
+        prepared = catalog.compile({'date_when': Name('when')})
+        assert prepared.rcount(when=None) == 2
+        assert prepared(when=rec4.when).keys() == (IUUID(rec4),)
+        self.assertRaises(KeyError, catalog.compile, {'field_nope': 1})
+        self.assertRaises(TypeError, catalog.compile, q, sort='field_age')
+
+    def test_query_text(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from repoze.catalog import query
+        rec1, rec2, rec3, rec4 = RECORDS
+        text = "field_name == 'You' or keyword_keywords in any(['monkey'])"
+        result = catalog.query(text, sort_index='field_age')
+        assert result.keys() == (IUUID(rec4), IUUID(rec2), IUUID(rec3))
+        assert catalog.rcount("10 < field_age <= 90") == 2
+        assert catalog.rcount(u"field_name == '\xe9'") == 0
+        # parsed queries are cached, until indexes change:
+        cache = catalog.parse_cache()
+        assert catalog.parse(text) is catalog.parse(text)
+        assert cache.hits >= 1
+        q = catalog.parse(text)
+        assert isinstance(q, query.Or)
+        catalog.add_composite(['field_name', 'field_age'])
+        assert catalog.parse(text) is not q
+        # safe parsing, for untrusted text:
+        assert catalog.rcount(text, safe=True) == 3
+        for bad in (
+                "field_name == name",  # query name, not a literal
+                "field_nope == 1",  # unknown index
+                "'monkey' in field_name",  # unsupported by index
+                "field_age > 1; import os",
+                "__import__('os')",
+                " or ".join("field_age > %s" % i for i in range(100)),
+                "(" * 200 + "field_age == 1" + ")" * 200,
+                ):
+            self.assertRaises(ValueError, catalog.query, bad, safe=True)
+        self.assertRaises(ValueError, catalog.query, "field_age ==")
+
+    def test_consistency(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval import consistency
+        rec1, rec2, rec3, rec4 = RECORDS
+        uidmap = catalog.uidmap
+        report = catalog.check_consistency()
+        assert report.ok and report.pairs == 4
+        docid1 = uidmap.docid_for(IUUID(rec1))
+        docid2 = uidmap.docid_for(IUUID(rec2))
+        # drift: stale, dangling, orphan, missing entries, bad length:
+        del catalog.resolver.context._items[IUUID(rec4)]
+        del uidmap.docid_to_uuid[docid2]
+        catalog.indexer['field_age'].index_value(12345, 7)
+        catalog.indexer['field_name'].unindex_doc(docid1)
+        uidmap._length.change(1)
+        report = catalog.check_consistency()
+        assert not report.ok
+        assert report.summary() == {
+            consistency.STALE: 1,
+            consistency.DANGLING_UID: 1,
+            consistency.ORPHAN: 1,
+            consistency.MISSING: 1,
+            }
+        assert (consistency.ORPHAN, 'field_age', 12345, None) in report
+        assert (consistency.MISSING, 'field_name', docid1,
+                IUUID(rec1)) in report
+        # without resolution, stale entries are not found:
+        assert len(catalog.check_consistency(resolve=False)) == 3
+        assert catalog.repair(report) == 5
+        assert catalog.check_consistency().ok
+        assert len(catalog) == 3 and IUUID(rec4) not in uidmap
+        assert uidmap.uuid_for(docid2) == IUUID(rec2)
+        assert catalog.rcount(field_name=rec1.name) == 1
+        assert catalog.rcount(field_age=7) == 0
+        assert catalog.repair() == 0
+
+    def test_stats(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        stats = catalog.stats()
+        assert sorted(stats) == sorted(
+            ['uidmap', 'lexicon'] + catalog.indexer.keys())
+        assert stats['uidmap']['documents'] == 4
+        assert stats['uidmap']['trees']['uuid_to_docid']['items'] == 4
+        age = stats['field_age']
+        assert age['documents'] == 4 and age['values'] == 4
+        assert age['trees']['fwd_index']['depth'] == 1
+        assert age['objects'] > 1 and age['size'] > 0
+        assert not age['sampled']
+        keywords = stats['keyword_keywords']
+        assert keywords['largest'][0] == (u'this', 3)
+        bio = stats['text_bio']
+        assert bio['values'] > 0 and bio['lexicon_words'] >= bio['values']
+        assert len(bio['largest']) == 10 and bio['largest'][0][1] == 2
+        # shared lexicon is counted once, not in totals of text indexes:
+        lexicon = stats['lexicon']
+        assert lexicon['values'] == bio['lexicon_words']
+        assert bio['lexicon_shared'] and 'lexicon_wids' not in bio['trees']
+        assert lexicon['trees']['lexicon_wids']['items'] == lexicon['values']
+        unshared = index_stats(catalog.indexer['text_bio'])
+        assert 'lexicon_wids' in unshared['trees']
+        assert unshared['size'] > bio['size']
+        # sampled, for one index, of many records:
+        for i in range(2000):
+            catalog.indexer['field_name'].index_value(1000 + i, u'n%s' % i)
+        stats = catalog.stats(names=['field_name'], sample=2)
+        assert stats.keys() == ['field_name']
+        fwd = stats['field_name']['trees']['fwd_index']
+        assert fwd['sampled'] and fwd['buckets'] > 2 and fwd['depth'] > 1
+        assert 1000 < fwd['items'] < 4000
+
+    def test_warmup(self):
+        container = self.test_indexing()
+        catalog = container.catalog
+        from uu.retrieval import warmup
+        roots = warmup.structures(catalog)
+        assert catalog.uidmap.docid_to_uuid in roots
+        assert catalog.indexer['field_age']._fwd_index in roots
+        assert catalog.lexicon._wids in roots
+        result = catalog.warmup()
+        assert result['objects'] >= len(roots)
+        assert result['seconds'] >= 0
+        # configured per catalog:
+        catalog.warmup_indexes = ('field_age',)
+        assert len(warmup.structures(catalog, catalog.warmup_indexes)) == 3
+        assert catalog.warmup()['objects'] < result['objects']
+        assert catalog.warmup(limit=1)['objects'] == 1
@@ -6,6 +6,7 @@ from uu.retrieval.collection.interfaces import INamedItemCollection
 from uu.retrieval.collection.interfaces import IItemCollection
 from uu.retrieval.collection.interfaces import ICollectionSetOperations
 from uu.retrieval.collection import BaseCollection, BaseNamedCollection
+from uu.retrieval.collection import CollectionView, NamedCollectionView
 
 NS_UPIQ = uuid.uuid3(uuid.NAMESPACE_DNS, 'upiq.org')
 NS_PKG = uuid.uuid3(NS_UPIQ, 'uu.retrieval.tests.test_collection')
@@ -168,6 +169,45 @@ class TestCollection(unittest.TestCase):
         # intersection of disjoint set is null set, empty mapping:
         assert not (collection1 & disjoint).keys()
 
+    def test_lazy_views(self):
+        collection1 = BaseCollection(ITEMS, NAMES)
+        collection2 = BaseCollection(ITEMS2)
+        disjoint = BaseCollection(ITEMS3)
+        smaller = BaseCollection(ITEMS4)
+        chained = ((collection2 | disjoint) - smaller) & collection2
+        self.assertIsInstance(chained, CollectionView)
+        # nothing materialized until used:
+        assert '_uids' not in chained.__dict__
+        assert '_uidset' not in collection2.__dict__
+        uid2 = str(uuid.uuid3(NS_PKG, 'item2'))
+        uid3 = str(uuid.uuid3(NS_PKG, 'item3'))
+        assert uid2 in chained
+        assert str(uuid.uuid3(NS_PKG, 'item4')) not in chained
+        assert chained[uid2] is ITEMS2[uid2]
+        assert '_uids' not in chained.__dict__
+        # order is that of left-most operand keys:
+        expected = [k for k in collection2.keys() if k in (uid2, uid3)]
+        assert list(chained.iterkeys()) == expected
+        assert chained.keys() == expected
+        assert len(chained) == 2
+        assert chained.values() == [ITEMS2[k] for k in expected]
+        assert chained.name_for(uid2) is None  # collection2 has no names
+        # views are operands of further set operations:
+        assert (chained - collection1).keys() == [uid3]
+        assert set((collection1 | chained).keys()) == set(ITEMS2.keys())
+        # names merged on use:
+        smaller = BaseCollection(ITEMS4, {'item1': ITEMS4.keys()[0]})
+        view = collection1 - smaller
+        assert view.keys() == [uid2]
+        assert view.uid_for('item2') == uid2
+        assert view.uid_for('item1') is None
+        named = view.byname()
+        assert named.keys() == ['item2']
+        self.assertIsInstance(
+            BaseNamedCollection(ITEMS, NAMES) & collection1.byname(),
+            NamedCollectionView,
+            )
+
     def test_namemap(self):
         k = ITEMS.keys()[0]
         nonames = BaseCollection(ITEMS)
@@ -0,0 +1,241 @@
+import random
+import unittest2 as unittest
+import uuid
+
+from plone.uuid.interfaces import IUUID
+from zope.component import adapter, provideAdapter
+from zope.interface import Interface, implementer, implements
+from zope.container.interfaces import IOrderedContainer
+from zope.interface import alsoProvides, directlyProvides
+
+from uu.retrieval.collection.interfaces import INamedItemCollection
+from uu.retrieval.container.interfaces import INamedItemContainer
+from uu.retrieval.container.interfaces import IUIDKeyedContainer
+from uu.retrieval.container import NamedItemContainer
+from uu.retrieval.container import UIDKeyedContainer, OrderedUIDKeyedContainer
+from uu.retrieval.result import SearchResult
+
+
+class IMockItem(Interface):
+    """Mock item interface"""
+
+
+class IDocument(IMockItem):
+    """Mock document interface"""
+
+
+class IImage(IMockItem):
+    """Mock image interface"""
+
+
+class MockItem(object):
+    implements(IMockItem)
+
+    def __init__(self, id=None):
+        self.id = id
+        self.uid = str(uuid.uuid4())  # random
+
+
+@implementer(IUUID)
+@adapter(IMockItem)
+def mock_uuid_adapter(context):
+    return context.uid
+
+
+class TestNamedItemContainer(unittest.TestCase):
+
+    def setUp(self):
+        provideAdapter(mock_uuid_adapter)
+        self.container = NamedItemContainer('folder')
+        for i in range(10):
+            item = MockItem('item%s' % i)
+            alsoProvides(item, IDocument if i % 2 else IImage)
+            self.container[item.id] = item
+
+    def test_interfaces(self):
+        assert INamedItemContainer.providedBy(self.container)
+        assert self.container.getId() == u'folder'
+        ifaces = self.container.interfaces()
+        for iface in (IMockItem, IDocument, IImage, Interface):
+            assert iface in ifaces
+
+    def test_names(self):
+        container = self.container
+        assert len(container) == 10
+        item = container['item3']
+        assert container.uid_for('item3') == item.uid
+        assert container.name_for(item.uid) == 'item3'
+        assert container.all_names(item.uid) == ('item3',)
+        assert container.byuid()[item.uid] is item
+        assert 'item3' in container and 'item99' not in container
+        assert container.get('item99') is None
+
+    def test_providing(self):
+        container = self.container
+        images = container.providing(IImage)
+        assert INamedItemCollection.providedBy(images)
+        assert images.__parent__ is container
+        assert len(images) == 5
+        assert sorted(images.keys()) == ['item%s' % i for i in (0, 2, 4, 6, 8)]
+        assert 'item0' in images and 'item1' not in images
+        assert images['item0'] is container['item0']
+        assert images.get('item1') is None
+        self.assertRaises(KeyError, lambda: images['item1'])
+        assert set(images.byuid().keys()) == set(
+            container.uid_for(name) for name in images.keys())
+        # ANY semantics for a sequence of interfaces:
+        assert len(container.providing((IImage, IDocument))) == 10
+        assert len(container.providing([IImage])) == 5
+        assert len(container.providing(IMockItem)) == 10
+        assert len(container.providing(INamedItemContainer)) == 0
+
+    def test_add_remove(self):
+        container = self.container
+        del container['item0']
+        assert len(container) == 9
+        assert 'item0' not in container.providing(IImage)
+        assert len(container.providing(IImage)) == 4
+        # replace an item, and rename an item:
+        item = MockItem('item1')
+        container['item1'] = item
+        assert container['item1'] is item
+        assert len(container) == 9
+        assert len(container.providing(IDocument)) == 4
+        container['renamed'] = container['item2']
+        assert 'item2' not in container
+        assert 'renamed' in container.providing(IImage)
+        assert len(container) == 9
+        # reindex after change to provided interfaces:
+        directlyProvides(item, IDocument)
+        container.reindex('item1')
+        assert 'item1' in container.providing(IDocument)
+        del container['renamed']
+        del container['item1']
+        del container['item3']
+        assert len(container.providing(IDocument)) == 3
+        assert IImage in container.interfaces()
+        for name in ('item4', 'item6', 'item8'):
+            del container[name]
+        assert IImage not in container.interfaces()
+        assert len(container.providing(IImage)) == 0
+        assert len(container) == len(container._items) == 3
+
+
+class MockBulkResolver(object):
+    """Resolver using bulk get_many() of a container"""
+
+    def __init__(self, container):
+        self.container = container
+        self.calls = 0
+
+    def __call__(self, uid):
+        return self.container.get(uid)
+
+    def get_many(self, uids):
+        self.calls += 1
+        return self.container.get_many(uids)
+
+
+class TestUIDKeyedContainer(unittest.TestCase):
+
+    def setUp(self):
+        provideAdapter(mock_uuid_adapter)
+        self.items = [MockItem('item%s' % i) for i in range(10)]
+
+    def test_interfaces(self):
+        container = UIDKeyedContainer('folder')
+        assert IUIDKeyedContainer.providedBy(container)
+        assert not IOrderedContainer.providedBy(container)
+        ordered = OrderedUIDKeyedContainer('folder')
+        assert IUIDKeyedContainer.providedBy(ordered)
+        assert IOrderedContainer.providedBy(ordered)
+
+    def test_add_remove(self):
+        container = UIDKeyedContainer()
+        for item in self.items:
+            assert container.add(item, item.id) == item.uid
+        assert len(container) == 10
+        item = self.items[0]
+        assert container[item.uid] is item
+        assert container.get(uuid.UUID(item.uid)) is item
+        assert item._v_parent is container
+        assert sorted(container.keys()) == sorted(i.uid for i in self.items)
+        container[item.uid] = item  # replace: length unchanged
+        assert len(container) == 10
+        del container[item.uid]
+        assert len(container) == 9
+        assert item.uid not in container
+        assert container.uid_for('item0') is None
+        self.assertRaises(KeyError, lambda: container[item.uid])
+
+    def test_names(self):
+        container = UIDKeyedContainer()
+        item = self.items[0]
+        container.add(item, 'a')
+        container.add_name('b', item.uid)
+        assert container.all_names(item.uid) == ('a', 'b')
+        assert container.name_for(item.uid) == 'a'
+        assert container.uid_for('b') == item.uid
+        container.remove_name('a')
+        assert container.name_for(item.uid) == 'b'
+        # relinking a name to another item:
+        other = self.items[1]
+        container.add(other, 'b')
+        assert container.all_names(item.uid) == ()
+        assert container.uid_for('b') == other.uid
+        self.assertRaises(KeyError, container.add_name, 'c', 'unknown')
+
+    def test_get_many(self):
+        container = UIDKeyedContainer(items=[(i.uid, i) for i in self.items])
+        uids = [i.uid for i in reversed(self.items)]
+        assert container.get_many(uids) == list(reversed(self.items))
+        assert container.get_many(['unknown', uids[0]]) == [
+            None, self.items[-1]]
+        resolver = MockBulkResolver(container)
+        result = SearchResult.fromtuples(
+            list(enumerate(uids[:5])),
+            resolver=resolver,
+            )
+        assert result.values() == list(reversed(self.items))[:5]
+        assert result.items() == zip(uids[:5], result.values())
+        assert resolver.calls == 3
+
+    def test_ordered(self):
+        container = OrderedUIDKeyedContainer()
+        for item in self.items:
+            container.add(item)
+        uids = [i.uid for i in self.items]
+        assert container.keys() == uids
+        assert container.values() == self.items
+        container.move(uids[9], before=uids[0])
+        assert container.keys() == uids[9:] + uids[:9]
+        container.move(uids[9])
+        assert container.keys() == uids
+        container.move(uids[0], before=uids[5])
+        assert container.keys() == uids[1:5] + [uids[0]] + uids[5:]
+        container.updateOrder(uids)
+        assert container.keys() == uids
+        self.assertRaises(ValueError, container.updateOrder, uids[1:])
+        del container[uids[3]]
+        assert container.keys() == uids[:3] + uids[4:]
+        assert len(container) == 9
+        # repeated moves into the same gap exhaust it, renumbering:
+        for i in range(40):
+            container.move(uids[(i % 2) + 1], before=uids[0])
+        assert set(container.keys()) == set(uids) - set([uids[3]])
+        assert container.keys()[:3] == [uids[1], uids[2], uids[0]]
+        assert len(container._order) == len(container._position) == 9
+
+    def test_ordered_moves_many(self):
+        random.seed(4)
+        container = OrderedUIDKeyedContainer()
+        items = [MockItem('item%s' % i) for i in range(5000)]
+        for item in items:
+            container.add(item)
+        expected = [item.uid for item in items]
+        for i in range(200):
+            uid, before = random.sample(expected, 2)
+            container.move(uid, before=before)
+            expected.remove(uid)
+            expected.insert(expected.index(before), uid)
+        assert container.keys() == expected
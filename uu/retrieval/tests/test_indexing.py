@@ -1,13 +1,22 @@
 import uuid
 import unittest2 as unittest
 
+from persistent import Persistent
 from plone.uuid.interfaces import IUUID
+from repoze.catalog.query import Eq
+from ZODB import DB
+import transaction
 
 from uu.retrieval.indexing import Indexer
 from uu.retrieval.indexing import FieldIndex, TextIndex, KeywordIndex
 from uu.retrieval.indexing import UUIDMapper
 from uu.retrieval.indexing import IdGeneratorBase
+from uu.retrieval.indexing import make_lexicon, merge_lexicons
 from uu.retrieval.utils import normalize_uuid
+from uu.retrieval import paging, warmup
+from uu.retrieval.bitmap import Bitmap, BitmapPostings
+from uu.retrieval.indexing.postings import BitmapFieldIndex
+from uu.retrieval.indexing.postings import BitmapKeywordIndex
 
 from layers import RETRIEVAL_APP_TESTING
 
@@ -138,6 +147,28 @@ class UUIDMapperTests(unittest.TestCase):
             assert (uid, mapper.get(uid)) in mapper.items()
             assert (uid, mapper.get(uid)) in mapper.iteritems()
 
+    def test_remove_many(self):
+        """test batch removal"""
+        mapper = UUIDMapper()
+        pairs = [mapper.add(uuid.uuid4()) for i in range(10)]
+        generation = mapper.generation()
+        # nothing removed if any spec is not found:
+        self.assertRaises(
+            KeyError,
+            mapper.remove_many,
+            [pairs[0][0], uuid.uuid4()],
+            )
+        assert len(mapper) == 10
+        # remove by UUID or docid, duplicates ignored:
+        specs = [pairs[0][0], pairs[1][1], pairs[2][0], pairs[2][0]]
+        removed = mapper.remove_many(specs)
+        assert sorted(removed) == sorted(pairs[:3])
+        assert len(mapper) == 7 == len(mapper.keys())
+        assert mapper.generation() == generation + 1
+        for uid, docid in pairs[:3]:
+            assert uid not in mapper and docid not in mapper
+        assert mapper.remove_many([]) == []
+
 
 class MockItem(object):
     pass
@@ -172,6 +203,209 @@ class TestIndexBoundaries(unittest.TestCase):
         self._test_index(KeywordIndex, getter=_keywords)
 
 
+class TestMissingValues(unittest.TestCase):
+    """Test tracking of docids with missing values in indexes"""
+
+    def _item(self, value=None):
+        item = MockItem()
+        item.value = value
+        return item
+
+    def test_field_index(self):
+        idx = FieldIndex('value')
+        idx.index_doc(1, self._item(u'a'))
+        idx.index_doc(2, self._item(None))
+        idx.index_doc(3, MockItem())  # no attribute
+        assert list(idx.applyIsEmpty()) == [2, 3]
+        assert list(idx.applyNotEmpty()) == [1]
+        assert list(idx._fwd_index.keys()) == [u'a']
+        # value set, then removed again on reindex:
+        idx.reindex_doc(2, self._item(u'b'))
+        assert list(idx.applyIsEmpty()) == [3]
+        idx.reindex_doc(1, self._item(None))
+        assert list(idx.applyIsEmpty()) == [1, 3]
+        assert list(idx.applyEq(u'a')) == []
+        idx.unindex_doc(3)
+        assert list(idx.applyIsEmpty()) == [1]
+
+    def test_migrate_missing(self):
+        idx = FieldIndex('value')
+        idx.index_doc(1, self._item(u'a'))
+        idx.index_doc(2, self._item(float('inf')))  # legacy sentinel
+        idx.migrate_missing()
+        assert float('inf') not in idx._fwd_index
+        assert list(idx.applyIsEmpty()) == [2]
+        assert idx.documentCount() == 1
+
+    def test_generation(self):
+        idx = KeywordIndex('value')
+        assert idx.generation() == 0
+        idx.index_doc(1, self._item([u'a', u'b']))
+        idx.index_doc(2, self._item(None))
+        assert idx.generation() == 2
+        # unchanged values do not count as changes:
+        idx.reindex_doc(1, self._item([u'b', u'a']))
+        idx.reindex_doc(2, MockItem())
+        assert idx.generation() == 2
+        idx.reindex_doc(1, self._item([u'a']))
+        assert idx.generation() == 3
+        idx.unindex_doc(2)
+        assert idx.generation() == 4
+
+
+class TestCursorPaging(unittest.TestCase):
+    """Test keyset pagination deep into a large field index"""
+
+    def _index(self, cls):
+        idx = cls('value')
+        for docid in range(40000):
+            item = MockItem()
+            item.value = docid // 4  # 10000 values, 4 docids each
+            idx.index_doc(docid, item)
+        return idx
+
+    def _test_deep_pages(self, idx):
+        docids = idx.family.IF.TreeSet(range(0, 40000, 3))
+        ordered = sorted((docid // 4, docid) for docid in docids)
+        for reverse in (False, True):
+            expected = ordered[::-1] if reverse else ordered
+            for position in (37, 6000, len(expected) - 5):
+                value, docid = expected[position]
+                cursor = paging.encode_cursor(value, docid)
+                result, next_cursor = paging.page(
+                    idx, docids, 20, reverse=reverse, cursor=cursor)
+                tail = [d for v, d in expected[position + 1:]]
+                assert result == tail[:20]
+                assert (next_cursor is None) == (len(tail) < 20)
+
+    def test_deep_pages(self):
+        self._test_deep_pages(self._index(FieldIndex))
+
+    def test_deep_pages_bitmap(self):
+        self._test_deep_pages(self._index(BitmapFieldIndex))
+
+
+class TestBitmapIndexes(unittest.TestCase):
+    """Test postings of bitmap indexes are only ever BitmapPostings"""
+
+    def _postings(self, idx):
+        for postings in idx._fwd_index.values():
+            assert isinstance(postings, BitmapPostings)
+        return dict(
+            (value, list(postings.walk()))
+            for value, postings in idx._fwd_index.items()
+            )
+
+    def test_field_index(self):
+        idx = BitmapFieldIndex('value')
+        for docid, value in ((1, u'a'), (2, u'b'), (3, u'a')):
+            idx.index_value(docid, value)
+        assert self._postings(idx) == {u'a': [1, 3], u'b': [2]}
+        generation = idx.generation()
+        idx.index_value(1, u'a')  # unchanged
+        assert idx.generation() == generation
+        idx.index_value(2, u'c')  # moved to new value, old one removed
+        idx.index_doc(3, MockItem())  # no value
+        assert self._postings(idx) == {u'a': [1], u'c': [2]}
+        assert idx.documentCount() == 2 and list(idx._not_indexed) == [3]
+        assert idx._rev_index[2] == u'c'
+        assert list(idx.applyEq(u'c')) == [2]
+
+    def test_keyword_index(self):
+        idx = BitmapKeywordIndex('value')
+        idx.index_value(1, [u'a', u'b'])
+        idx.index_value(2, [u'b'])
+        idx.index_value(1, [u'c'])
+        assert self._postings(idx) == {u'b': [2], u'c': [1]}
+        assert idx.documentCount() == 2
+
+    def test_mixed_union(self):
+        indexer = Indexer()
+        indexer['bitmap'] = BitmapFieldIndex('value')
+        indexer['treeset'] = FieldIndex('value')
+        indexer['bitmap'].index_value(1, u'a')
+        indexer['treeset'].index_value(2, u'a')
+        q = Eq('bitmap', u'a') | Eq('treeset', u'a')
+        result = indexer.query(q)[1]
+        assert isinstance(result, Bitmap)  # not converted to a set
+        assert list(result) == [1, 2]
+
+
+class TestDateIndex(unittest.TestCase):
+    """Test bucketed range queries of date/datetime indexes"""
+
+    def _item(self, value):
+        item = MockItem()
+        item.value = value
+        return item
+
+    def _index(self, kind, values):
+        import datetime
+        import time
+        from uu.retrieval.indexing.dates import DateIndex
+
+        def _normalize(o, default):
+            v = getattr(o, 'value', default)
+            if isinstance(v, datetime.datetime):
+                return int(time.mktime(v.timetuple()))
+            if isinstance(v, datetime.date):
+                return v.toordinal()
+            return v
+
+        idx = DateIndex(_normalize, kind)
+        for docid, value in enumerate(values):
+            idx.index_doc(docid, self._item(value))
+        return idx, _normalize
+
+    def test_date_range(self):
+        from datetime import date
+        from uu.retrieval.indexing.dates import DATE
+        values = [date(2011, 12, 31), date(2012, 1, 1), date(2012, 2, 15),
+                  date(2012, 12, 31), date(2013, 1, 1), None]
+        idx, _normalize = self._index(DATE, values)
+        value = lambda v: _normalize(self._item(v), None)
+        assert list(idx.applyIsEmpty()) == [5]
+        assert len(idx._year_index) == 3
+        r = idx.applyInRange(
+            value(date(2012, 1, 1)),
+            value(date(2012, 12, 31)),
+            )
+        assert list(r) == [1, 2, 3]
+        r = idx.applyInRange(
+            value(date(2011, 12, 31)),
+            value(date(2013, 1, 1)),
+            excludemin=True,
+            excludemax=True,
+            )
+        assert list(r) == [1, 2, 3]
+        assert list(idx.applyGe(value(date(2012, 2, 1)))) == [2, 3, 4]
+        assert list(idx.applyLt(value(date(2012, 1, 1)))) == [0]
+        # buckets are maintained on reindex/unindex:
+        idx.reindex_doc(2, self._item(date(2014, 3, 1)))
+        assert list(idx.applyGe(value(date(2014, 1, 1)))) == [2]
+        idx.unindex_doc(2)
+        assert 2014 not in idx._year_index
+        assert list(idx.applyGe(value(date(2014, 1, 1)))) == []
+
+    def test_datetime_range(self):
+        from datetime import datetime
+        from uu.retrieval.indexing.dates import DATETIME
+        values = [datetime(2012, 1, 1, 0, 0, 1), datetime(2012, 1, 1, 12),
+                  datetime(2012, 1, 2, 8), datetime(2012, 3, 1, 23, 59)]
+        idx, _normalize = self._index(DATETIME, values)
+        value = lambda v: _normalize(self._item(v), None)
+        r = idx.applyInRange(
+            value(datetime(2012, 1, 1, 6)),
+            value(datetime(2012, 3, 1, 12)),
+            )
+        assert list(r) == [1, 2]
+        r = idx.applyInRange(
+            value(datetime(2012, 1, 1)),
+            value(datetime(2012, 12, 31, 23, 59, 59)),
+            )
+        assert list(r) == [0, 1, 2, 3]
+
+
 class TestIndexer(unittest.TestCase):
     """Test catalog/indexer 64-bit support"""
 
@@ -190,3 +424,201 @@ class TestIndexer(unittest.TestCase):
             MockItem(),
             )
 
+
+class TestSharedLexicon(unittest.TestCase):
+    """Test merging per-index lexicons into a shared lexicon"""
+
+    def _item(self, text):
+        item = MockItem()
+        item.text = text
+        return item
+
+    def test_merge_lexicons(self):
+        _text = lambda o, default: getattr(o, 'text', default)
+        idx1, idx2 = TextIndex(_text), TextIndex(_text)
+        assert idx1.lexicon is not idx2.lexicon
+        idx1.index_doc(1, self._item(u'red green blue'))
+        idx2.index_doc(1, self._item(u'blue orange'))
+        idx2.index_doc(2, self._item(u'green'))
+        lexicon = make_lexicon()
+        merge_lexicons([idx1, idx2], lexicon)
+        assert idx1.lexicon is idx2.lexicon is lexicon
+        assert lexicon.wordCount() == 4
+        # word info re-made in the BTree family of the index:
+        assert isinstance(
+            idx1.index._wordinfo,
+            type(idx1.index.family.IO.BTree()),
+            )
+        assert list(idx1.applyContains('green')) == [1]
+        assert list(idx2.applyContains('green')) == [2]
+        assert sorted(idx2.applyContains('blue')) == [1]
+        # unindex still works against re-mapped word ids:
+        idx2.unindex_doc(1)
+        assert len(idx2.applyContains('orange')) == 0
+        assert list(idx1.applyContains('blue')) == [1]
+
+
+class TestIndexWords(unittest.TestCase):
+    """Test applying pre-normalized words to a text index"""
+
+    TEXTS = {
+        1: u'The quick brown fox',
+        2: u'jumps over the lazy dog, the fox',
+        3: u'quick quick dog',
+        }
+
+    def _words(self, idx, text):
+        words = [text]
+        for element in idx.lexicon._pipeline:
+            words = element.process(words)
+        return words
+
+    def _state(self, idx):
+        okapi = idx.index
+        scores = dict(
+            (word, sorted(okapi.search(word).items()))
+            for word in (u'quick', u'fox', u'dog', u'lazy', u'cat')
+            )
+        return (
+            scores,
+            okapi.wordCount(),
+            okapi.documentCount(),
+            okapi._totaldoclen(),
+            sorted(okapi._docweight.items()),
+            )
+
+    def test_index_words(self):
+        _text = lambda o, default: getattr(o, 'text', default)
+        expected, idx = TextIndex(_text), TextIndex(_text)
+        for docid, text in sorted(self.TEXTS.items()):
+            expected.index_value(docid, text)
+        items = [
+            (docid, self._words(idx, text))
+            for docid, text in sorted(self.TEXTS.items())
+            ]
+        assert idx.index_words(items) == 3
+        assert self._state(idx) == self._state(expected)
+        generation = idx.generation()
+        assert idx.index_words(items) == 0  # unchanged
+        assert idx.generation() == generation
+        # changed words, as on reindex:
+        expected.index_value(2, u'the lazy cat')
+        expected.index_value(3, u'quick dog dog')
+        assert idx.index_words([
+            (2, self._words(idx, u'the lazy cat')),
+            (3, self._words(idx, u'quick dog dog')),
+            ]) == 2
+        assert self._state(idx) == self._state(expected)
+        assert idx.lexicon.wordCount() == expected.lexicon.wordCount()
+
+
+class MockCatalog(Persistent):
+    """Stored object recording hot oids, as a catalog would"""
+
+
+class TestWarmup(unittest.TestCase):
+    """Test loading stored index structures into an empty cache"""
+
+    def setUp(self):
+        self.db = DB(None)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        uidmap = UUIDMapper()
+        for i in range(5000):
+            uidmap.add(str(uuid.uuid4()))
+        conn.root()['uidmap'] = uidmap
+        conn.root()['catalog'] = MockCatalog()
+        tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _open(self):
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        conn.cacheMinimize()  # all ghosts
+        uidmap = conn.root()['uidmap']
+        return conn, tm, [uidmap.uuid_to_docid, uidmap.docid_to_uuid]
+
+    def test_load_structures(self):
+        conn, tm, roots = self._open()
+        walked, loaded = warmup.load_structures(conn, roots)
+        assert walked == loaded > 2  # trees, and their buckets
+        assert warmup.load_structures(conn, roots) == (walked, 0)
+        conn.cacheMinimize()
+        assert warmup.load_structures(conn, roots, limit=3) == (3, 3)
+        conn.close()
+
+    def test_hot_oids(self):
+        conn, tm, roots = self._open()
+        catalog = conn.root()['catalog']
+        for docid in list(roots[1].keys())[:10]:
+            roots[0].get(roots[1][docid])  # "queries" load buckets
+        count = warmup.record_hot(catalog)
+        assert count == len(catalog.hot_oids) > 2
+        tm.commit()
+        conn.close()
+        conn = self.db.open(transaction_manager=tm)
+        conn.cacheMinimize()
+        assert warmup.load_oids(conn, conn.root()['catalog'].hot_oids) == count
+        assert warmup.load_oids(conn, ['\xff' * 8]) == 0  # not stored
+        conn.close()
+
+
+class TestClauseCache(unittest.TestCase):
+    """Test that cached clause results do not outlive aborted changes"""
+
+    def setUp(self):
+        self.db = DB(None)
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(transaction_manager=self.tm)
+        indexer = Indexer()
+        indexer['value'] = FieldIndex('value')
+        for docid, value in enumerate([u'a', u'a', u'b']):
+            item = MockItem()
+            item.value = value
+            indexer.index_doc(docid, item)
+        self.conn.root()['indexer'] = indexer
+        self.tm.commit()
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def _reindex(self, docid, value):
+        item = MockItem()
+        item.value = value
+        self.conn.root()['indexer'].reindex_doc(docid, item)
+
+    def _count(self, value):
+        return self.conn.root()['indexer'].query(Eq('value', value))[0]
+
+    def test_abort(self):
+        indexer = self.conn.root()['indexer']
+        assert self._count(u'a') == 2
+        assert self._count(u'a') == 2
+        assert indexer.clause_cache().hits == 1
+        self._reindex(0, u'b')
+        assert self._count(u'a') == 1
+        self.tm.abort()
+        # a different change, to the same count as the aborted one:
+        self._reindex(2, u'a')
+        assert self._count(u'a') == 3
+        self.tm.commit()
+        assert self._count(u'a') == 3
+        self._reindex(2, u'b')
+        assert self._count(u'a') == 2
+        self.tm.abort()
+        assert self._count(u'a') == 3
+
+    def test_clear(self):
+        indexer = self.conn.root()['indexer']
+        index = indexer['value']
+        generation = index.generation()
+        assert self._count(u'a') == 2
+        index.clear()
+        assert index.generation() == generation + 1
+        assert self._count(u'a') == 0
+        assert FieldIndex('value').generation() == 0
@@ -96,7 +96,7 @@ class TestSchemaManager(unittest.TestCase):
 class TestSchemaIndexes(unittest.TestCase):
 
     def _prefixed_index_name(self, n):
-        prefixes = ('field_', 'keyword_', 'text_')
+        prefixes = ('field_', 'keyword_', 'text_', 'date_')
         return any([n.startswith(p) for p in prefixes])
 
     def test_field(self):
@@ -128,7 +128,7 @@ class TestSchemaIndexes(unittest.TestCase):
                     assert indexes[0].startswith('field_')
                 if schema.interfaces.IDate.providedBy(field):
                     assert len(indexes) == 1
-                    assert indexes[0].startswith('field_')
+                    assert indexes[0].startswith('date_')
                 # omitted types, no indexes for these:
                 if schema.interfaces.IObject.providedBy(field):
                     assert len(indexes) == 0
@@ -146,7 +146,7 @@ class TestSchemaIndexes(unittest.TestCase):
                                     'text_url',
                                     'text_biography',
                                     'field_number',
-                                    'field_date',
+                                    'date_date',
                                     'keyword_subjects',
                                     ))
 
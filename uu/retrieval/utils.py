@@ -1,4 +1,5 @@
 import uuid
+from bisect import bisect_right
 from hashlib import md5
 
 from plone.supermodel import serializeSchema
@@ -42,3 +43,22 @@ def normalize_uuid(v):
     if v in (None, 'None'):
         return None
     return v                            # fallback / unknown
+
+
+def key_before(tree, key):
+    """
+    Largest key of BTree (or TreeSet, or bucket) tree less than key,
+    or None; descends from the root through one path of nodes, without
+    walking buckets in order as tree.keys(max=key)[-1] would.
+    """
+    state = tree.__getstate__() if hasattr(tree, '_bucket_type') else None
+    if state is None or len(state) == 1:
+        # a bucket, or a tree without any separate bucket:
+        keys = tree.keys(max=key, excludemax=True)
+        return keys[-1] if len(keys) else None
+    children, separators = state[0][::2], state[0][1::2]
+    i = bisect_right(separators, key)  # child whose key range has key
+    found = key_before(children[i], key)
+    if found is None and i > 0:
+        found = children[i - 1].maxKey()  # all keys of child are < key
+    return found
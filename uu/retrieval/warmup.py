@@ -0,0 +1,175 @@
+"""
+Warm-up of the (per-connection) ZODB object cache with the structures
+of a catalog queries load first: the UUID map BTrees, the forward
+BTrees of indexes (word info of text indexes) and lexicons.
+
+BTrees are loaded level by level (internal nodes, then buckets), each
+level in batches, prefetched together where the storage supports it
+(Connection.prefetch(), e.g. ZEO), instead of one object at a time as
+queries would.  Object ids recorded (by record_hot()) from the cache of
+a connection that served queries are loaded first, in the same way.
+
+Call warm() (or SimpleCatalog.warmup()) from a process start-up hook,
+e.g. for each catalog when the database is opened.
+"""
+
+import time
+
+from persistent import Persistent
+
+from uu.retrieval.indexing import TextIndex
+
+
+BATCH_SIZE = 500
+
+HOT_LIMIT = 10000  # object ids recorded by record_hot()
+
+# module prefixes of classes of catalog structures recorded as hot:
+HOT_MODULES = ('BTrees.', 'uu.retrieval.', 'zope.index.')
+
+
+def _batches(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _is_tree(obj):
+    return hasattr(obj, '_bucket_type')
+
+
+def _refs(obj, values):
+    """Persistent objects referenced by (loaded) obj, to load next"""
+    state = obj.__getstate__()
+    if isinstance(state, dict):
+        refs = state.values()  # e.g. bitmap postings
+    elif _is_tree(obj) and state is not None and len(state) == 2:
+        return list(state[0][::2])  # children: internal nodes, or buckets
+    elif values and hasattr(obj, 'values'):
+        refs = obj.values()  # bucket, or tree with its bucket inline
+    else:
+        return []
+    return [ref for ref in refs if isinstance(ref, Persistent)]
+
+
+def _activate(jar, objects):
+    """Load objects (in batches, prefetched), return count loaded"""
+    prefetch = getattr(jar, 'prefetch', None)
+    loaded = 0
+    for batch in _batches(objects, BATCH_SIZE):
+        ghosts = [obj for obj in batch if obj._p_changed is None]
+        if prefetch is not None and ghosts:
+            prefetch(ghosts)
+        for obj in ghosts:
+            try:
+                obj._p_activate()
+            except KeyError:
+                continue  # POSKeyError: object removed from storage
+            loaded += 1
+    return loaded
+
+
+def load_structures(jar, roots, values=False, limit=None):
+    """
+    Load roots (persistent objects) and objects they reference, level
+    by level; values of buckets are only loaded if values is true.
+    Loads at most limit objects (or all); returns (objects, loaded)
+    counts of objects walked and of those loaded from storage.
+    """
+    walked, loaded = 0, 0
+    seen = set()
+    level = list(roots)
+    while level and (limit is None or walked < limit):
+        level = [obj for obj in level if id(obj) not in seen]
+        if limit is not None:
+            level = level[:limit - walked]
+        seen.update(id(obj) for obj in level)
+        loaded += _activate(jar, level)
+        walked += len(level)
+        below = []
+        for obj in level:
+            if obj._p_changed is not None:  # loaded, not a missing ghost
+                below.extend(_refs(obj, values))
+        level = below
+    return walked, loaded
+
+
+def load_oids(jar, oids):
+    """Load objects by oid, in prefetched batches; returns count loaded"""
+    objects = []
+    for oid in oids:
+        try:
+            objects.append(jar.get(oid))
+        except KeyError:
+            continue  # POSKeyError: object removed from storage
+    return _activate(jar, objects)
+
+
+def structures(catalog, names=None):
+    """
+    Root structures of catalog to warm: the UUID map BTrees, and the
+    forward BTree of each index named in names (all, if None), with
+    the word info BTree and lexicon BTrees of text indexes.
+    """
+    uidmap = catalog.uidmap
+    result = [uidmap.uuid_to_docid, uidmap.docid_to_uuid]
+    if names is None:
+        names = sorted(catalog.indexer.keys())
+    for name in names:
+        idx = catalog.indexer[name]
+        if isinstance(idx, TextIndex):
+            lexicon = idx.index._lexicon
+            result.append(idx.index._wordinfo)
+            result.extend([lexicon._wids, lexicon._words])
+        else:
+            result.append(idx._fwd_index)
+    return result
+
+
+def record_hot(catalog, limit=HOT_LIMIT):
+    """
+    Record (in catalog.hot_oids, persisted on commit) the oids of at
+    most limit of the most recently used catalog structures (BTrees,
+    index and catalog objects) in the object cache of the connection
+    of catalog; returns count of oids recorded.
+    """
+    jar = getattr(catalog, '_p_jar', None)
+    lru_items = getattr(getattr(jar, '_cache', None), 'lru_items', None)
+    if lru_items is None:
+        return 0
+    hot = [
+        oid for oid, obj in lru_items()  # least recently used first
+        if obj._p_changed is not None and
+        type(obj).__module__.startswith(HOT_MODULES)
+        ]
+    catalog.hot_oids = tuple(hot[-limit:])
+    return len(catalog.hot_oids)
+
+
+def warm(catalog, names=None, values=False, limit=None, oids=None):
+    """
+    Warm the object cache of the connection of catalog: load objects
+    for oids (default: catalog.hot_oids, as recorded by record_hot()),
+    then the structures() of catalog for index names, as for
+    load_structures().  Returns a dict of objects (walked), loaded
+    (from storage), seconds (taken) and prefetch (whether the
+    connection supports batched prefetch).
+    """
+    start = time.time()
+    jar = getattr(catalog, '_p_jar', None)
+    if oids is None:
+        oids = getattr(catalog, 'hot_oids', ())
+    loaded = 0
+    if oids and jar is not None:
+        loaded += load_oids(jar, oids)
+    walked, structure_loaded = load_structures(
+        jar,
+        structures(catalog, names),
+        values,
+        limit,
+        )
+    return {
+        'objects': walked,
+        'loaded': loaded + structure_loaded,
+        'seconds': time.time() - start,
+        'prefetch': hasattr(jar, 'prefetch'),
+        }